@@ -3,6 +3,7 @@ import pstats
 
 import bpy.props
 
+from .geometry_cache import fixed_object_cache
 from .icputil import *
 
 class ICPOperator(bpy.types.Operator):
@@ -28,6 +29,25 @@ class ICPOperator(bpy.types.Operator):
                                      description='Threshold used to detect if converged',
                                      default=0.01, min=0.0, step=0.01)
 
+    pyramid_levels: bpy.props.IntProperty(name='Pyramid levels',
+                                          description='Number of resolution levels. The first iterations match '
+                                                      'downsampled objects, each level has 4 times more points than '
+                                                      'the previous one. 1 matches at full resolution only',
+                                          default=1, min=1, max=8)
+
+    initial_alignment: bpy.props.EnumProperty(name='Initial alignment',
+                                              description='Coarse alignment of the moving object onto the fixed one '
+                                                          'before iterating, kept only if it fits better than the '
+                                                          'current pose',
+                                              items=[
+                                                  ('NONE', 'None', 'Start from the current pose'),
+                                                  ('PCA', 'Principal axes',
+                                                   'Align the principal axes of both objects'),
+                                                  ('PCA_FEATURES', 'Principal axes and features',
+                                                   'Also try matches of local shape features, for objects that '
+                                                   'only partially overlap'),
+                                              ])
+
     normal_dissimilarity_threshold: bpy.props.FloatProperty(name='normal dissimilarity threshold', default=0.5,
                                                             min=0.0001)
     # Point selection method
@@ -45,6 +65,11 @@ class ICPOperator(bpy.types.Operator):
                                       default=1000,
                                       min=1)
 
+    seed: bpy.props.IntProperty(name='Seed',
+                                description='Seed of the random point sampling, runs with the same seed give '
+                                            'identical results',
+                                default=0, min=0)
+
     matching_dist_metric: bpy.props.EnumProperty(name='Method',
                                                  description='Metric used to create point correspondences',
                                                  items=[
@@ -53,6 +78,53 @@ class ICPOperator(bpy.types.Operator):
                                                       'Normal weighted Euclidean distance'),
                                                  ])
 
+    normal_weight: bpy.props.FloatProperty(name='Normal weight',
+                                           description='Weight of normal differences relative to point distances, '
+                                                       'as a fraction of the fixed object\'s size',
+                                           default=0.05, min=0.0)
+
+    matching_index: bpy.props.EnumProperty(name='Index',
+                                           description='Spatial index used to find closest points',
+                                           items=[
+                                               ('KD_TREE', 'KD-tree', 'Balanced KD-tree, works for any alignment'),
+                                               ('VOXEL_GRID', 'Voxel grid',
+                                                'Uniform hash grid, fastest when objects are roughly aligned. '
+                                                'Not used for normal weighted matching, which uses the KD-tree'),
+                                               ('AUTO', 'Automatic',
+                                                'Brute force, KD-tree or voxel grid, whichever this machine answers '
+                                                'fastest for the object sizes. Measured once, on points near the '
+                                                'fixed object'),
+                                           ])
+
+    approx_eps: bpy.props.FloatProperty(name='Approximation',
+                                        description='Closest points may be up to (1 + approximation) times farther '
+                                                    'than the true closest points, trading accuracy for speed',
+                                        default=0.0, min=0.0)
+
+    approx_schedule: bpy.props.BoolProperty(name='Tighten approximation',
+                                            description='Start with approximate matching, and tighten it to exact '
+                                                        'matching as the iterations converge',
+                                            default=False)
+
+    kdtree_cache_dir: bpy.props.StringProperty(name='KD-tree cache',
+                                               description='Directory to cache built kd-trees in, reused when the '
+                                                           'fixed object is unchanged. Leave empty to disable',
+                                               default='', subtype='DIR_PATH')
+
+    kdtree_cache_size: bpy.props.IntProperty(name='Cache size (MB)',
+                                             description='Maximum size of the kd-tree cache on disk',
+                                             default=1024, min=1)
+
+    geometry_cache_size: bpy.props.IntProperty(name='Memory cache (MB)',
+                                               description='Memory budget for keeping the fixed object\'s buffers '
+                                                           'and index between runs. 0 disables the cache',
+                                               default=512, min=0)
+
+    processes: bpy.props.IntProperty(name='Processes',
+                                     description='Worker processes that align objects in parallel, when more than one '
+                                                 'object is aligned to the active object. 0 uses all cores',
+                                     default=0, min=0)
+
     rejection_criterion: bpy.props.EnumProperty(name='Criterion',
                                                 description='Criterion used to reject outlier point-pairs',
                                                 items=[
@@ -79,6 +151,9 @@ class ICPOperator(bpy.types.Operator):
     nu: bpy.props.FloatProperty(name='nu', default=1, min=0.01)
 
     animate: bpy.props.BoolProperty('Animate', default=False, description='output animation as set of frames')
+    animation_interval: bpy.props.IntProperty(name='Frame interval',
+                                              description='Render a frame every this many iterations',
+                                              default=1, min=1)
     animation_dir: bpy.props.StringProperty('Animation dir', default='animation',
                                             description='relative path to animation directory')
 
@@ -92,15 +167,31 @@ class ICPOperator(bpy.types.Operator):
         box.label(text="Iteration options:")
         box.prop(self, "max_iterations")
         box.prop(self, "epsilon")
+        box.prop(self, "pyramid_levels")
+        box.prop(self, "initial_alignment")
+        if len(context.selected_objects) > 2:
+            box.prop(self, "processes")
 
         box = col.box()
         box.label(text='Point sampling:')
         box.prop(self, "sampling_method")
         box.prop(self, "max_points")
+        box.prop(self, "seed")
 
         box = col.box()
         box.label(text='Point matching:')
         box.prop(self, "matching_dist_metric")
+        if self.matching_dist_metric == 'NORMAL_WEIGHTED':
+            box.prop(self, "normal_weight")
+        box.prop(self, "matching_index")
+        if self.matching_index in {'KD_TREE', 'AUTO'}:
+            box.prop(self, "kdtree_cache_dir")
+            if self.kdtree_cache_dir:
+                box.prop(self, "kdtree_cache_size")
+        box.prop(self, "geometry_cache_size")
+        box.prop(self, "approx_eps")
+        if self.approx_eps > 0:
+            box.prop(self, "approx_schedule")
 
         box = col.box()
         box.label(text='Point-pair rejection:')
@@ -111,30 +202,33 @@ class ICPOperator(bpy.types.Operator):
         elif self.rejection_criterion == 'DISSIMILAR_NORMALS':
             box.prop(self, "normal_dissimilarity_threshold")
 
-        if self.minimization_function == 'POINT_TO_POINT':
-
-            box = col.box()
-            box.label(text="Point-pair weighing:")
-            box.prop(self, "weighting_strategy")
+        box = col.box()
+        box.label(text="Point-pair weighing:")
+        box.prop(self, "weighting_strategy")
 
-            if self.weighting_strategy == 'WELSCH':
-                box.prop(self, "nu")
+        if self.weighting_strategy == 'WELSCH':
+            box.prop(self, "nu")
 
         box = col.box()
         box.label(text='Animation')
         box.prop(self, "animate")
+        if self.animate:
+            box.prop(self, "animation_interval")
         box.prop(self, "animation_dir")
 
     def execute(self, context):
         objs = bpy.context.selected_objects
 
-        if len(objs) != 2:
-            self.report({'ERROR'}, "Select 2 objects for ICP")
-            return {'CANCELLED'}
-
-        # first selected is moving, second selected is fixed
+        # the active object is fixed, all other selected objects are moved onto it
         fixed = bpy.context.active_object
-        moving = objs[1] if fixed == objs[0] else objs[0]
+        moving = [obj for obj in objs if obj != fixed]
+
+        if fixed is None or fixed not in objs or not moving:
+            self.report({'ERROR'}, "Select the objects to move and then the fixed object for ICP")
+            return {'CANCELLED'}
+        if len(moving) > 1 and self.animate:
+            self.report({'ERROR'}, "Animation is only supported when moving one object")
+            return {'CANCELLED'}
 
         icp_solver = ICP(max_iterations=self.max_iterations, eps=self.epsilon, max_points=self.max_points,
                          k=self.k, nu=self.nu, sampling_strategy=self.sampling_method,
@@ -142,22 +236,47 @@ class ICPOperator(bpy.types.Operator):
                          point_to_plane=self.minimization_function == 'POINT_TO_PLANE',
                          rejection_criterion=self.rejection_criterion,
                          weighting_strategy=self.weighting_strategy,
-                         animate=self.animate,
+                         distance_strategy=self.matching_dist_metric, normal_weight=self.normal_weight,
+                         matching_index=self.matching_index,
+                         approx_eps=self.approx_eps, approx_schedule=self.approx_schedule,
+                         kdtree_cache_dir=bpy.path.abspath(self.kdtree_cache_dir) if self.kdtree_cache_dir else None,
+                         kdtree_cache_bytes=self.kdtree_cache_size * 1024 * 1024,
+                         seed=self.seed,
+                         geometry_cache=fixed_object_cache if self.geometry_cache_size > 0 else None,
+                         pyramid_levels=self.pyramid_levels, initial_alignment=self.initial_alignment,
+                         animate=self.animate, animation_interval=self.animation_interval,
                          frames_folder=self.animation_dir)
 
-        try:
+        fixed_object_cache.max_bytes = self.geometry_cache_size * 1024 * 1024
+        fixed_object_cache.evict()
 
-            with cProfile.Profile() as pr:
-                converged, iters_required = icp_solver.icp(moving, fixed)
-
-            stats = pstats.Stats(pr)
-            stats.sort_stats(pstats.SortKey.TIME)
-            stats.dump_stats(filename='profile.prof')
+        try:
 
-            if converged:
-                self.report({'INFO'}, f'converged in {iters_required} iterations')
+            if len(moving) > 1:
+                results = icp_solver.icp_batch(moving, fixed, processes=self.processes or None)
+            else:
+                with cProfile.Profile() as pr:
+                    converged, iters_required = icp_solver.icp(moving[0], fixed)
+
+                stats = pstats.Stats(pr)
+                stats.sort_stats(pstats.SortKey.TIME)
+                stats.dump_stats(filename='profile.prof')
+
+            cache_report = ''
+            if self.geometry_cache_size > 0:
+                cache_report = (f', fixed object cache {"hit" if fixed_object_cache.last_hit else "miss"} '
+                                f'({fixed_object_cache.hits} hits, {fixed_object_cache.misses} misses)')
+
+            if len(moving) > 1:
+                for obj, result in zip(moving, results):
+                    print(f'{obj.name}: {"converged" if result.converged else "not converged"} after '
+                          f'{result.iterations} iterations in {result.seconds:.3f}s')
+                n_converged = sum(result.converged for result in results)
+                self.report({'INFO'}, f'{n_converged} of {len(results)} objects converged{cache_report}')
+            elif converged:
+                self.report({'INFO'}, f'converged in {iters_required} iterations{cache_report}')
             else:
-                self.report({'INFO'}, f'Not converged')
+                self.report({'INFO'}, f'Not converged{cache_report}')
 
         except RuntimeError as e:
             self.report({'ERROR'}, str(e))
@@ -52,13 +52,14 @@ class LaplacianBrushOperator(bpy.types.Operator):
         delta_y = (self.laplacian @ vy).reshape(-1, 1)
         delta_z = (self.laplacian @ vz).reshape(-1, 1)
 
-        # selected verts
-        selected_verts_indices = [v.index for v in bm.verts if v.select]
+        # selected verts, read in bulk from the mesh once it is synced with the edit mesh
+        obj.update_from_editmode()
+        selected_verts = vertex_selection(mesh)
 
         # select gradients
-        selected_delta_x = delta_x[selected_verts_indices]
-        selected_delta_y = delta_y[selected_verts_indices]
-        selected_delta_z = delta_z[selected_verts_indices]
+        selected_delta_x = delta_x[selected_verts]
+        selected_delta_y = delta_y[selected_verts]
+        selected_delta_z = delta_z[selected_verts]
 
         # modify the selected gradients with the matrix
         modified_selected_deltas = np.concatenate((selected_delta_x, selected_delta_y, selected_delta_z),
@@ -73,9 +74,9 @@ class LaplacianBrushOperator(bpy.types.Operator):
         modified_delta_y = delta_y.flatten()
         modified_delta_z = delta_z.flatten()
 
-        modified_delta_x[selected_verts_indices] = modified_selected_delta_x
-        modified_delta_y[selected_verts_indices] = modified_selected_delta_y
-        modified_delta_z[selected_verts_indices] = modified_selected_delta_z
+        modified_delta_x[selected_verts] = modified_selected_delta_x
+        modified_delta_y[selected_verts] = modified_selected_delta_y
+        modified_delta_z[selected_verts] = modified_selected_delta_z
 
         # flatten modified gradients
         modified_deltas_x = modified_delta_x.reshape(-1, 1)
@@ -86,23 +87,16 @@ class LaplacianBrushOperator(bpy.types.Operator):
         rhs_y = (self.laplacian.T @ modified_deltas_y).flatten()
         rhs_z = (self.laplacian.T @ modified_deltas_z).flatten()
 
-        center_og = centroid([corner.co for corner in bm.verts])
+        center_og = bmesh_positions(bm).mean(axis=0)
 
         new_vx = self.left_hand_side.solve(rhs_x)
         new_vy = self.left_hand_side.solve(rhs_y)
         new_vz = self.left_hand_side.solve(rhs_z)
 
-        for v_i, v in enumerate(bm.verts):
-            v.co.x = new_vx[v_i]
-            v.co.y = new_vy[v_i]
-            v.co.z = new_vz[v_i]
-
-        center_new = centroid([corner.co for corner in bm.verts])
-
-        diff = center_new - center_og
-
-        for v in bm.verts:
-            v.co -= diff
+        # set vertex coordinates, keeping the centroid in place
+        new_positions = np.column_stack((new_vx, new_vy, new_vz))
+        diff = new_positions.mean(axis=0) - center_og
+        set_bmesh_positions(bm, new_positions - diff)
 
         bm.free()
 
@@ -54,13 +54,14 @@ class GradientBrushOperator(bpy.types.Operator):
         grads_y = (self.gradient_matrix @ vy).reshape(-1, 3)
         grads_z = (self.gradient_matrix @ vz).reshape(-1, 3)
 
-        # selected faces
-        selected_faces_indices = [f.index for f in bm.faces if f.select]
+        # selected faces, read in bulk from the mesh once it is synced with the edit mesh
+        obj.update_from_editmode()
+        selected_faces = face_selection(mesh)
 
         # select gradients
-        selected_grads_x = grads_x[selected_faces_indices]
-        selected_grads_y = grads_y[selected_faces_indices]
-        selected_grads_z = grads_z[selected_faces_indices]
+        selected_grads_x = grads_x[selected_faces]
+        selected_grads_y = grads_y[selected_faces]
+        selected_grads_z = grads_z[selected_faces]
 
         # modify the selected gradients with the matrix
         modified_selected_grads_x = selected_grads_x @ self.matrix()
@@ -72,9 +73,9 @@ class GradientBrushOperator(bpy.types.Operator):
         modified_grads_y = grads_y
         modified_grads_z = grads_z
 
-        modified_grads_x[selected_faces_indices] = modified_selected_grads_x
-        modified_grads_y[selected_faces_indices] = modified_selected_grads_y
-        modified_grads_z[selected_faces_indices] = modified_selected_grads_z
+        modified_grads_x[selected_faces] = modified_selected_grads_x
+        modified_grads_y[selected_faces] = modified_selected_grads_y
+        modified_grads_z[selected_faces] = modified_selected_grads_z
 
         # flatten modified gradients
         modified_grads_x = modified_grads_x.reshape(-1, 1)
@@ -85,24 +86,16 @@ class GradientBrushOperator(bpy.types.Operator):
         rhs_y = (self.gtmv @ modified_grads_y).flatten()
         rhs_z = (self.gtmv @ modified_grads_z).flatten()
 
-        center_og = centroid([corner.co for corner in bm.verts])
+        center_og = np.column_stack((vx, vy, vz)).mean(axis=0)
 
         new_vx = self.cotangent_matrix.solve(rhs_x)
         new_vy = self.cotangent_matrix.solve(rhs_y)
         new_vz = self.cotangent_matrix.solve(rhs_z)
 
-        # set vertex coordinates
-        for v_i, v in enumerate(bm.verts):
-            v.co.x = new_vx[v_i]
-            v.co.y = new_vy[v_i]
-            v.co.z = new_vz[v_i]
-
-        center_new = centroid([corner.co for corner in bm.verts])
-
-        diff = center_new - center_og
-
-        for v in bm.verts:
-            v.co -= diff
+        # set vertex coordinates, keeping the centroid in place
+        new_positions = np.column_stack((new_vx, new_vy, new_vz))
+        diff = new_positions.mean(axis=0) - center_og
+        set_bmesh_positions(bm, new_positions - diff)
 
         bm.free()
 
@@ -167,13 +160,14 @@ class ScaleRotateGradientBrushOp(GradientBrushOperator):
         grads_y = (self.gradient_matrix @ vy).reshape(-1, 3)
         grads_z = (self.gradient_matrix @ vz).reshape(-1, 3)
 
-        # selected faces
-        selected_faces_indices = [f.index for f in bm.faces if f.select]
+        # selected faces, read in bulk from the mesh once it is synced with the edit mesh
+        obj.update_from_editmode()
+        selected_faces = face_selection(mesh)
 
         # select gradients
-        selected_grads_x = grads_x[selected_faces_indices]
-        selected_grads_y = grads_y[selected_faces_indices]
-        selected_grads_z = grads_z[selected_faces_indices]
+        selected_grads_x = grads_x[selected_faces]
+        selected_grads_y = grads_y[selected_faces]
+        selected_grads_z = grads_z[selected_faces]
 
         # modify the selected gradients with the matrix
         modified_selected_grads_x = selected_grads_x @ self.matrix()
@@ -185,9 +179,9 @@ class ScaleRotateGradientBrushOp(GradientBrushOperator):
         modified_grads_y = grads_y
         modified_grads_z = grads_z
 
-        modified_grads_x[selected_faces_indices] = modified_selected_grads_x
-        modified_grads_y[selected_faces_indices] = modified_selected_grads_y
-        modified_grads_z[selected_faces_indices] = modified_selected_grads_z
+        modified_grads_x[selected_faces] = modified_selected_grads_x
+        modified_grads_y[selected_faces] = modified_selected_grads_y
+        modified_grads_z[selected_faces] = modified_selected_grads_z
 
         # flatten modified gradients
         modified_grads_x = modified_grads_x.reshape(-1, 1)
@@ -198,24 +192,16 @@ class ScaleRotateGradientBrushOp(GradientBrushOperator):
         rhs_y = (self.gtmv @ modified_grads_y).flatten()
         rhs_z = (self.gtmv @ modified_grads_z).flatten()
 
-        center_og = centroid([corner.co for corner in bm.verts])
+        center_og = np.column_stack((vx, vy, vz)).mean(axis=0)
 
         new_vx = self.cotangent_matrix.solve(rhs_x)
         new_vy = self.cotangent_matrix.solve(rhs_y)
         new_vz = self.cotangent_matrix.solve(rhs_z)
 
-        # set vertex coordinates
-        for v_i, v in enumerate(bm.verts):
-            v.co.x = new_vx[v_i]
-            v.co.y = new_vy[v_i]
-            v.co.z = new_vz[v_i]
-
-        center_new = centroid([corner.co for corner in bm.verts])
-
-        diff = center_new - center_og
-
-        for v in bm.verts:
-            v.co -= diff
+        # set vertex coordinates, keeping the centroid in place
+        new_positions = np.column_stack((new_vx, new_vy, new_vz))
+        diff = new_positions.mean(axis=0) - center_og
+        set_bmesh_positions(bm, new_positions - diff)
 
         bm.free()
 
@@ -61,28 +61,21 @@ class SmoothLaplacianOp(bpy.types.Operator):
             bm.from_mesh(obj.data)
 
             vx, vy, vz = self.perform_smoothing(obj, bm)
-
-            for v in bm.verts:
-                v.co.x = vx[v.index]
-                v.co.y = vy[v.index]
-                v.co.z = vz[v.index]
-
-            bm.to_mesh(obj.data)
             bm.free()
 
+            set_vertex_positions(obj.data, np.column_stack((vx, vy, vz)))
+
         elif bpy.context.mode == 'EDIT_MESH':
 
             # if in edit mode, only smooth the selected vertices
+            obj.update_from_editmode()
+            selected = vertex_selection(obj.data)
             bm = bmesh.from_edit_mesh(obj.data)
-            selected_vertices = set([v for v in bm.verts if v.select])
 
             vx, vy, vz = self.perform_smoothing(obj, bm)
 
             # only affect selected vertices
-            for v in selected_vertices:
-                v.co.x = vx[v.index]
-                v.co.y = vy[v.index]
-                v.co.z = vz[v.index]
+            set_bmesh_positions(bm, np.column_stack((vx, vy, vz)), mask=selected)
 
         return {'FINISHED'}
 
@@ -1,3 +1,5 @@
+import hashlib
+import itertools
 import re
 
 import bpy
@@ -45,6 +47,135 @@ def rigid_transform(t: np.ndarray, r: np.ndarray, obj):
     transform_matrix = translation_matrix @ rotation_matrix
     obj.matrix_world = transform_matrix @ obj.matrix_world
 
+def normal_matrix(obj) -> Matrix:
+    """
+    Matrix that transforms the local normals of an object into world space normals (up to normalization)
+    """
+    return obj.matrix_world.to_3x3().inverted_safe().transposed()
+
+# bulk mesh I/O. Mesh data is read and written with foreach_get/foreach_set into float32/int32 buffers, which blender
+# copies without converting each value, and is returned as (N, 3) float64 or (N, k) int64 arrays
+
+def _read(collection, attr: str, width: int, dtype) -> np.ndarray:
+    buffer = np.empty(len(collection) * width, dtype=dtype)
+    collection.foreach_get(attr, buffer)
+    return buffer.reshape(-1, width) if width > 1 else buffer
+
+def vertex_positions(mesh) -> np.ndarray:
+    """
+    (N, 3) local vertex positions of a mesh
+    """
+    return _read(mesh.vertices, 'co', 3, np.float32).astype(np.float64)
+
+def set_vertex_positions(mesh, positions: np.ndarray):
+    """
+    Overwrite all local vertex positions of a mesh with an (N, 3) array
+    """
+    mesh.vertices.foreach_set('co', np.ascontiguousarray(positions, dtype=np.float32).ravel())
+    mesh.update()
+
+def vertex_normals(mesh) -> np.ndarray:
+    """
+    (N, 3) local vertex normals of a mesh
+    """
+    return _read(mesh.vertices, 'normal', 3, np.float32).astype(np.float64)
+
+def edge_indices(mesh) -> np.ndarray:
+    """
+    (E, 2) vertex indices of the edges of a mesh
+    """
+    return _read(mesh.edges, 'vertices', 2, np.int32).astype(np.int64)
+
+def face_indices(mesh) -> np.ndarray:
+    """
+    (F, 3) vertex indices of the faces of a triangulated mesh, in the order of its polygons. Polygons vary in length,
+    so their vertices are read from their loops
+    """
+    loop_totals = _read(mesh.polygons, 'loop_total', 1, np.int32)
+    if np.any(loop_totals != 3):
+        raise ValueError(f'{mesh.name} is not triangulated')
+    loop_starts = _read(mesh.polygons, 'loop_start', 1, np.int32)
+    loop_vertices = _read(mesh.loops, 'vertex_index', 1, np.int32)
+    return loop_vertices[loop_starts[:, None] + np.arange(3)].astype(np.int64)
+
+def vertex_selection(mesh) -> np.ndarray:
+    """
+    (N,) boolean mask of the selected vertices of a mesh. In edit mode, the mesh has to be synced with
+    obj.update_from_editmode() first
+    """
+    return _read(mesh.vertices, 'select', 1, bool)
+
+def set_vertex_selection(mesh, mask: np.ndarray):
+    """
+    Select the vertices of a mesh given by an (N,) boolean mask, and deselect all others
+    """
+    mesh.vertices.foreach_set('select', np.ascontiguousarray(mask, dtype=bool))
+    mesh.update()
+
+def edge_selection(mesh) -> np.ndarray:
+    """
+    (E,) boolean mask of the selected edges of a mesh
+    """
+    return _read(mesh.edges, 'select', 1, bool)
+
+def face_selection(mesh) -> np.ndarray:
+    """
+    (F,) boolean mask of the selected faces of a mesh. In edit mode, the mesh has to be synced with
+    obj.update_from_editmode() first
+    """
+    return _read(mesh.polygons, 'select', 1, bool)
+
+def to_world(obj, points: np.ndarray) -> np.ndarray:
+    """
+    Transform (N, 3) local points of an object into world space, as one 4x4 matrix product
+    """
+    homogeneous = np.hstack((points, np.ones((len(points), 1))))
+    return (homogeneous @ np.array(obj.matrix_world).T)[:, :3]
+
+def world_vertex_positions(obj) -> np.ndarray:
+    """
+    (N, 3) world space vertex positions of a mesh object
+    """
+    return to_world(obj, vertex_positions(obj.data))
+
+def world_vertices(obj) -> (np.ndarray, np.ndarray):
+    """
+    (N, 3) world space vertex positions and (N, 3) unit world space vertex normals of a mesh object
+    """
+    normals = vertex_normals(obj.data) @ np.array(normal_matrix(obj)).T
+    normals /= np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+    return world_vertex_positions(obj), normals
+
+def mesh_hash(mesh) -> str:
+    """
+    Hash of the vertex positions and normals of a mesh, which changes whenever its geometry is edited
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(_read(mesh.vertices, 'co', 3, np.float32).tobytes())
+    h.update(_read(mesh.vertices, 'normal', 3, np.float32).tobytes())
+    return h.hexdigest()
+
+def bmesh_positions(bm: BMesh) -> np.ndarray:
+    """
+    (N, 3) vertex positions of a BMesh. BMesh has no bulk access, so this is the fastest way to read an edit mesh
+    """
+    return np.fromiter(itertools.chain.from_iterable(v.co for v in bm.verts), dtype=np.float64,
+                       count=3 * len(bm.verts)).reshape(-1, 3)
+
+def set_bmesh_positions(bm: BMesh, positions: np.ndarray, mask=None):
+    """
+    Set the vertex positions of a BMesh from an (N, 3) array, one vector assignment per vertex
+    :param mask: optional (N,) boolean mask of the vertices to set, the others keep their positions
+    """
+    rows = positions.tolist()
+    if mask is None:
+        for v, co in zip(bm.verts, rows):
+            v.co = co
+    else:
+        bm.verts.ensure_lookup_table()
+        for i in np.flatnonzero(mask).tolist():
+            bm.verts[i].co = rows[i]
+
 def get_or_else(d: dict, key, other):
     return other if d.get(key) is None else d.get(key)
 
@@ -77,8 +208,7 @@ def set_vector_attrib(obj, name: str, domain: str, vectors: np.ndarray):
     if not obj.data.attributes.get(name):
         obj.data.attributes.new(name, type='FLOAT_VECTOR', domain=domain)
 
-    for i, vector in enumerate(vectors):
-        obj.data.attributes[name].data[i].vector = Vector(vector)
+    obj.data.attributes[name].data.foreach_set("vector", np.ascontiguousarray(vectors, dtype=np.float32).ravel())
 
 def set_vector_face_attrib(obj, name: str, vectors):
     set_vector_attrib(obj, name, 'FACE', vectors)
@@ -0,0 +1,127 @@
+import mmap
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+import numpy as np
+
+def _is_mapped(array: np.ndarray) -> bool:
+    """
+    Whether an array or the array it is a view of is memory-mapped from a file
+    """
+    base = array
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, 'base', None)
+    return False
+
+def nbytes(value, _seen=None) -> int:
+    """
+    Approximate memory held by a value: the sizes of all numpy arrays reachable from it through containers and
+    object attributes. Memory-mapped arrays, like those of KDTrees loaded from the on-disk cache, are paged in and
+    out by the OS and are not counted
+    """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return 0 if _is_mapped(value) else value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(v, _seen) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(v, _seen) for v in value)
+    if hasattr(value, '__dict__'):
+        return sum(nbytes(v, _seen) for v in vars(value).values())
+    return 0
+
+def _close(value):
+    """
+    Release the resources of an evicted value, e.g. the worker processes of KDTrees
+    """
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            _close(v)
+    elif hasattr(value, 'close'):
+        value.close()
+
+class GeometryCache:
+    """
+    In-memory least recently used cache of derived geometry, like world space buffers and spatial indices, bounded
+    by the total size of the arrays it holds.
+
+    Values that are larger than the whole budget are returned without being cached. Evicted values are closed if
+    they have a close method.
+    """
+
+    def __init__(self, max_bytes=512 << 20):
+        """
+        :param max_bytes: maximum total size of the cached values
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._sizes = {}
+
+        # lookup statistics, for reporting
+        self.hits = 0
+        self.misses = 0
+        self.last_hit = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    @property
+    def size(self) -> int:
+        """
+        Total size of the cached values in bytes
+        """
+        return sum(self._sizes.values())
+
+    def get_or_build(self, key: Hashable, build: Callable[[], object]):
+        """
+        Return the cached value of key, or build it with build() and cache it
+        """
+        if key in self._entries:
+            self.hits += 1
+            self.last_hit = True
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        self.last_hit = False
+        value = build()
+
+        size = nbytes(value)
+        if size <= self.max_bytes:
+            self._entries[key] = value
+            self._sizes[key] = size
+            self.evict(keep=key)
+        return value
+
+    def evict(self, keep=None):
+        """
+        Evict least recently used values until the cache fits into its budget
+        :param keep: key that is never evicted, e.g. the one just added
+        """
+        for key in list(self._entries):
+            if self.size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self._sizes.pop(key)
+            _close(self._entries.pop(key))
+
+    def clear(self):
+        for value in self._entries.values():
+            _close(value)
+        self._entries.clear()
+        self._sizes.clear()
+
+# cache shared by all ICP runs of this process, so that re-running the operator with tweaked settings reuses the
+# fixed object's buffers and index
+fixed_object_cache = GeometryCache()
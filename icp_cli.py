@@ -0,0 +1,130 @@
+"""
+Register point clouds or meshes without blender: aligns each moving file onto the fixed file, and writes the 4x4
+transforms with per-iteration statistics as JSON. Exits with status 1 if any registration did not converge.
+
+    python icp_cli.py moving.ply fixed.ply --point-to-plane --output result.json
+    python icp_cli.py scan_*.ply reference.obj --processes 8
+    python icp_cli.py scan.ply huge_reference.npy --tiles reference_tiles --memory-budget 2048
+"""
+import argparse
+import json
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+try:
+    from .icp_engine import ICPEngine, close_levels, register_batch
+    from .mesh_io import read_points
+    from .tiled_index import TILE_POINTS, build_tiles_from_file, is_tiled
+except ImportError:
+    from icp_engine import ICPEngine, close_levels, register_batch
+    from mesh_io import read_points
+    from tiled_index import TILE_POINTS, build_tiles_from_file, is_tiled
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Iterative closest point registration of mesh and point files '
+                                                 '(.ply, .obj, .xyz, .npy)')
+    parser.add_argument('moving', nargs='+', help='files to move onto the fixed file')
+    parser.add_argument('fixed', help='file that stays in place')
+    parser.add_argument('--output', '-o', help='JSON file to write the results to, standard output if omitted')
+    parser.add_argument('--initial', help='JSON or .npy file with the initial 4x4 transform of the moving files')
+
+    parser.add_argument('--max-iterations', type=int, default=100)
+    parser.add_argument('--eps', type=float, default=0.001, help='threshold used to detect if converged')
+    parser.add_argument('--max-points', type=int, default=1000, help='number of points sampled per iteration')
+    parser.add_argument('--point-to-plane', action='store_true', help='minimize point-to-plane distances')
+    parser.add_argument('--sampling', default='RANDOM_POINT', choices=['RANDOM_POINT', 'NORMAL', 'STRATIFIED_NORMAL'])
+    parser.add_argument('--matching', default='EUCLIDEAN', choices=['EUCLIDEAN', 'NORMAL_WEIGHTED'])
+    parser.add_argument('--normal-weight', type=float, default=0.05)
+    parser.add_argument('--index', default='KD_TREE', choices=['KD_TREE', 'VOXEL_GRID', 'AUTO'],
+                        help='spatial index of the fixed points. Voxel grids only index positions, with normal '
+                             'weighted matching a kd-tree is used instead')
+    parser.add_argument('--approx-eps', type=float, default=0.0)
+    parser.add_argument('--approx-schedule', action='store_true')
+    parser.add_argument('--kdtree-cache-dir', help='directory to cache built kd-trees in')
+    parser.add_argument('--rejection', default='K_MEDIAN', choices=['K_MEDIAN', 'DISSIMILAR_NORMALS', 'NONE'])
+    parser.add_argument('--k', type=float, default=2.5, help='k factor of k*median rejection')
+    parser.add_argument('--normal-dissimilarity-thresh', type=float, default=0.5)
+    parser.add_argument('--weighting', default='NONE', choices=['NONE', 'NORMAL_SIMILARITY', 'DISTANCE', 'WELSCH'])
+    parser.add_argument('--nu', type=float, default=0.1, help='lower bound of nu of Welsch weighting')
+    parser.add_argument('--pyramid-levels', type=int, default=1)
+    parser.add_argument('--initial-alignment', default='NONE', choices=['NONE', 'PCA', 'PCA_FEATURES'],
+                        help='coarse alignment before iterating, kept only if it fits better than the initial pose')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help='processes answering kd-tree queries, all cores if omitted')
+    parser.add_argument('--processes', type=int,
+                        help='processes aligning several moving files in parallel, all cores if omitted')
+    parser.add_argument('--tiles', help='directory of the fixed file stored in tiles, matched without reading it '
+                                        'into memory. The tiles are built there from the fixed file if missing')
+    parser.add_argument('--tile-points', type=int, default=TILE_POINTS, help='average number of points per tile')
+    parser.add_argument('--memory-budget', type=float, default=1024,
+                        help='megabytes of the kd-trees of tiles kept in memory when matching against tiles. '
+                             'Coarse pyramid levels are held in memory besides, with at most about a million points '
+                             'each')
+    return parser.parse_args(argv)
+
+def read_initial(path) -> np.ndarray:
+    path = pathlib.Path(path)
+    if path.suffix.lower() == '.npy':
+        matrix = np.load(path)
+    else:
+        with open(path, 'r') as fp:
+            matrix = np.array(json.load(fp), dtype=np.float64)
+    if matrix.shape != (4, 4):
+        raise ValueError(f'Expected a 4x4 transform in {path}, got {matrix.shape}')
+    return matrix
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    engine = ICPEngine(max_iterations=args.max_iterations, eps=args.eps, max_points=args.max_points, k=args.k,
+                       nu=args.nu, normal_dissimilarity_thresh=args.normal_dissimilarity_thresh,
+                       point_to_plane=args.point_to_plane, sampling_strategy=args.sampling,
+                       distance_strategy=args.matching, normal_weight=args.normal_weight,
+                       rejection_criterion=args.rejection, weighting_strategy=args.weighting,
+                       matching_index=args.index, approx_eps=args.approx_eps, approx_schedule=args.approx_schedule,
+                       kdtree_cache_dir=args.kdtree_cache_dir, seed=args.seed, pyramid_levels=args.pyramid_levels,
+                       initial_alignment=args.initial_alignment, workers=args.workers, verbose=False)
+
+    initial = read_initial(args.initial) if args.initial else np.eye(4)
+    moving = [(*read_points(path), initial) for path in args.moving]
+
+    t_start = time.perf_counter()
+    n_queries = min(engine.max_points, max(len(points) for points, _, _ in moving))
+    if args.tiles:
+        if not is_tiled(args.tiles):
+            build_tiles_from_file(args.fixed, args.tiles, args.tile_points)
+        fixed_levels = engine.prepare_fixed_tiled(args.tiles, n_queries, int(args.memory_budget * (1 << 20)))
+    else:
+        fixed_levels = engine.prepare_fixed(*read_points(args.fixed), n_queries)
+    n_fixed = len(fixed_levels[-1][0])
+    build_seconds = time.perf_counter() - t_start
+
+    try:
+        results = register_batch(engine, moving, fixed_levels, args.processes)
+    finally:
+        close_levels(fixed_levels)
+
+    output = {
+        'fixed': str(args.fixed),
+        'fixed_points': n_fixed,
+        'build_seconds': build_seconds,
+        'results': [{'moving': str(path), 'moving_points': len(points), 'matrix': result.matrix.tolist(),
+                     'converged': bool(result.converged), 'iterations': result.iterations,
+                     'seconds': result.seconds, 'stats': result.stats}
+                    for path, (points, _, _), result in zip(args.moving, moving, results)],
+    }
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(output, fp, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+
+    return 0 if all(result.converged for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,725 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.linalg import solve, svd, det
+
+try:
+    from .kd_tree import KDTree, _WorkerFunction, _attach, _share, _spawn_context
+    from .kdtree_cache import KDTreeCache
+    from .nn_index import AdaptiveIndex, BruteForceIndex
+    from .prealignment import prealign
+    from .tiled_index import TiledIndex
+    from .voxel_grid import VoxelGridIndex, voxel_downsample
+except ImportError:
+    from kd_tree import KDTree, _WorkerFunction, _attach, _share, _spawn_context
+    from kdtree_cache import KDTreeCache
+    from nn_index import AdaptiveIndex, BruteForceIndex
+    from prealignment import prealign
+    from tiled_index import TiledIndex
+    from voxel_grid import VoxelGridIndex, voxel_downsample
+
+# fewest points sampled per iteration at the coarse levels of the resolution pyramid
+MIN_PYRAMID_SAMPLES = 64
+
+# normal space sampling bins normals on an octahedral grid of this many cells per side
+NORMAL_SPACE_RESOLUTION = 8
+
+# most points in memory of the finest coarse level of a fixed object stored in tiles, the coarser ones keep fewer by
+# the pyramid ratio
+TILED_COARSE_POINTS = 1 << 20
+
+def transform_matrix(r: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """
+    4x4 matrix of the rigid transformation that rotates by r and then translates by t
+    """
+    matrix = np.eye(4)
+    matrix[:3, :3] = r
+    matrix[:3, 3] = t
+    return matrix
+
+def octahedral_bins(normals: np.ndarray, resolution: int) -> np.ndarray:
+    """
+    Quantize unit normals on an octahedral grid: the sphere is projected onto the octahedron |x| + |y| + |z| = 1,
+    whose lower half is folded over the upper one, and the resulting unit square is split into resolution ** 2 cells
+    :return: (N,) cell index of each normal
+    """
+    octahedron = normals / np.maximum(np.abs(normals).sum(axis=1), 1e-12)[:, None]
+    u, v, w = octahedron.T
+
+    # fold the lower hemisphere over the diagonals
+    lower = w < 0
+    sign_u = np.where(u >= 0, 1.0, -1.0)
+    sign_v = np.where(v >= 0, 1.0, -1.0)
+    u, v = (np.where(lower, (1 - np.abs(v)) * sign_u, u), np.where(lower, (1 - np.abs(u)) * sign_v, v))
+
+    cells = np.clip(((np.column_stack((u, v)) + 1) / 2 * resolution).astype(np.int64), 0, resolution - 1)
+    return cells[:, 0] * resolution + cells[:, 1]
+
+class PointPairs:
+    """
+    Corresponding points of the moving and fixed objects, as structure of arrays: row i of each array belongs to
+    pair i. Indexing with a mask or index array selects a subset of the pairs.
+    """
+
+    def __init__(self, ps: np.ndarray, qs: np.ndarray, q_normals: np.ndarray, p_normals: np.ndarray,
+                 distances: np.ndarray):
+        self.ps = ps
+        self.qs = qs
+        self.q_normals = q_normals
+        self.p_normals = p_normals
+        self.distances = distances
+
+    def __len__(self):
+        return len(self.ps)
+
+    def __getitem__(self, rows) -> 'PointPairs':
+        return PointPairs(self.ps[rows], self.qs[rows], self.q_normals[rows], self.p_normals[rows],
+                          self.distances[rows])
+
+class RegistrationResult:
+    """
+    Outcome of registering one moving object onto the fixed object
+    """
+
+    def __init__(self, matrix: np.ndarray, converged: bool, iterations: int, seconds: float, stats: list[dict] = None):
+        """
+        :param matrix: final 4x4 world matrix of the moving object
+        :param converged: if the registration converged
+        :param iterations: number of iterations run
+        :param seconds: wall time of the registration
+        :param stats: statistics of each iteration, see ICPEngine.iteration_stats
+        """
+        self.matrix = matrix
+        self.converged = converged
+        self.iterations = iterations
+        self.seconds = seconds
+        self.stats = stats if stats is not None else []
+
+class ICPEngine:
+    """
+    Iterative closest point on numpy buffers, independent of blender: the moving object is given as local points and
+    normals with a world matrix, and the fixed object as the levels built by prepare_fixed
+    """
+
+    def __init__(self, max_iterations=100, eps=0.001, max_points=1000, k=2.5, nu=0.1, normal_dissimilarity_thresh=0.5,
+                 point_to_plane=False, sampling_strategy="RANDOM_POINT", distance_strategy="EUCLIDEAN",
+                 normal_weight=0.05, rejection_criterion="K_MEDIAN", weighting_strategy="NONE",
+                 matching_index="KD_TREE", approx_eps=0.0, approx_schedule=False, kdtree_cache_dir=None,
+                 kdtree_cache_bytes=1 << 30, seed=None, pyramid_levels=1, pyramid_ratio=4,
+                 normal_space_resolution=NORMAL_SPACE_RESOLUTION, initial_alignment="NONE", workers=None,
+                 verbose=True):
+
+        # constructor arguments, to create equal engines in the worker processes of batch registration
+        self.options = {name: value for name, value in locals().items() if name != 'self'}
+
+        self.max_iterations = max_iterations
+        self.eps = eps
+        self.max_points = max_points
+        self.k = k
+        self.nu = None
+        self.min_nu = nu
+        self.normal_dissimilarity_thresh = normal_dissimilarity_thresh
+        self.point_to_plane = point_to_plane
+        self.sampling_strategy = sampling_strategy
+        self.normal_space_resolution = normal_space_resolution
+        self.distance_strategy = distance_strategy
+        self.normal_weight = normal_weight
+        self.rejection_criterion = rejection_criterion
+        self.weighting_strategy = weighting_strategy
+        self.matching_index = matching_index
+        self.approx_eps = approx_eps
+        self.approx_schedule = approx_schedule
+        self.initial_alignment = initial_alignment
+        self.max_distance = -1
+        self.num_rejected = []
+
+        # statistics of each iteration of the last registration: pyramid level, number of sampled and rejected
+        # points, root mean square distance of the kept pairs, norm of the translation and angle of the rotation of
+        # the update, and seconds since the start
+        self.iteration_stats = []
+
+        # processes used to build kd-trees and answer their queries
+        self.workers = workers or os.cpu_count()
+
+        # print progress to the console
+        self.verbose = verbose
+
+        # coarse-to-fine matching: each level has pyramid_ratio times more points than the previous one
+        self.pyramid_levels = max(int(pyramid_levels), 1)
+        self.pyramid_ratio = pyramid_ratio
+
+        # random generator of point sampling, so that runs with the same seed give identical results
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        # on-disk cache of the fixed object's kd-tree, keyed by its worldspace vertices
+        self.kdtree_cache = KDTreeCache(kdtree_cache_dir, kdtree_cache_bytes) if kdtree_cache_dir else None
+
+    def register(self, local_points: np.ndarray, local_normals: np.ndarray, fixed_levels: list[tuple],
+                 p_matrix: np.ndarray = None, callback=None) -> (bool, int, np.ndarray):
+        """
+        Perform iterative closest point of a moving object onto a fixed one
+        :param local_points: (N, 3) local points of the moving object
+        :param local_normals: (N, 3) local normals of the moving object
+        :param fixed_levels: levels of the fixed object, built by prepare_fixed
+        :param p_matrix: initial 4x4 world matrix of the moving object, identity if None
+        :param callback: called with the iteration number and the current world matrix at the start of each iteration
+        :return: if algorithm converged, in how many iterations, and the final 4x4 world matrix of the moving object
+        """
+
+        # keep track of convergence
+        converged = False
+        num_iterations_so_far = 0
+        self.nu = None
+        self.max_distance = -1
+        self.num_rejected = []
+        self.iteration_stats = []
+        t_start = time.perf_counter()
+
+        # the local points and normals don't change while the object moves, so the iterations only compose its world
+        # matrix, and transform the sampled points with it
+        n_queries = min(self.max_points, len(local_points))
+        p_world_matrix = np.eye(4) if p_matrix is None else np.array(p_matrix, dtype=np.float64)
+        if self.initial_alignment != "NONE":
+            p_world_matrix = self.prealign(local_points, fixed_levels, p_world_matrix)
+
+        # vertices of object P that are sampled from at each level, and their normal space buckets
+        moving_levels = self.pyramid_subsets(local_points)
+        moving_buckets = [None] * len(moving_levels)
+        if self.sampling_strategy in {"NORMAL", "STRATIFIED_NORMAL"}:
+            moving_buckets = [self.normal_space_buckets(local_normals[subset]) for subset in moving_levels]
+
+        # start matching at the coarsest level
+        level = 0
+        finest_level = self.pyramid_levels - 1
+        q_points, q_normals, normal_scale, qs_index = fixed_levels[level]
+
+        # Initial values for the rotation and translation of the previous iteration
+        # these are updated during iterations to be used in case the weighting strategy needs it
+        prev_R = np.eye(3)
+        prev_t = np.zeros((3,))
+
+        # approximation factor of nearest neighbor queries, and translation norm of the first iteration
+        match_eps = self.approx_eps
+        first_trans_norm = None
+
+        # Main ICP iteration loop
+        for num_iterations_so_far in range(self.max_iterations):
+
+            if callback is not None:
+                callback(num_iterations_so_far, p_world_matrix)
+
+            # sample points in P, and transform only the samples into world space
+            samples = moving_levels[level][self.sample_indices(len(moving_levels[level]),
+                                                               self.level_samples(level, n_queries),
+                                                               moving_buckets[level])]
+            p_points = local_points[samples] @ p_world_matrix[:3, :3].T + p_world_matrix[:3, 3]
+            p_normals = local_normals[samples] @ np.linalg.inv(p_world_matrix[:3, :3])
+            p_normals /= np.maximum(np.linalg.norm(p_normals, axis=1), 1e-12)[:, None]
+            n_samples = len(p_points)
+            if self.verbose and num_iterations_so_far == 0:
+                print(f'num points: {n_samples}')
+                if isinstance(qs_index, AdaptiveIndex):
+                    print(f'matching index: {qs_index.backend}')
+
+            # for each sampled point, get the closest point in q and its distance, all in one batched query
+            query_points = p_points
+            if self.distance_strategy == "NORMAL_WEIGHTED":
+                query_points = np.hstack((p_points, normal_scale * p_normals))
+
+            # kd-tree queries are answered on all cores for large sample counts, tiles of fixed objects on disk are not
+            query_kwargs = {'workers': self.workers, 'morton': True} if isinstance(qs_index, KDTree) else {}
+            q_indices, _ = qs_index.query_batch(query_points, eps=match_eps, **query_kwargs)
+
+            # point pairs, as structure of arrays
+            pairs = PointPairs(p_points, q_points[q_indices], q_normals[q_indices], p_normals,
+                               np.linalg.norm(p_points - q_points[q_indices], axis=1))
+            self.max_distance = max(self.max_distance, pairs.distances.max())
+
+            if self.weighting_strategy == "WELSCH" and self.nu is None:
+                # Set initial nu value for Welsch function weighting
+                self.nu = 3 * np.partition(pairs.distances, n_samples // 2)[n_samples // 2]
+
+            if self.rejection_criterion == "K_MEDIAN":
+                # compute median distance, for filtering outliers, without sorting all distances
+                median_distance = np.partition(pairs.distances, n_samples // 2)[n_samples // 2]
+
+                # filter outlier point-pairs that don't satisfy the k*median condition. Coarse levels match to sparse
+                # points, whose distances vary more, so k is relaxed by a factor 2 per level above the finest one
+                k = self.k * 2 ** (finest_level - level)
+                pairs = pairs[pairs.distances <= k * median_distance]
+
+            elif self.rejection_criterion == "DISSIMILAR_NORMALS":
+                normal_dots = np.einsum('ij,ij->i', pairs.q_normals, pairs.p_normals)
+                pairs = pairs[normal_dots >= self.normal_dissimilarity_thresh]
+
+            num_points_rejected = n_samples - len(pairs)
+            self.num_rejected.append(num_points_rejected)
+            if self.verbose and num_iterations_so_far == 0:
+                print(f'num_points_rejected: {num_points_rejected}')
+                print(f'num points after rejection: {len(pairs)}')
+
+            # compute optimal rigid transformation.
+            if self.point_to_plane:
+                r_opt, t_opt = self.opt_rigid_transformation_point_to_plane(pairs, prev_R=prev_R, prev_t=prev_t)
+            else:
+                r_opt, t_opt = self.opt_rigid_transformation_point_to_point(pairs, prev_R=prev_R, prev_t=prev_t)
+
+            trans_norm = np.linalg.norm(t_opt)
+            self.iteration_stats.append({
+                'level': level, 'samples': n_samples, 'rejected': num_points_rejected,
+                'rms_distance': float(np.sqrt(np.mean(pairs.distances ** 2))) if len(pairs) else None,
+                'translation': float(trans_norm),
+                'rotation': float(np.arccos(np.clip((np.trace(r_opt) - 1) / 2, -1.0, 1.0))),
+                'seconds': time.perf_counter() - t_start,
+            })
+
+            # check if converged, if so stop. Coarse levels can only align up to their point spacing, so they move on to
+            # the next level once the update falls below a threshold that grows with the coarseness of the level
+            level_eps = self.eps * self.pyramid_ratio ** (finest_level - level)
+            if trans_norm <= level_eps and np.allclose(r_opt, np.eye(3), atol=level_eps):
+                if level == finest_level:
+                    converged = True
+                    break
+
+                level += 1
+                q_points, q_normals, normal_scale, qs_index = fixed_levels[level]
+                if self.verbose:
+                    print(f'pyramid level {level} at iteration {num_iterations_so_far + 1}: '
+                          f'{len(q_points)} fixed points')
+
+            # Update the previous rotation and translation
+            prev_R = r_opt
+            prev_t = t_opt
+
+            # tighten approximate matching as the translation norm approaches eps
+            if self.approx_schedule:
+                if first_trans_norm is None:
+                    first_trans_norm = trans_norm
+                match_eps = self.scheduled_approx_eps(trans_norm, first_trans_norm)
+
+            # compose the optimal transformation into the world matrix of the object
+            p_world_matrix = transform_matrix(r_opt, t_opt) @ p_world_matrix
+
+        return converged, num_iterations_so_far + 1, p_world_matrix
+
+    def prealign(self, local_points: np.ndarray, fixed_levels: list[tuple], p_matrix: np.ndarray) -> np.ndarray:
+        """
+        Move the moving object close to the fixed one before iterating, according to the initial alignment option:
+        PCA aligns the principal axes of both objects, PCA_FEATURES also tries matches of local shape features. The
+        current pose is kept if no candidate fits better
+        :return: the new 4x4 world matrix of the moving object
+        """
+        if self.initial_alignment not in {"PCA", "PCA_FEATURES"}:
+            raise RuntimeError("Invalid initial alignment")
+
+        t_start = time.perf_counter()
+        p_points = local_points @ p_matrix[:3, :3].T + p_matrix[:3, 3]
+        matrix = prealign(p_points, fixed_levels[0][0], features=self.initial_alignment == "PCA_FEATURES",
+                          rng=self.rng) @ p_matrix
+        if self.verbose:
+            print(f'initial alignment: {(time.perf_counter() - t_start) * 1000:.1f} ms')
+        return matrix
+
+    def scheduled_approx_eps(self, trans_norm: float, first_trans_norm: float) -> float:
+        """
+        Approximation factor for the next matching step: approx_eps at the first iteration, decreasing linearly to
+        exact search as the translation norm of the last iteration approaches the convergence threshold eps
+        """
+        if first_trans_norm <= self.eps:
+            return 0.0
+
+        progress = (trans_norm - self.eps) / (first_trans_norm - self.eps)
+        return self.approx_eps * float(np.clip(progress, 0.0, 1.0))
+
+    def level_samples(self, level: int, n_queries: int) -> int:
+        """
+        Number of points sampled per iteration at a level of the resolution pyramid: n_queries at the finest level,
+        and pyramid_ratio times less at each coarser one
+        """
+        n = n_queries // self.pyramid_ratio ** (self.pyramid_levels - 1 - level)
+        return max(n, min(MIN_PYRAMID_SAMPLES, n_queries))
+
+    def pyramid_subsets(self, points: np.ndarray) -> list[np.ndarray]:
+        """
+        Vertices of each level of the resolution pyramid, coarsest first: level i keeps about one in
+        pyramid_ratio ** (levels - 1 - i) vertices, spread uniformly over the object, and the finest level keeps all
+        :return: sorted vertex indices per level
+        """
+        return [voxel_downsample(points, self.pyramid_ratio ** (self.pyramid_levels - 1 - level))
+                for level in range(self.pyramid_levels)]
+
+    def prepare_fixed(self, points: np.ndarray, normals: np.ndarray, n_queries: int) -> list[tuple]:
+        """
+        Build the matching index of each level of the resolution pyramid of the fixed object
+        :param points: (N, 3) world space points of the fixed object
+        :param normals: (N, 3) unit world space normals of the fixed object
+        :param n_queries: number of points sampled per iteration at the finest level
+        :return: per level, coarsest first: (N, 3) points, (N, 3) normals, scale of the normals in matched points, and
+        the matching index
+        """
+        # normal weighted matching searches (position, scaled normal) points, whose euclidean distance grows with
+        # both the distance between points and the angle between their normals
+        normal_scale = 0.0
+        if self.distance_strategy == "NORMAL_WEIGHTED":
+            normal_scale = self.normal_weight * np.linalg.norm(np.ptp(points, axis=0))
+
+        levels = []
+        for level, subset in enumerate(self.pyramid_subsets(points)):
+            q_points, q_normals = points[subset], normals[subset]
+            index_points = q_points
+            if self.distance_strategy == "NORMAL_WEIGHTED":
+                index_points = np.hstack((q_points, normal_scale * q_normals))
+
+            index = self.build_matching_index(index_points, self.level_samples(level, n_queries))
+            levels.append((q_points, q_normals, normal_scale, index))
+        return levels
+
+    def prepare_fixed_tiled(self, directory, n_queries: int, memory_budget=1 << 30) -> list[tuple]:
+        """
+        Prepare the levels of a fixed object too large for memory, stored in tiles by tiled_index.build_tiles. The
+        finest level matches against the memory-mapped tiles, keeping the kd-trees of at most memory_budget bytes of
+        tiles in memory. Coarser levels keep one in pyramid_ratio ** (levels - 1 - i) of the stored points, but at most
+        TILED_COARSE_POINTS, read with a stride and indexed in memory like those of prepare_fixed. They are not
+        counted against memory_budget
+        :param directory: directory of the tiles
+        :param n_queries: number of points sampled per iteration at the finest level
+        :param memory_budget: maximum size of the kd-trees of the tiles in memory, in bytes
+        :return: levels like those of prepare_fixed
+        """
+        if self.distance_strategy == "NORMAL_WEIGHTED":
+            raise RuntimeError("Normal weighted matching is not supported for tiled fixed objects")
+
+        index = TiledIndex(directory, memory_budget)
+        levels = []
+        coarse_stride = max(self.pyramid_ratio, -(-len(index.points) // TILED_COARSE_POINTS))
+        for level in range(self.pyramid_levels - 1):
+            stride = coarse_stride * self.pyramid_ratio ** (self.pyramid_levels - 2 - level)
+            q_points = np.asarray(index.points[::stride], dtype=np.float64)
+            q_normals = np.asarray(index.normals[::stride], dtype=np.float64)
+            levels.append((q_points, q_normals, 0.0, self.build_matching_index(q_points,
+                                                                              self.level_samples(level, n_queries))))
+        levels.append((index.points, index.normals, 0.0, index))
+        return levels
+
+    def build_matching_index(self, points: np.ndarray, n_queries: int):
+        """
+        Build the spatial index used to find closest points, according to the matching index option. Voxel grids are
+        only built for 3d points: the rings of cells they search grow with the power of the dimension, so the 6d points
+        of normal weighted matching are indexed with a kd-tree instead
+        :param n_queries: number of points sampled per iteration, used to choose an index if the option is AUTO
+        """
+        dim = points.shape[1]
+        if self.matching_index == "KD_TREE" or (self.matching_index == "VOXEL_GRID" and dim > 3):
+            return self._build_kd_tree(points)
+        elif self.matching_index == "VOXEL_GRID":
+            return VoxelGridIndex(points, dim=dim)
+        elif self.matching_index == "AUTO":
+            return AdaptiveIndex(points, n_queries, n_batches=self.max_iterations, dim=dim, workers=self.workers,
+                                 build_kd_tree=self._build_kd_tree)
+        else:
+            raise RuntimeError("Invalid matching index")
+
+    def _build_kd_tree(self, points: np.ndarray) -> KDTree:
+        if self.kdtree_cache is not None:
+            return self.kdtree_cache.get_or_build(points, workers=self.workers)
+        return KDTree(points, dim=points.shape[1], workers=self.workers)
+
+    def pair_weights(self, pairs: 'PointPairs', prev_R=None, prev_t=None) -> np.ndarray:
+        """
+        Weights of all point pairs according to the weighting strategy. Welsch weighting needs the previous rotation
+        and translation, and anneals nu once per call
+        :return: (N,) weights
+        """
+        if self.weighting_strategy == "NORMAL_SIMILARITY":
+            return np.einsum('ij,ij->i', pairs.q_normals, pairs.p_normals)
+        elif self.weighting_strategy == "DISTANCE":
+            return 1.0 - pairs.distances / self.max_distance  # Based on Godin, 1994
+        elif self.weighting_strategy == "WELSCH":
+            welsch_norms = np.linalg.norm(pairs.ps @ prev_R.T + prev_t - pairs.qs, axis=1)
+            weights = np.exp(-welsch_norms / (2 * self.nu ** 2))
+            self.nu = max(self.nu / 2, self.min_nu)
+            return weights
+        return np.ones(len(pairs))
+
+    def opt_rigid_transformation_point_to_point(self, pairs: 'PointPairs', prev_R=None, prev_t=None):
+        """
+        Compute the optimal rigid transformation between pairs of points
+
+        :param pairs: point pairs (p_i, q_i)
+        :param prev_R: the previous rotation matrix. Pass it if it is needed by the weighting strategy
+        :param prev_t: the previous translation vector. Pass it if is need by the weighting strategy.
+        :return: translation vector and rotation matrix for optimal rigid transformation from
+        points p_i to q_i
+        """
+
+        # compute centroids
+        centroid_p = pairs.ps.mean(axis=0)
+        centroid_q = pairs.qs.mean(axis=0)
+
+        # compute weighted covariance matrix, as one matrix product over all pairs
+        weights = self.pair_weights(pairs, prev_R, prev_t)
+        covariance_matrix = ((pairs.ps - centroid_p) * weights[:, None]).T @ (pairs.qs - centroid_q)
+        covariance_matrix /= weights.sum()
+
+        # singular value decomposition
+        U, _, Vt, = np.linalg.svd(covariance_matrix, full_matrices=False)
+        V = Vt.transpose()
+        Ut = U.transpose()
+
+        # compute optimal rotation and translation
+        m = np.eye(3)
+        m[2, 2] = np.linalg.det((V @ Ut))
+        r_opt = V @ m @ Ut
+        t_opt = centroid_q - r_opt @ centroid_p
+
+        return r_opt, t_opt
+
+    def opt_rigid_transformation_point_to_plane(self, pairs: 'PointPairs', prev_R=None, prev_t=None):
+        """
+        Compute the rigid transformation minimizing the (weighted) distances of points p_i to the tangent planes at q_i,
+        linearized for small rotations
+
+        :param pairs: point pairs (p_i, q_i) with the normals of q_i
+        :param prev_R: the previous rotation matrix. Pass it if it is needed by the weighting strategy
+        :param prev_t: the previous translation vector. Pass it if is need by the weighting strategy.
+        """
+        # (N, 6) jacobian rows: cross product of p and nq, concatenated with nq
+        J = np.hstack((np.cross(pairs.ps, pairs.q_normals), pairs.q_normals))
+        # (N,) point to plane residuals
+        r = np.einsum('ij,ij->i', pairs.ps - pairs.qs, pairs.q_normals)
+
+        # normal equations, A = J^T W J and b = J^T W r
+        weights = self.pair_weights(pairs, prev_R, prev_t)
+        weighted_J = J * weights[:, None]
+        A = weighted_J.T @ J
+        b = weighted_J.T @ r
+
+        # solve system that minimizes r, t: A (r t) + b = 0
+        rt_vec = solve(A, -b)
+
+        r1, r2, r3 = rt_vec[0], rt_vec[1], rt_vec[2]
+        t_opt = rt_vec[3:]
+
+        # compute approximation of rotation matrix R.
+        R = np.eye(3)
+        R[0, 1] = -r3  # first row, second column.
+        R[0, 2] = r2
+        R[1, 0] = r3
+        R[1, 2] = -r1
+        R[2, 0] = -r2
+        R[2, 1] = r1
+
+        # perform singular value decomposition.
+        U, _, Vt = svd(R, full_matrices=False)
+        D = np.eye(3)
+        D[2, 2] = det((U @ Vt))
+
+        # compute optimal rotation matrix.
+        r_opt = U @ D @ Vt
+
+        return r_opt, t_opt
+
+    def sample_indices(self, n_points: int, n_samples: int = None,
+                       buckets: (np.ndarray, np.ndarray) = None) -> np.ndarray:
+        """
+        Sample points to match, according to the sampling strategy
+        :param n_points: number of points to sample from
+        :param n_samples: number of points to sample, max_points if None
+        :param buckets: normal space buckets of the points, built once per object by normal_space_buckets. Required by
+        the normal space sampling strategies
+        :return: indices of the sampled points
+        """
+        n_samples = min(n_points - 1, self.max_points if n_samples is None else n_samples)
+
+        if self.sampling_strategy == "RANDOM_POINT":
+            # Sample n random points in mesh P
+            samples = self.rng.choice(n_points, n_samples, replace=False)
+        elif self.sampling_strategy in {"NORMAL", "STRATIFIED_NORMAL"}:
+            bucket_ptr, bucket_points = buckets
+            bucket_size = np.diff(bucket_ptr)
+
+            if self.sampling_strategy == "NORMAL":
+                # Draw buckets uniformly at random, so that samples are uniformly distributed over the normal space
+                counts = self.rng.multinomial(n_samples, np.full(len(bucket_size), 1 / len(bucket_size)))
+                counts = np.minimum(counts, bucket_size)
+            else:
+                # Sample every stratum equally, small buckets give all their points and the rest is spread evenly
+                counts = self._stratified_counts(n_samples, bucket_size)
+            samples = self._sample_from_buckets(counts, bucket_ptr, bucket_points)
+        else:
+            raise RuntimeError("Invalid point sampling strategy")
+
+        return samples
+
+    def normal_space_buckets(self, normals: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Group vertices by their quantized normal, so we can sample normals uniformly. Normals are binned on an
+        octahedral grid of the sphere, whose cells cover comparable solid angles, unlike latitude-longitude bins that
+        shrink towards the poles.
+        Buckets are stored compressed like CSR matrix rows: the vertices of bucket i are
+        bucket_points[bucket_ptr[i]:bucket_ptr[i + 1]], in random order. Only non-empty buckets are stored
+        :return: bucket pointers, and vertex indices sorted by bucket
+        """
+        bins = octahedral_bins(normals, self.normal_space_resolution)
+
+        # shuffle the vertices within each bucket, so that any slice of a bucket is a random subset of it
+        bucket_points = np.lexsort((self.rng.random(len(bins)), bins))
+        bin_size = np.bincount(bins, minlength=self.normal_space_resolution ** 2)
+        bucket_ptr = np.concatenate(([0], np.cumsum(bin_size[bin_size > 0])))
+        return bucket_ptr, bucket_points
+
+    def _stratified_counts(self, n_samples: int, bucket_size: np.ndarray) -> np.ndarray:
+        """
+        Number of samples per bucket that spreads n_samples as evenly as possible over the buckets, without taking
+        more samples from a bucket than it has points
+        """
+        if n_samples >= bucket_size.sum():
+            return bucket_size.copy()
+
+        # find the level L with sum(min(size, L)) = n_samples: the first bucket in ascending size order that can't
+        # be filled completely fixes it
+        n_buckets = len(bucket_size)
+        sorted_size = np.sort(bucket_size)
+        filled = np.concatenate(([0], np.cumsum(sorted_size)[:-1]))
+        capacity = filled + sorted_size * (n_buckets - np.arange(n_buckets))
+        i = np.searchsorted(capacity, n_samples)
+        level = (n_samples - filled[i]) // (n_buckets - i)
+
+        # distribute what is left over the larger buckets at random
+        counts = np.minimum(bucket_size, level)
+        remainder = n_samples - counts.sum()
+        counts[self.rng.choice(np.flatnonzero(bucket_size > level), remainder, replace=False)] += 1
+        return counts
+
+    def _sample_from_buckets(self, counts: np.ndarray, bucket_ptr: np.ndarray, bucket_points: np.ndarray) -> np.ndarray:
+        """
+        Pick counts[i] distinct random vertices from each bucket i, with one random draw per bucket: evenly spaced
+        slots of the bucket with a random phase
+        """
+        bucket_size = np.diff(bucket_ptr)
+        total = counts.sum()
+        owners = np.repeat(np.arange(len(counts)), counts)
+        ranks = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        phase = self.rng.random(len(counts))
+        offsets = ((phase[owners] + ranks) * bucket_size[owners] / counts[owners]).astype(np.int64)
+        return bucket_points[bucket_ptr[owners] + offsets]
+
+def close_levels(fixed_levels: list[tuple]):
+    """
+    Stop the worker processes of parallel queries of the levels' indices, if any were started
+    """
+    for *_, index in fixed_levels:
+        if isinstance(index, (KDTree, AdaptiveIndex, TiledIndex)):
+            index.close()
+
+# index classes that can be rebuilt from their flat arrays in worker processes
+_INDEX_CLASSES = {'KD_TREE': KDTree, 'VOXEL_GRID': VoxelGridIndex, 'BRUTE_FORCE': BruteForceIndex}
+
+def _index_state(index) -> (str, tuple, dict[str, np.ndarray]):
+    """
+    Kind, constructor parameters and flat arrays of a built matching index, to rebuild it in another process
+    """
+    if isinstance(index, AdaptiveIndex):
+        index = index.index
+
+    if isinstance(index, KDTree):
+        return 'KD_TREE', (index.dim, index.leaf_size), {name: getattr(index, name) for name in index._ARRAYS}
+    elif isinstance(index, VoxelGridIndex):
+        return 'VOXEL_GRID', (index.dim, index.cell_size), {name: getattr(index, name) for name in index._ARRAYS}
+    elif isinstance(index, BruteForceIndex):
+        return 'BRUTE_FORCE', (index.dim, index.max_bytes), {name: getattr(index, name) for name in index._ARRAYS}
+    raise RuntimeError("Matching index can't be shared with worker processes")
+
+def register_batch(engine: ICPEngine, moving: list[tuple], fixed_levels: list[tuple],
+                   processes: int = None) -> list[RegistrationResult]:
+    """
+    Register many moving objects onto one fixed object, in parallel worker processes. The fixed object's levels and
+    matching indices are built once, and shared with the workers through shared memory, as are the moving points.
+    Each object is sampled with its own random generator, derived from the engine's seed, so results don't depend on
+    the number of processes
+    :param engine: engine whose options are used by the workers
+    :param moving: (N, 3) local points, (N, 3) local normals and 4x4 world matrix of each moving object
+    :param fixed_levels: levels of the fixed object, built by engine.prepare_fixed
+    :param processes: number of worker processes, all cores if None. With one process, the objects are registered
+    one after the other in this process
+    :return: result of each moving object, in order
+    """
+    processes = min(processes or os.cpu_count(), len(moving))
+    if any(isinstance(index, TiledIndex) for *_, index in fixed_levels):
+        # tiles are paged in per process, each worker would need its own memory budget
+        processes = 1
+    seeds = np.random.SeedSequence(engine.seed).spawn(len(moving))
+
+    if processes <= 1:
+        # the engine's own generator is restored afterwards, so that later registrations are unaffected
+        rng = engine.rng
+        results = []
+        try:
+            for (points, normals, matrix), seed in zip(moving, seeds):
+                engine.rng = np.random.default_rng(seed)
+                t_start = time.perf_counter()
+                converged, iterations, matrix = engine.register(points, normals, fixed_levels, matrix)
+                results.append(RegistrationResult(matrix, converged, iterations, time.perf_counter() - t_start,
+                                                  engine.iteration_stats))
+        finally:
+            engine.rng = rng
+        return results
+
+    # one shared memory block per array: the moving objects' points concatenated, and the fixed levels
+    arrays = {'points': np.concatenate([points for points, _, _ in moving]),
+              'normals': np.concatenate([normals for _, normals, _ in moving])}
+    bounds = np.cumsum([0] + [len(points) for points, _, _ in moving])
+    level_meta = []
+    for level, (q_points, q_normals, normal_scale, index) in enumerate(fixed_levels):
+        kind, params, index_arrays = _index_state(index)
+        arrays[f'{level}/points'] = q_points
+        arrays[f'{level}/normals'] = q_normals
+        arrays.update({f'{level}/index/{name}': array for name, array in index_arrays.items()})
+        level_meta.append((normal_scale, kind, params))
+    blocks, specs = _share(arrays)
+
+    # workers build no indices and answer queries on their own core
+    options = dict(engine.options, workers=1, kdtree_cache_dir=None)
+
+    try:
+        with ProcessPoolExecutor(max_workers=processes, mp_context=_spawn_context(),
+                                 initializer=_WorkerFunction('icp_engine', '_init_batch_worker'),
+                                 initargs=(specs, level_meta, options)) as pool:
+            futures = [pool.submit(_WorkerFunction('icp_engine', '_register_one'), lo, hi,
+                                   np.array(matrix, dtype=np.float64), seed)
+                       for (_, _, matrix), lo, hi, seed in zip(moving, bounds[:-1], bounds[1:], seeds)]
+            return [RegistrationResult(*future.result()) for future in futures]
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+# engine, moving points and fixed levels of a worker process, attached to the shared memory of the parent process
+_worker_engine = None
+_worker_arrays = None
+_worker_levels = None
+_worker_blocks = []
+
+def _init_batch_worker(specs: dict, level_meta: list[tuple], options: dict):
+    global _worker_engine, _worker_arrays, _worker_levels, _worker_blocks
+    _worker_blocks, _worker_arrays = _attach(specs)
+    _worker_engine = ICPEngine(**options)
+
+    _worker_levels = []
+    for level, (normal_scale, kind, params) in enumerate(level_meta):
+        prefix = f'{level}/index/'
+        index_arrays = {name[len(prefix):]: array for name, array in _worker_arrays.items() if name.startswith(prefix)}
+        index = _INDEX_CLASSES[kind]._from_arrays(index_arrays, *params)
+        _worker_levels.append((_worker_arrays[f'{level}/points'], _worker_arrays[f'{level}/normals'], normal_scale,
+                               index))
+
+def _register_one(lo: int, hi: int, matrix: np.ndarray, seed: np.random.SeedSequence) -> tuple:
+    _worker_engine.rng = np.random.default_rng(seed)
+    t_start = time.perf_counter()
+    converged, iterations, matrix = _worker_engine.register(_worker_arrays['points'][lo:hi],
+                                                            _worker_arrays['normals'][lo:hi], _worker_levels, matrix)
+    return matrix, converged, iterations, time.perf_counter() - t_start, _worker_engine.iteration_stats
@@ -98,7 +98,7 @@ class EvaluationOperator(bpy.types.Operator):
             'collection': 'bunnies',
             "solvers": [{'name': matching_strat.lower().replace('_', ' '),
                          'solver': ICP(max_iterations=35, eps=0, max_points=max_points, rejection_criterion='NONE',
-                                       weighting_strategy=matching_strat)}
+                                       distance_strategy=matching_strat)}
                         for matching_strat in ['EUCLIDEAN', 'NORMAL_WEIGHTED']],
             "render_initial_state": True,
             "render_final_states": True,
@@ -124,9 +124,27 @@ class EvaluationOperator(bpy.types.Operator):
         normal_rejection_rabbits_hard['name'] = 'normal_rejection_rabbits_hard'
         normal_rejection_rabbits_hard['collection'] = 'rabbits_hard'
 
+        # iterations needed to converge from the initial pose, with and without pre-alignment
+        initial_alignment_rabbits_mid = {
+            'name': 'initial_alignment_rabbits_mid',
+            'collection': 'rabbits_mid',
+            "solvers": [{'name': alignment.lower().replace('_', ' '),
+                         'solver': ICP(max_iterations=max_iters, eps=eps, max_points=max_points,
+                                       initial_alignment=alignment)}
+                        for alignment in ['NONE', 'PCA', 'PCA_FEATURES']],
+            "render_initial_state": True,
+            "render_final_states": True,
+        }
+
+        initial_alignment_rabbits_hard = initial_alignment_rabbits_mid.copy()
+        initial_alignment_rabbits_hard['name'] = 'initial_alignment_rabbits_hard'
+        initial_alignment_rabbits_hard['collection'] = 'rabbits_hard'
+
         experiments = [
             normal_rejection_rabbits_mid,
-            normal_rejection_rabbits_hard
+            normal_rejection_rabbits_hard,
+            initial_alignment_rabbits_mid,
+            initial_alignment_rabbits_hard,
         ]
 
         for experiment in experiments:
@@ -185,14 +203,16 @@ class EvaluationOperator(bpy.types.Operator):
                 solver = entry['solver']
                 solver.evaluation_object = target
                 t.start()
-                solver.icp(moving, fixed)
+                converged, iterations = solver.icp(moving, fixed)
                 t.stop(entry['name'])
 
                 # save results of experiment
                 experiment_results[entry['name']] = {
                     'times': [t for (_, t) in solver.errors],
                     'errors': [err for (err, _) in solver.errors],
-                    'num_rejected': solver.num_rejected
+                    'num_rejected': solver.num_rejected,
+                    'iterations': iterations,
+                    'converged': bool(converged),
                 }
 
                 # render result after running ICP
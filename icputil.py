@@ -1,51 +1,47 @@
 import pathlib
-import random
 import time
 
-from mathutils import Vector
-from numpy.linalg import solve, svd, det
-
 from .bpyutil import *
-from .kd_tree import KDTree
+from .geometry_cache import GeometryCache
+from .icp_engine import ICPEngine, RegistrationResult, close_levels, register_batch
 
 def rmse(ob1, ob2) -> float:
-    verts_1 = np.array([np.array(ob1.matrix_world @ v.co) for v in ob1.data.vertices])
-    verts_2 = np.array([np.array(ob2.matrix_world @ v.co) for v in ob2.data.vertices])
+    verts_1 = world_vertex_positions(ob1)
+    verts_2 = world_vertex_positions(ob2)
 
     # assume that both objects are the same one
     assert len(verts_1) == len(verts_2)
 
     return np.sqrt(np.mean(np.linalg.norm(verts_1 - verts_2, axis=1) ** 2))
 
-class ICP:
-
-    def __init__(self, max_iterations=100, eps=0.001, max_points=1000, k=2.5, nu=0.1, normal_dissimilarity_thresh=0.5,
-                 point_to_plane=False, sampling_strategy="RANDOM_POINT", distance_strategy="EUCLIDEAN",
-                 rejection_criterion="K_MEDIAN", weighting_strategy="NONE", evaluation_object=None,
-                 evaluation_metric=rmse, animate=False, frames_folder=None):
-
-        self.max_iterations = max_iterations
-        self.eps = eps
-        self.max_points = max_points
-        self.k = k
-        self.nu = None
-        self.min_nu = nu
-        self.normal_dissimilarity_thresh = normal_dissimilarity_thresh
-        self.point_to_plane = point_to_plane
-        self.sampling_strategy = sampling_strategy
-        self.distance_strategy = distance_strategy
-        self.rejection_criterion = rejection_criterion
-        self.weighting_strategy = weighting_strategy
-        self.max_distance = -1
+class ICP(ICPEngine):
+    """
+    Iterative closest point on blender objects: reads their buffers, and writes the resulting world matrix back
+    """
+
+    def __init__(self, *args, geometry_cache: GeometryCache = None, evaluation_object=None, evaluation_metric=rmse,
+                 animate=False, animation_interval=1, frames_folder=None, **kwargs):
+        """
+        Takes the options of ICPEngine, and
+        :param geometry_cache: in-memory cache of the fixed object's worldspace buffers and matching index, shared
+        between runs
+        :param evaluation_object: object that the moving object should end up at, to record errors at each iteration
+        :param animate: render a frame every animation_interval iterations into frames_folder
+        """
+        super().__init__(*args, **kwargs)
+
+        # in-memory cache of the fixed object's worldspace buffers and matching index, shared between runs
+        self.geometry_cache = geometry_cache
 
         # used for evaluations
         self.evaluation_object = evaluation_object
         self.evaluation_metric = evaluation_metric
         self.errors = []
-        self.num_rejected = []
+        self._t_start = 0.0
 
         # use for animation at each iter
         self.animate = animate
+        self.animation_interval = max(int(animation_interval), 1)
         if frames_folder:
             self.frames_folder = pathlib.Path(frames_folder)
 
@@ -76,247 +72,113 @@ class ICP:
 
         # keep track of errors at each iteration, and time
         self.errors = []
-        t_start = time.perf_counter()
+        self._t_start = time.perf_counter()
 
         # initialize camera
         if self.animate:
             self.init_camera()
 
-        # keep track of convergence
-        converged = False
-        num_iterations_so_far = 0
-
-        # kd-tree of worldspace verts and normals of object Q, for optimizing nearest neighbor queries
-        q_world = obj_Q_fixed.matrix_world
-        qs = [(q_world @ q.co, q_world @ q.normal) for q in obj_Q_fixed.data.vertices]
-
-        distance_lambda = lambda p1, p2: (p1[0] - p2[0]).length
-        if self.distance_strategy == "NORMAL_WEIGHTED":
-            # Use cosine similarity to weigh the distance
-            distance_lambda = lambda p1, p2: np.dot(p1, p2) * (p1[0] - p2[0]).length
-
-        qs_kdtree = KDTree(qs, distance_lambda, lambda point, ax: point[0][ax])
-
-        # Initial values for the rotation and translation of the previous iteration
-        # these are updated during iterations to be used in case the weighting strategy needs it
-        prev_R = np.eye(3)
-        prev_t = np.zeros((3,))
-
-        # Main ICP iteration loop
-        for num_iterations_so_far in range(self.max_iterations):
-
-            # record error at iteration
-            if self.evaluation_object is not None:
-                err = self.evaluation_metric(obj_P_moving, self.evaluation_object)
-                t_iter = time.perf_counter()
-                self.errors.append((err, t_iter - t_start))
-
-            # render progress at iteration
-            if self.animate:
-                self.render_current(iter_num=num_iterations_so_far)
+        # worldspace verts of object Q, and their spatial index for optimizing nearest neighbor queries, per level of
+        # the resolution pyramid
+        n_queries = min(self.max_points, len(obj_P_moving.data.vertices))
+        fixed_levels, cached = self.fixed_object_levels(obj_Q_fixed, n_queries)
 
-            # sample verts in P
-            ps_samples = self.sample_points(obj_P_moving)
-            n_samples = len(ps_samples)
+        callback = None
+        if self.evaluation_object is not None or self.animate:
+            callback = lambda iteration, matrix: self.on_iteration(obj_P_moving, iteration, matrix)
 
-            if num_iterations_so_far == 0:
-                print(f'num points: {n_samples}')
+        try:
+            # snapshot of the local verts and normals of object P, the iterations only compose its world matrix
+            converged, iterations, matrix = self.register(vertex_positions(obj_P_moving.data),
+                                                          vertex_normals(obj_P_moving.data), fixed_levels,
+                                                          np.array(obj_P_moving.matrix_world), callback=callback)
+        finally:
+            # stop worker processes of parallel queries, if any were started. Cached indices keep them until evicted
+            if not cached:
+                close_levels(fixed_levels)
 
-            # for each sampled point, get the closest point in q and its distance
-            point_pairs = []
-            for p, p_normal in ps_samples:
-                (q, nq), dist = qs_kdtree.get_nearest_neighbor((p, None))
-                self.max_distance = max(self.max_distance, dist)
-                point_pairs.append((p, q, nq, p_normal, dist))
+        # write the world matrix back to the object once
+        obj_P_moving.matrix_world = Matrix(matrix)
 
-            if self.weighting_strategy == "WELSCH" and self.nu is None:
-                # Set initial nu value for Welsch function weighting
-                sorted_point_pairs = sorted(point_pairs, key=lambda t: t[4])
-                self.nu = 3 * sorted_point_pairs[n_samples // 2][4]
+        return converged, iterations
 
-            if self.rejection_criterion == "K_MEDIAN":
-                # compute median distance, for filtering outliers
-
-                distances = sorted([d for (_, _, _, _, d) in point_pairs])
-                median_distance = distances[n_samples // 2]
-
-                # filter outlier point-pairs that don't satisfy the k*median condition
-                point_pairs = [(p, q, nq, p_normal, dist) for (p, q, nq, p_normal, dist) in point_pairs if
-                               dist <= self.k * median_distance]
-
-            elif self.rejection_criterion == "DISSIMILAR_NORMALS":
-                point_pairs = [(p, q, q_normal, p_normal, dist) for (p, q, q_normal, p_normal, dist) in point_pairs if
-                               (q_normal.dot(p_normal)) >= self.normal_dissimilarity_thresh]
-
-            num_points_rejected = n_samples - len(point_pairs)
-            self.num_rejected.append(num_points_rejected)
-            if num_iterations_so_far == 0:
-                print(f'num_points_rejected: {num_points_rejected}')
-                print(f'num points after rejection: {len(point_pairs)}')
-
-            # compute optimal rigid transformation.
-            if self.point_to_plane:
-                r_opt, t_opt = self.opt_rigid_transformation_point_to_plane(point_pairs)
-            else:
-                r_opt, t_opt = self.opt_rigid_transformation_point_to_point(point_pairs,
-                                                                            prev_R=prev_R, prev_t=prev_t)
-
-            # check if converged, if so stop
-            trans_norm = np.linalg.norm(t_opt)
-            if trans_norm <= self.eps and np.allclose(r_opt, np.eye(3), atol=self.eps):
-                converged = True
-                break
+    def icp_batch(self, moving_objects: list, obj_Q_fixed, processes: int = None) -> list[RegistrationResult]:
+        """
+        Perform iterative closest point of many objects onto one fixed object, in parallel processes that share the
+        fixed object's matching index. The world matrices of all moving objects are written at the end.
+        Errors are not recorded and frames are not rendered per iteration, so an evaluation object and animation are
+        not supported
+        :param processes: number of worker processes, all cores if None
+        :return: result of each moving object, in order
+        """
+        if self.evaluation_object is not None or self.animate:
+            raise RuntimeError("Evaluation and animation are not supported when registering many objects")
 
-            # Update the previous rotation and translation
-            prev_R = r_opt
-            prev_t = t_opt
+        n_queries = min(self.max_points, max(len(obj.data.vertices) for obj in moving_objects))
+        fixed_levels, cached = self.fixed_object_levels(obj_Q_fixed, n_queries)
 
-            # transform object optimal transformation
-            rigid_transform(t_opt, r_opt, obj_P_moving)
+        moving = [(vertex_positions(obj.data), vertex_normals(obj.data), np.array(obj.matrix_world))
+                  for obj in moving_objects]
+        try:
+            results = register_batch(self, moving, fixed_levels, processes)
+        finally:
+            if not cached:
+                close_levels(fixed_levels)
 
-        return converged, num_iterations_so_far + 1
+        for obj, result in zip(moving_objects, results):
+            obj.matrix_world = Matrix(result.matrix)
 
-    def _centroid(self, ps: list[Vector]):
-        p_sum = Vector((0, 0, 0))
-        for p in ps:
-            p_sum += p
+        return results
 
-        return p_sum / len(ps)
-
-    def opt_rigid_transformation_point_to_point(self, point_pairs: list[(Vector, Vector)], prev_R=None, prev_t=None):
+    def on_iteration(self, obj_P_moving, iteration: int, matrix: np.ndarray):
         """
-        Compute the optimal rigid transformation between pairs of points
-
-        :param point_pairs: a list of pairs (p_i, q_i)
-        :param prev_R: the previous rotation matrix. Pass it if it is needed by the weighting strategy
-        :param prev_t: the previous translation vector. Pass it if is need by the weighting strategy.
-        :return: translation vector and rotation matrix for optimal rigid transformation from
-        points p_i to q_i
+        Record the error and render a frame at the start of an iteration
         """
+        # the evaluation metric and the renderer read the object, so they need its current world matrix
+        render = self.animate and iteration % self.animation_interval == 0
+        if self.evaluation_object is None and not render:
+            return
+        obj_P_moving.matrix_world = Matrix(matrix)
+
+        # record error at iteration
+        if self.evaluation_object is not None:
+            err = self.evaluation_metric(obj_P_moving, self.evaluation_object)
+            t_iter = time.perf_counter()
+            self.errors.append((err, t_iter - self._t_start))
+
+        # render progress at iteration
+        if render:
+            self.render_current(iter_num=iteration)
+
+    def fixed_object_levels(self, obj_Q_fixed, n_queries: int) -> (list[tuple], bool):
+        """
+        Levels of the fixed object built by prepare_fixed, from the geometry cache if there is one
+        :return: the levels, and if the cache holds them. Levels that are too large for the cache aren't held by it
+        """
+        if self.geometry_cache is not None:
+            key = self.fixed_object_key(obj_Q_fixed, n_queries)
+            levels = self.geometry_cache.get_or_build(key, lambda: self.prepare_fixed_object(obj_Q_fixed, n_queries))
+            return levels, key in self.geometry_cache
+        return self.prepare_fixed_object(obj_Q_fixed, n_queries), False
 
-        # compute centroids
-        centroid_p = np.array(self._centroid([t[0] for t in point_pairs]))
-        centroid_q = np.array(self._centroid([t[1] for t in point_pairs]))
-
-        # compute covariance matrix
-        covariance_matrix = np.zeros((3, 3))
-        weights_sum = 0.0
-        for pi, qi, q_normal, p_normal, dist in point_pairs:
-            wi = 1.0
-            if self.weighting_strategy == "NORMAL_SIMILARITY":
-                wi = q_normal.dot(p_normal)
-            elif self.weighting_strategy == "DISTANCE":
-                wi = 1.0 - (dist / self.max_distance)  # Based on Godin, 1994
-            elif self.weighting_strategy == "WELSCH":
-                welsch_vector = np.matmul(prev_R, pi) + prev_t - qi
-                welsch_norm = np.linalg.norm(welsch_vector)
-                wi = np.exp(-welsch_norm / (2 * self.nu ** 2))
-                self.nu = max(self.nu / 2, self.min_nu)
-            weights_sum += wi
-            covariance_matrix += wi * np.outer(np.array(pi) - centroid_p, np.array(qi) - centroid_q)
-
-        covariance_matrix /= weights_sum
-
-        # singular value decomposition
-        U, _, Vt, = np.linalg.svd(covariance_matrix, full_matrices=False)
-        V = Vt.transpose()
-        Ut = U.transpose()
-
-        # compute optimal rotation and translation
-        m = np.eye(3)
-        m[2, 2] = np.linalg.det((V @ Ut))
-        r_opt = V @ m @ Ut
-        t_opt = centroid_q - r_opt @ centroid_p
-
-        return r_opt, t_opt
-
-    def opt_rigid_transformation_point_to_plane(self, point_pairs: list[(Vector, Vector, Vector)]):
-        A = np.zeros((6, 6))
-        b = np.zeros((6,))
-
-        for p, q, nq, _, _ in point_pairs:
-            # convert vectors to numpy arrays.
-            p = np.array(p)
-            q = np.array(q)
-            nq = np.array(nq)
-
-            # compute cross product of p and nq in R3 which is a vector perpendicular to both p and nq.
-            cross = np.cross(p, nq)
-            # concatenate cross product with normal to create a vector in R6.
-            ai = np.concatenate((cross, nq))
-            # compute outer product to generate 6x6 matrix A.
-            ai_ait = np.outer(ai, ai)
-            A += ai_ait
-
-            # create a vector of 6-D.
-            ci = np.dot((p - q), nq)
-            ci_ai = ci * ai
-            b += ci_ai
-
-        # solve system that minimizes r, t: A (r t) + b = 0
-        rt_vec = solve(A, -b)
-
-        r1, r2, r3 = rt_vec[0], rt_vec[1], rt_vec[2]
-        t_opt = rt_vec[3:]
-
-        # compute approximation of rotation matrix R.
-        R = np.eye(3)
-        R[0, 1] = -r3  # first row, second column.
-        R[0, 2] = r2
-        R[1, 0] = r3
-        R[1, 2] = -r1
-        R[2, 0] = -r2
-        R[2, 1] = r1
-
-        # perform singular value decomposition.
-        U, _, Vt = svd(R, full_matrices=False)
-        D = np.eye(3)
-        D[2, 2] = det((U @ Vt))
-
-        # compute optimal rotation matrix.
-        r_opt = U @ D @ Vt
-
-        return r_opt, t_opt
-
-    def sample_points(self, obj) -> list[(np.ndarray, np.ndarray)]:
+    def prepare_fixed_object(self, obj_Q_fixed, n_queries: int) -> list[tuple]:
         """
-        Returns a list of tuples (point, normal)
+        Read the worldspace verts and normals of the fixed object, and build the matching index of each level of the
+        resolution pyramid
+        :param n_queries: number of points sampled per iteration at the finest level
         """
-        # Get world space vertices and the normals of object P
-        ps = [(obj.matrix_world @ p.co, p.normal.copy()) for p in obj.data.vertices]
-        n_samples = min(len(ps) - 1, self.max_points)
-
-        if self.sampling_strategy == "RANDOM_POINT":
-            # Sample n random points in mesh P
-            ps_samples = random.sample(ps, n_samples)
-            return ps_samples
-        elif self.sampling_strategy == "NORMAL":
-            # Create the normal "buckets" and sample from them
-            normal_dictionary = self._construct_normal_space_buckets(ps)
-            normal_samples = random.sample(normal_dictionary.keys(), n_samples)
-            ps_samples = [(random.choice(normal_dictionary[sample]), sample) for sample in normal_samples]
-            return ps_samples
-        elif self.sampling_strategy == "STRATIFIED_NORMAL":
-            normal_dictionary = self._construct_normal_space_buckets(ps)
-            ps_samples = []
-            # Sample once from each stratum until we have the amount of requested samples
-            while len(ps_samples) < n_samples:
-                for stratum in normal_dictionary.keys():
-                    ps_samples.append((random.choice(normal_dictionary[stratum]), stratum))
-            return ps_samples
-        else:
-            raise RuntimeError("Invalid point sampling strategy")
-
-    def _construct_normal_space_buckets(self, ps_normals) -> dict:
+        return self.prepare_fixed(*world_vertices(obj_Q_fixed), n_queries)
+
+    def fixed_object_key(self, obj_Q_fixed, n_queries: int) -> tuple:
         """
-        Returns a dictionary of normal -> list[Vector].
-        The normal is represented as a triple.
+        Key of the fixed object's buffers and index in the geometry cache: the object, the content of its mesh, its
+        world matrix, and the options the index is built with
         """
-        # Create dictionary of normals so we can sample them uniformly
-        normal_dictionary = dict()
-        for point, normal in ps_normals:
-            key = (normal[0], normal[1], normal[2])
-            if key not in normal_dictionary.keys():
-                normal_dictionary[key] = []
-            normal_dictionary[key].append(point)
-        return normal_dictionary
+        options = (self.distance_strategy, self.normal_weight if self.distance_strategy == "NORMAL_WEIGHTED" else None,
+                   self.matching_index, self.pyramid_levels, self.pyramid_ratio if self.pyramid_levels > 1 else None)
+        if self.matching_index == "AUTO":
+            # the automatic index is chosen for the problem size
+            options += (n_queries, self.max_iterations)
+
+        return (obj_Q_fixed.name_full, mesh_hash(obj_Q_fixed.data), tuple(np.array(obj_Q_fixed.matrix_world).ravel()),
+                options)
@@ -1,65 +1,915 @@
+import contextlib
+import importlib
+import json
+import multiprocessing
+import pathlib
+import sys
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 from typing import Generic, TypeVar
 
-from numpy import inf
+import numpy as np
 
-# P can be any point representation, which can be indexed with index_fun, and
-# distance can be computed with provided dist_fun.
+# P can be any point representation, whose coordinates can be read with index_fun
 P = TypeVar('P')
 
-class KDTree(Generic[P]):
+# trees with fewer points than this are always built on a single thread
+PARALLEL_BUILD_MIN_POINTS = 100_000
+
+# batches with fewer queries than this are always answered in the calling process
+PARALLEL_QUERY_MIN_POINTS = 10_000
 
-    def __init__(self, points: list[P], dist_fun, index_fun, dim=3):
+# upper bound on the number of (query, point) distances brute force evaluates at once
+BRUTE_FORCE_CHUNK_PAIRS = 1 << 22
 
-        def build(points, depth):
-            if len(points) == 0:
-                return None
+# Morton-ordered queries are answered in rounds of decreasing stride: every query of a round is seeded with the
+# neighbors of the preceding query of the previous round, whose stride is this many times larger
+MORTON_LEADER_STRIDE = 8
 
-            if len(points) == 1:
-                return [None, None, points[0]]
+# the first round of Morton-ordered queries, which is searched without seeds, has at least this many queries
+MORTON_MIN_LEADERS = 64
 
-            # cycle axis with depth
-            _axis = depth % dim
+class KDTree(Generic[P]):
+    """
+    KD-tree over an (N, dim) point buffer.
 
-            # sort values in ascending order for corresponding axis.
-            points.sort(key=lambda x: self.index_fun(x, _axis))
-            median = len(points) // 2
-            return [build(points[:median], depth + 1), build(points[median + 1:], depth + 1), points[median]]
+    The tree is stored implicitly in flat arrays: `_idx` is a permutation of the point indices such that each node
+    covers a contiguous range [lo, hi) of it. Nodes with at most `leaf_size` points are leaves, whose points are
+    scanned all at once. Other nodes split their range in the middle into [lo, mid) and [mid, hi), and
+    `_split_axis` and `_split_value` hold, at position mid, the axis and coordinate the node splits on.
+    `_leaf_points` holds the points in the order of `_idx`, so that a leaf's points are one contiguous slice.
+    """
+
+    def __init__(self, points, dist_fun=None, index_fun=None, dim=3, leaf_size=128, workers=1):
+        """
+        :param points: an (N, dim) array of points, or a list of arbitrary point objects P
+        :param dist_fun: unused, the tree always searches with euclidean distance. Kept for backwards compatibility
+        :param index_fun: function (P, axis) -> coordinate, required if points is a list of arbitrary objects
+        :param dim: dimensionality of the points
+        :param leaf_size: maximum number of points in a leaf
+        :param workers: number of threads used to build the tree
+        """
 
         self.dim = dim
         self.dist_fun = dist_fun
         self.index_fun = index_fun
-        self._tree = build(points, depth=0)
+        self.leaf_size = max(1, leaf_size)
+
+        # keep original point objects, so that per-point queries can return them
+        self._items = None
+        if index_fun is not None:
+            self._items = list(points)
+            points = [[index_fun(p, ax) for ax in range(dim)] for p in self._items]
+
+        self._points = np.asarray(points, dtype=np.float64).reshape(-1, dim)
+
+        n = len(self._points)
+        self._idx = np.arange(n)
+        self._split_axis = np.zeros(n, dtype=np.int8)
+        self._split_value = np.zeros(n)
+
+        # optional mask of points that are skipped by queries, used by DynamicKDTree for lazy removal
+        self._deleted = None
+
+        # process pool answering parallel queries, started on first use
+        self._pool = None
+        self._pool_workers = 0
+
+        if workers > 1 and n >= PARALLEL_BUILD_MIN_POINTS:
+            self._build_parallel(workers)
+        else:
+            self._build(0, n, depth=0)
+        self._leaf_points = self._points[self._idx]
+
+    def __len__(self):
+        return len(self._points)
+
+    # flat arrays that fully describe a built tree
+    _ARRAYS = ['_points', '_idx', '_split_axis', '_split_value', '_leaf_points']
+
+    def save(self, path):
+        """
+        Save the tree to a directory, as one raw .npy file per flat array so that it can be memory-mapped on load.
+        Point objects passed with index_fun are not saved.
+        """
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        for name in self._ARRAYS:
+            np.save(path / f'{name[1:]}.npy', getattr(self, name))
+        with open(path / 'meta.json', 'w') as fp:
+            json.dump({'dim': self.dim, 'leaf_size': self.leaf_size}, fp)
+
+    @classmethod
+    def load(cls, path, mmap=True) -> 'KDTree':
+        """
+        Load a tree saved with save, without rebuilding it
+        :param mmap: if True, the arrays are memory-mapped read-only instead of read into memory
+        """
+        path = pathlib.Path(path)
+        with open(path / 'meta.json', 'r') as fp:
+            meta = json.load(fp)
+
+        # trees saved before leaf points were stored regather them on load
+        arrays = {name: np.load(path / f'{name[1:]}.npy', mmap_mode='r' if mmap else None) for name in cls._ARRAYS
+                  if (path / f'{name[1:]}.npy').exists()}
+        return cls._from_arrays(arrays, meta['dim'], meta['leaf_size'])
+
+    @classmethod
+    def _from_arrays(cls, arrays: dict[str, np.ndarray], dim: int, leaf_size: int) -> 'KDTree':
+        """
+        Wrap already built flat arrays into a tree
+        """
+        tree = cls.__new__(cls)
+        tree.dim = dim
+        tree.leaf_size = leaf_size
+        tree.dist_fun = None
+        tree.index_fun = None
+        tree._items = None
+        tree._deleted = None
+        tree._pool = None
+        tree._pool_workers = 0
+        for name in cls._ARRAYS:
+            setattr(tree, name, arrays.get(name))
+        if tree._leaf_points is None:
+            tree._leaf_points = tree._points[tree._idx]
+        return tree
+
+    def _get_pool(self, workers: int) -> ProcessPoolExecutor:
+        """
+        Start a pool of worker processes that share the flat tree arrays, or reuse the running one
+        """
+        if self._pool is not None and self._pool_workers == workers:
+            return self._pool
+        self.close()
+
+        # the tree is copied into shared memory once, workers attach to it instead of receiving a pickled copy
+        blocks, specs = _share({name: getattr(self, name) for name in self._ARRAYS})
+
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=_spawn_context(),
+                                   initializer=_WorkerFunction('kd_tree', '_init_query_worker'),
+                                   initargs=(specs, self.dim, self.leaf_size))
+
+        self._pool = pool
+        self._pool_workers = workers
+        self._pool_finalizer = weakref.finalize(self, _shutdown_pool, pool, blocks)
+        return pool
+
+    def close(self):
+        """
+        Stop the worker processes of parallel queries and release their shared memory
+        """
+        if self._pool is not None:
+            self._pool_finalizer()
+            self._pool = None
+            self._pool_workers = 0
+
+    def _query_parallel(self, queries: np.ndarray, k: int, eps: float, workers: int,
+                        seeded: bool) -> (np.ndarray, np.ndarray):
+        n_queries = len(queries)
+        pool = self._get_pool(workers)
+
+        # queries and results are exchanged through shared memory, workers only receive the row ranges to answer
+        blocks, specs = _share({'queries': queries,
+                                'best_idx': np.zeros((n_queries, k), dtype=np.int64),
+                                'best_dist': np.zeros((n_queries, k))})
+        try:
+            bounds = np.linspace(0, n_queries, 4 * workers + 1).astype(int)
+            futures = [pool.submit(_WorkerFunction('kd_tree', '_query_chunk'), specs, lo, hi, k, eps, seeded)
+                       for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+            for future in futures:
+                future.result()
+
+            arrays = _attach_views(blocks, specs)
+            return arrays['best_idx'].copy(), arrays['best_dist'].copy()
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def _split(self, lo: int, hi: int, depth: int) -> int:
+        """
+        Split the range [lo, hi) at its median along the axis of the given depth, by permuting it in place so that
+        [lo, mid) holds the smaller and [mid, hi) the larger coordinates. Runs in O(hi - lo).
+        :return: mid
+        """
+
+        # cycle axis with depth
+        axis = depth % self.dim
+        mid = (lo + hi) // 2
+
+        # select the median without sorting the range
+        order = np.argpartition(self._points[self._idx[lo:hi], axis], mid - lo)
+        self._idx[lo:hi] = self._idx[lo:hi][order]
+
+        self._split_axis[mid] = axis
+        self._split_value[mid] = self._points[self._idx[mid], axis]
+        return mid
+
+    def _build(self, lo: int, hi: int, depth: int):
+        if hi - lo <= self.leaf_size:
+            return
+
+        mid = self._split(lo, hi, depth)
+        self._build(lo, mid, depth + 1)
+        self._build(mid, hi, depth + 1)
+
+    def _build_parallel(self, workers: int):
+        """
+        Split the top of the tree serially until there are enough independent subtrees to keep all workers busy,
+        then build those on a thread pool. Subtrees own disjoint ranges of the flat arrays, so they can be written
+        concurrently.
+        """
+        n = len(self._points)
+        min_subtree = max(self.leaf_size, PARALLEL_BUILD_MIN_POINTS // 2)
+
+        subtrees = [(0, n, 0)]
+        while len(subtrees) < 4 * workers:
+            # always split the largest remaining subtree
+            largest = max(range(len(subtrees)), key=lambda s: subtrees[s][1] - subtrees[s][0])
+            lo, hi, depth = subtrees[largest]
+            if hi - lo <= min_subtree:
+                break
+
+            mid = self._split(lo, hi, depth)
+            subtrees[largest:largest + 1] = [(lo, mid, depth + 1), (mid, hi, depth + 1)]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda subtree: self._build(*subtree), subtrees))
 
-    def _nearest_neighbour(self, node, point, closest_point, closest_dist, depth):
-        if node is None:
-            return closest_point, closest_dist
+    def _leaf_distances(self, lo: int, hi: int, qs: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        Squared distances from each query in qs to each point of the leaf covering [lo, hi)
+        :return: leaf point indices (L,) and squared distances (len(qs), L)
+        """
+        leaf_idx = self._idx[lo:hi]
+        leaf_points = self._leaf_points[lo:hi]
 
-        left, right, cur = node[0], node[1], node[2]
-        dist = self.dist_fun(point, cur)
+        # accumulate per axis, which avoids a (len(qs), L, dim) temporary
+        d2 = (qs[:, 0, None] - leaf_points[None, :, 0]) ** 2
+        for axis in range(1, self.dim):
+            d2 += (qs[:, axis, None] - leaf_points[None, :, axis]) ** 2
+        if self._deleted is not None:
+            d2[:, self._deleted[leaf_idx]] = np.inf
+        return leaf_idx, d2
 
-        if dist < closest_dist:
-            closest_dist = dist
-            closest_point = cur
+    def _search(self, lo: int, hi: int, qids: np.ndarray, queries: np.ndarray, best_idx: np.ndarray,
+                best_d2: np.ndarray, shrink: float):
+        """
+        Search the subtree covering [lo, hi) for all queries in qids at once.
 
-        # decide which side to go to.
-        _axis = depth % self.dim
-        if self.index_fun(point, _axis) < self.index_fun(cur, _axis):
-            good_side = left
-            bad_side = right
+        best_idx and best_d2 are (Q, k) bounded heaps, updated in place: every row holds the k closest points found
+        so far for a query, sorted by squared distance, so that its last column is the bound used for pruning.
+        The bound is multiplied by shrink = 1 / (1 + eps)^2 when pruning, for (1 + eps)-approximate search.
+        """
+        if len(qids) == 0:
+            return
+
+        if hi - lo <= self.leaf_size:
+            leaf_idx, d2 = self._leaf_distances(lo, hi, queries[qids])
+
+            # merge the leaf points into the heaps of the queries that have a point closer than their bound
+            closer = np.any(d2 < best_d2[qids, -1:], axis=1)
+            if np.any(closer):
+                rows = qids[closer]
+                k = best_d2.shape[1]
+                if k == 1:
+                    closer_d2 = d2[closer]
+                    nearest = np.argmin(closer_d2, axis=1)
+                    best_d2[rows, 0] = closer_d2[np.arange(len(rows)), nearest]
+                    best_idx[rows, 0] = leaf_idx[nearest]
+                    return
+
+                heap_d2 = np.concatenate((best_d2[rows], d2[closer]), axis=1)
+                heap_idx = np.concatenate((best_idx[rows], np.broadcast_to(leaf_idx, d2[closer].shape)), axis=1)
+                order = np.argsort(heap_d2, axis=1, kind='stable')[:, :k]
+                best_d2[rows] = np.take_along_axis(heap_d2, order, axis=1)
+                best_idx[rows] = np.take_along_axis(heap_idx, order, axis=1)
+            return
+
+        mid = (lo + hi) // 2
+
+        # decide which side each query goes to
+        diff = queries[qids, self._split_axis[mid]] - self._split_value[mid]
+        go_left = diff < 0
+        left_qids, right_qids = qids[go_left], qids[~go_left]
+
+        self._search(lo, mid, left_qids, queries, best_idx, best_d2, shrink)
+        self._search(mid, hi, right_qids, queries, best_idx, best_d2, shrink)
+
+        # visit the other side only for queries whose heap may still improve beyond the splitting plane
+        far_right = right_qids[diff[~go_left] ** 2 < shrink * best_d2[right_qids, -1]]
+        self._search(lo, mid, far_right, queries, best_idx, best_d2, shrink)
+        far_left = left_qids[diff[go_left] ** 2 < shrink * best_d2[left_qids, -1]]
+        self._search(mid, hi, far_left, queries, best_idx, best_d2, shrink)
+
+    def _search_seeded(self, lo: int, hi: int, qids: np.ndarray, queries: np.ndarray, best_idx: np.ndarray,
+                       best_d2: np.ndarray, shrink: float):
+        """
+        Like _search, for queries whose heaps already hold a tight bound. Each query is sent down every side its bound
+        crosses at once, instead of first descending the near sides, so that every node is visited at most once for
+        the whole batch.
+        """
+        if len(qids) == 0:
+            return
+
+        if hi - lo <= self.leaf_size:
+            self._search(lo, hi, qids, queries, best_idx, best_d2, shrink)
+            return
+
+        mid = (lo + hi) // 2
+        diff = queries[qids, self._split_axis[mid]] - self._split_value[mid]
+
+        # the bounds shrink while searching the left side, so they are read again for the right side
+        left = (diff < 0) | (diff ** 2 < shrink * best_d2[qids, -1])
+        self._search_seeded(lo, mid, qids[left], queries, best_idx, best_d2, shrink)
+        right = (diff >= 0) | (diff ** 2 < shrink * best_d2[qids, -1])
+        self._search_seeded(mid, hi, qids[right], queries, best_idx, best_d2, shrink)
+
+    def _search_radius(self, lo: int, hi: int, qids: np.ndarray, queries: np.ndarray, r2: float, found: list):
+        """
+        Collect, for all queries in qids, the points of the subtree covering [lo, hi) within squared radius r2.
+        Matches are appended to found as (query ids, point indices, squared distances) triples.
+        """
+        if len(qids) == 0:
+            return
+
+        if hi - lo <= self.leaf_size:
+            leaf_idx, d2 = self._leaf_distances(lo, hi, queries[qids])
+            rows, cols = np.nonzero(d2 <= r2)
+            if len(rows):
+                found.append((qids[rows], leaf_idx[cols], d2[rows, cols]))
+            return
+
+        mid = (lo + hi) // 2
+
+        # the ball around a query crosses the splitting plane if it is closer than r to it
+        diff = queries[qids, self._split_axis[mid]] - self._split_value[mid]
+        self._search_radius(lo, mid, qids[(diff < 0) | (diff ** 2 <= r2)], queries, r2, found)
+        self._search_radius(mid, hi, qids[(diff >= 0) | (diff ** 2 <= r2)], queries, r2, found)
+
+    def _as_queries(self, points) -> np.ndarray:
+        return np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+
+    def _seed(self, qids: np.ndarray, leaders: np.ndarray, queries: np.ndarray, best_idx: np.ndarray,
+              best_d2: np.ndarray):
+        """
+        Start the heaps of the queries qids from an upper bound on their k-th neighbor distance: the distance to the
+        farthest of the k neighbors already found for their leaders, which are nearby queries. Seeded slots keep
+        index -1 until a point within the bound replaces them.
+        """
+        lead_idx = best_idx[leaders]
+        d2 = np.sum((queries[qids][:, None, :] - self._points[lead_idx]) ** 2, axis=2)
+        d2[lead_idx < 0] = np.inf
+
+        # loosen the bound slightly, so that points exactly on it, like the leaders' neighbors, still enter the heaps
+        best_d2[qids] = (d2.max(axis=1) * (1 + 1e-9))[:, None]
+
+    def _query(self, queries: np.ndarray, k: int, eps: float, seeded: bool) -> (np.ndarray, np.ndarray):
+        """
+        Answer a batch of queries in the calling process
+        :param seeded: if True, the queries are sorted along a space-filling curve, and are answered in rounds: the
+        first round answers every stride-th query, and each following round divides the stride by
+        MORTON_LEADER_STRIDE and seeds its queries from the preceding query of the previous rounds
+        """
+        n = len(self._points)
+        n_queries = len(queries)
+        shrink = 1 / (1 + eps) ** 2
+
+        best_idx = np.full((n_queries, k), -1, dtype=np.int64)
+        best_d2 = np.full((n_queries, k), np.inf)
+        qids = np.arange(n_queries)
+
+        if not seeded:
+            self._search(0, n, qids, queries, best_idx, best_d2, shrink)
+            return best_idx, np.sqrt(best_d2)
+
+        stride = 1
+        while n_queries // (stride * MORTON_LEADER_STRIDE) >= MORTON_MIN_LEADERS:
+            stride *= MORTON_LEADER_STRIDE
+        self._search(0, n, qids[::stride], queries, best_idx, best_d2, shrink)
+
+        while stride > 1:
+            leader_stride, stride = stride, stride // MORTON_LEADER_STRIDE
+            round_qids = qids[::stride]
+            round_qids = round_qids[round_qids % leader_stride != 0]
+            self._seed(round_qids, round_qids - round_qids % leader_stride, queries, best_idx, best_d2)
+            self._search_seeded(0, n, round_qids, queries, best_idx, best_d2, shrink)
+
+        # approximate search can prune the points under a seeded bound, search those queries again unseeded
+        unresolved = np.flatnonzero(np.any((best_idx < 0) & np.isfinite(best_d2), axis=1))
+        if len(unresolved):
+            best_idx[unresolved], best_d2[unresolved] = -1, np.inf
+            self._search(0, n, unresolved, queries, best_idx, best_d2, shrink)
+
+        return best_idx, np.sqrt(best_d2)
+
+    def query_knn(self, points, k: int, eps=0.0, workers=1, morton=False) -> (np.ndarray, np.ndarray):
+        """
+        Find the k nearest neighbors of many query points at once
+        :param points: (Q, dim) array of query points
+        :param k: number of neighbors per query
+        :param eps: if > 0, search approximately: the i-th neighbor returned is at most (1 + eps) times farther
+        than the true i-th nearest neighbor
+        :param workers: number of processes to answer the queries with, for batches of at least
+        PARALLEL_QUERY_MIN_POINTS queries
+        :param morton: if True, answer the queries in Z-order, so that consecutive queries traverse the same parts
+        of the tree and seed each other's bounds. Faster for large batches of queries in random order
+        :return: (Q, k) indices into the tree's point buffer and (Q, k) euclidean distances, sorted by distance.
+        If the tree has fewer than k points, missing neighbors have index -1 and distance inf
+        """
+        queries = self._as_queries(points)
+        n_queries = len(queries)
+
+        order = None
+        if morton and n_queries > 1:
+            order = morton_order(queries)
+            queries = queries[order]
+
+        if workers > 1 and n_queries >= PARALLEL_QUERY_MIN_POINTS and self._deleted is None:
+            best_idx, best_dist = self._query_parallel(queries, k, eps, workers, seeded=order is not None)
         else:
-            good_side = right
-            bad_side = left
+            best_idx, best_dist = self._query(queries, k, eps, seeded=order is not None)
+
+        if order is not None:
+            best_idx[order], best_dist[order] = best_idx.copy(), best_dist.copy()
+        return best_idx, best_dist
+
+    def query_batch(self, points, eps=0.0, workers=1, morton=False) -> (np.ndarray, np.ndarray):
+        """
+        Find the nearest neighbor of many query points at once
+        :param points: (Q, dim) array of query points
+        :param eps: if > 0, return (1 + eps)-approximate nearest neighbors
+        :param workers: number of processes to answer the queries with, see query_knn
+        :param morton: if True, answer the queries in Z-order, see query_knn
+        :return: (Q,) indices of the nearest points in the tree's point buffer, and (Q,) euclidean distances to them
+        """
+        indices, distances = self.query_knn(points, k=1, eps=eps, workers=workers, morton=morton)
+        return indices[:, 0], distances[:, 0]
+
+    def query_radius(self, points, r: float) -> (list[np.ndarray], list[np.ndarray]):
+        """
+        Find all points within distance r of many query points at once
+        :param points: (Q, dim) array of query points
+        :param r: search radius
+        :return: for each query, an array of indices into the tree's point buffer and an array of euclidean
+        distances, sorted by distance
+        """
+        queries = self._as_queries(points)
+        n_queries = len(queries)
+
+        found = []
+        self._search_radius(0, len(self._points), np.arange(n_queries), queries, r * r, found)
 
-        closest_point, closest_dist = self._nearest_neighbour(good_side, point, closest_point, closest_dist, depth + 1)
+        if not found:
+            empty = np.zeros(0, dtype=np.int64)
+            return [empty] * n_queries, [np.zeros(0)] * n_queries
 
-        if abs(self.index_fun(cur, _axis) - self.index_fun(point, _axis)) ** 2 < closest_dist:
-            closest_point, closest_dist = self._nearest_neighbour(bad_side, point, closest_point, closest_dist,
-                                                                  depth + 1)
+        qids = np.concatenate([q for q, _, _ in found])
+        indices = np.concatenate([i for _, i, _ in found])
+        d2 = np.concatenate([d for _, _, d in found])
 
-        return closest_point, closest_dist
+        # group matches per query, sorted by distance
+        order = np.lexsort((d2, qids))
+        splits = np.cumsum(np.bincount(qids, minlength=n_queries))[:-1]
+        return np.split(indices[order], splits), np.split(np.sqrt(d2[order]), splits)
 
     def get_nearest_neighbor(self, point: P) -> (P, float):
-        closest_point, closest_distance = self._nearest_neighbour(node=self._tree, point=point,
-                                                                  closest_point=None, closest_dist=inf,
-                                                                  depth=0)
-        return closest_point, closest_distance
+        coords = point if self.index_fun is None else [self.index_fun(point, ax) for ax in range(self.dim)]
+        indices, distances = self.query_batch(coords)
+        i = indices[0]
+        if i < 0:
+            return None, np.inf
+
+        closest_point = self._points[i] if self._items is None else self._items[i]
+        return closest_point, distances[0]
+
+
+class _WorkerFunction:
+    """
+    Picklable reference to a function of a module of this directory, to pass to worker processes. Workers are spawned
+    fresh, and importing the addon package in them would fail without blender, so the reference unpickles to the
+    function of the module imported by its top-level name. This process never imports that second copy of the module
+    """
+
+    def __init__(self, module: str, name: str):
+        self.module = module
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        # in this process, the function of the module as it is imported here
+        module = importlib.import_module(f'{__package__}.{self.module}' if __package__ else self.module)
+        return getattr(module, self.name)(*args, **kwargs)
+
+    def __reduce__(self):
+        return getattr, (_TopLevelModule(self.module), self.name)
+
+class _TopLevelModule:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __reduce__(self):
+        return importlib.import_module, (self.name,)
+
+def _spawn_context() -> multiprocessing.context.SpawnContext:
+    """
+    Context of worker processes that are spawned instead of forked, since forking a process with running threads
+    (e.g. blender) is unsafe. They can import the modules of this directory by their top-level names
+    """
+    return _StandaloneContext()
+
+@contextlib.contextmanager
+def _standalone_path():
+    """
+    Put this directory on sys.path while inside, unless it is there already
+    """
+    directory = str(pathlib.Path(__file__).parent)
+    if directory in sys.path:
+        yield
+        return
+
+    sys.path.append(directory)
+    try:
+        yield
+    finally:
+        sys.path.remove(directory)
+
+class _StandaloneProcess(multiprocessing.context.SpawnProcess):
+    # a spawned process starts with the sys.path of its parent at the time it is launched
+    @staticmethod
+    def _Popen(process_obj):
+        with _standalone_path():
+            return multiprocessing.context.SpawnProcess._Popen(process_obj)
+
+    # the started process is a plain spawned process, so it doesn't need to import this module to unpickle itself
+    def __reduce__(self):
+        return object.__new__, (multiprocessing.context.SpawnProcess,), self.__dict__
+
+class _StandaloneContext(multiprocessing.context.SpawnContext):
+    Process = _StandaloneProcess
+
+def _share(arrays: dict[str, np.ndarray]) -> (list[SharedMemory], dict):
+    """
+    Copy arrays into new shared memory blocks
+    :return: the blocks, and picklable specs (block name, shape, dtype) to attach to them from other processes
+    """
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def _attach_views(blocks: list[SharedMemory], specs: dict) -> dict[str, np.ndarray]:
+    return {name: np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            for block, (name, (_, shape, dtype)) in zip(blocks, specs.items())}
+
+def _attach(specs: dict) -> (list[SharedMemory], dict[str, np.ndarray]):
+    blocks = [SharedMemory(name=block_name) for block_name, _, _ in specs.values()]
+    return blocks, _attach_views(blocks, specs)
+
+def _shutdown_pool(pool: ProcessPoolExecutor, blocks: list[SharedMemory]):
+    pool.shutdown(wait=True)
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+# tree of a worker process, attached to the shared memory of the tree in the parent process
+_worker_tree = None
+_worker_blocks = []
+
+def _init_query_worker(specs: dict, dim: int, leaf_size: int):
+    global _worker_tree, _worker_blocks
+    _worker_blocks, arrays = _attach(specs)
+    _worker_tree = KDTree._from_arrays(arrays, dim, leaf_size)
+
+def _query_chunk(specs: dict, lo: int, hi: int, k: int, eps: float, seeded: bool):
+    blocks, arrays = _attach(specs)
+    try:
+        idx, dist = _worker_tree._query(arrays['queries'][lo:hi], k, eps, seeded)
+        arrays['best_idx'][lo:hi] = idx
+        arrays['best_dist'][lo:hi] = dist
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+
+def morton_order(points: np.ndarray) -> np.ndarray:
+    """
+    Order of points along a Z-order (Morton) curve through their bounding box
+    :param points: (N, dim) array of points
+    :return: (N,) permutation that sorts the points along the curve
+    """
+    n, dim = points.shape
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # quantize each axis to as many bits as fit into a 64 bit code
+    bits = min(21, 63 // dim)
+    lo = points.min(axis=0)
+    scale = ((1 << bits) - 1) / max(np.ptp(points, axis=0).max(), 1e-300)
+    cells = ((points - lo) * scale).astype(np.uint64)
+
+    # interleave the bits of all axes, most significant first
+    codes = np.zeros(n, dtype=np.uint64)
+    for bit in range(bits - 1, -1, -1):
+        for axis in range(dim):
+            codes = (codes << np.uint64(1)) | ((cells[:, axis] >> np.uint64(bit)) & np.uint64(1))
+    return np.argsort(codes, kind='stable')
+
+def merge_knn(indices: list[np.ndarray], d2: list[np.ndarray], k: int) -> (np.ndarray, np.ndarray):
+    """
+    Merge several (Q, *) candidate sets of indices and squared distances into the (Q, k) closest ones
+    """
+    indices = np.concatenate(indices, axis=1)
+    d2 = np.concatenate(d2, axis=1)
+    order = np.argsort(d2, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(d2, order, axis=1)
+
+def squared_distances(queries: np.ndarray, points: np.ndarray, points_sq=None) -> np.ndarray:
+    """
+    (Q, N) squared distances between queries and points, computed as |q|^2 - 2 q.p + |p|^2 in place, so that the
+    only (Q, N) array allocated is the result
+    :param points_sq: optional precomputed (N,) squared norms of the points
+    """
+    if points_sq is None:
+        points_sq = np.sum(points ** 2, axis=1)
+    d2 = queries @ points.T
+    d2 *= -2
+    d2 += np.sum(queries ** 2, axis=1)[:, None]
+    d2 += points_sq[None, :]
+    return np.maximum(d2, 0, out=d2)
+
+def brute_force_knn(queries: np.ndarray, points: np.ndarray, k: int, max_pairs=BRUTE_FORCE_CHUNK_PAIRS,
+                    points_sq=None) -> (np.ndarray, np.ndarray):
+    """
+    k nearest neighbors by brute force, processing queries in chunks to bound memory
+    :param max_pairs: maximum number of (query, point) distances held at once
+    :param points_sq: optional precomputed (N,) squared norms of the points
+    :return: (Q, k) indices and squared distances, sorted by distance
+    """
+    n_queries, n_points = len(queries), len(points)
+    indices = np.full((n_queries, k), -1, dtype=np.int64)
+    d2 = np.full((n_queries, k), np.inf)
+
+    kk = min(k, n_points)
+    if kk == 0:
+        return indices, d2
+
+    if points_sq is None:
+        points_sq = np.sum(points ** 2, axis=1)
+
+    chunk = max(1, max_pairs // n_points)
+    for lo in range(0, n_queries, chunk):
+        chunk_d2 = squared_distances(queries[lo:lo + chunk], points, points_sq)
+        nearest = np.argpartition(chunk_d2, kk - 1, axis=1)[:, :kk]
+        nearest_d2 = np.take_along_axis(chunk_d2, nearest, axis=1)
+        order = np.argsort(nearest_d2, axis=1, kind='stable')
+        indices[lo:lo + chunk, :kk] = np.take_along_axis(nearest, order, axis=1)
+        d2[lo:lo + chunk, :kk] = np.take_along_axis(nearest_d2, order, axis=1)
+
+        # release this chunk's distances and indices before the next chunk's are allocated
+        del chunk_d2, nearest
+
+    return indices, d2
+
+def _grow(a: np.ndarray, capacity: int) -> np.ndarray:
+    grown = np.zeros((capacity,) + a.shape[1:], dtype=a.dtype)
+    grown[:len(a)] = a
+    return grown
+
+class _Level:
+    """
+    A static KDTree of the dynamic tree, with the ids of its points and lazily removed points masked out
+    """
+
+    def __init__(self, ids: np.ndarray, positions: np.ndarray, dim: int, leaf_size: int):
+        self.ids = ids
+        self.tree = KDTree(positions[ids], dim=dim, leaf_size=leaf_size)
+        self.tree._deleted = np.zeros(len(ids), dtype=bool)
+        self.n_deleted = 0
+
+    def alive_ids(self) -> np.ndarray:
+        return self.ids[~self.tree._deleted]
+
+class DynamicKDTree:
+    """
+    KD-tree supporting insertion, removal and update of points, using the logarithmic method (Bentley & Saxe, 1980).
+
+    Points live in a small buffer that is searched by brute force, and in static KDTree levels, where level i holds
+    up to buffer_size * 2^i points. When the buffer overflows, it is merged with the consecutive occupied levels
+    into the first free one, like a binary counter, so a point is rebuilt O(log n) times over its lifetime.
+    Removed points are masked out of their level, which is rebuilt once half of its points are removed.
+
+    Points are addressed by stable ids: initial points get ids 0..N-1, and insert returns the ids of new points.
+    """
+
+    def __init__(self, points=None, dim=3, leaf_size=128, buffer_size=256):
+        """
+        :param points: optional (N, dim) array of initial points
+        :param dim: dimensionality of the points
+        :param leaf_size: maximum number of points in a leaf of the static levels
+        :param buffer_size: maximum number of points in the brute force buffer
+        """
+        self.dim = dim
+        self.leaf_size = leaf_size
+        self.buffer_size = buffer_size
+
+        # position and state of each id, with spare capacity for inserted points
+        self._size = 0
+        self._positions = np.zeros((0, dim))
+        self._alive = np.zeros(0, dtype=bool)
+        # level holding each id (-1 for the buffer) and its index within that level
+        self._level_of = np.zeros(0, dtype=np.int64)
+        self._slot_of = np.zeros(0, dtype=np.int64)
+
+        self._levels: list[_Level | None] = []
+        self._buffer = np.zeros(0, dtype=np.int64)
+
+        if points is not None and len(points):
+            points = np.asarray(points, dtype=np.float64).reshape(-1, dim)
+            ids = self._allocate(points)
+
+            # initial points go straight to the smallest level that can hold them
+            level = max(0, int(np.ceil(np.log2(len(ids) / buffer_size))))
+            self._levels = [None] * level + [None]
+            self._set_level(level, ids)
+
+    def __len__(self):
+        return int(np.count_nonzero(self._alive))
+
+    @property
+    def points(self) -> np.ndarray:
+        """
+        (n_ids, dim) positions indexed by id. Rows of removed ids are meaningless.
+        """
+        return self._positions[:self._size]
+
+    def _allocate(self, points: np.ndarray) -> np.ndarray:
+        n_old, n_new = self._size, len(points)
+        self._size += n_new
+
+        # grow the per-id arrays geometrically, so that allocating ids is amortized O(1)
+        capacity = len(self._positions)
+        if self._size > capacity:
+            capacity = max(self._size, 2 * capacity)
+            self._positions = _grow(self._positions, capacity)
+            self._alive = _grow(self._alive, capacity)
+            self._level_of = _grow(self._level_of, capacity)
+            self._slot_of = _grow(self._slot_of, capacity)
+
+        ids = np.arange(n_old, self._size)
+        self._positions[ids] = points
+        self._alive[ids] = True
+        self._level_of[ids] = -1
+        return ids
+
+    def _set_level(self, level: int, ids: np.ndarray):
+        if len(ids) == 0:
+            self._levels[level] = None
+            return
+
+        self._levels[level] = _Level(ids, self._positions, self.dim, self.leaf_size)
+        self._level_of[ids] = level
+        self._slot_of[ids] = np.arange(len(ids))
+
+    def _add_to_buffer(self, ids: np.ndarray):
+        self._level_of[ids] = -1
+        self._buffer = np.concatenate((self._buffer, ids))
+
+        if len(self._buffer) <= self.buffer_size:
+            return
+
+        # carry the buffer into the first free level, merging all occupied levels below it
+        carry = [self._buffer]
+        self._buffer = np.zeros(0, dtype=np.int64)
+        level = 0
+        while level < len(self._levels) and self._levels[level] is not None:
+            carry.append(self._levels[level].alive_ids())
+            self._levels[level] = None
+            level += 1
+
+        if level == len(self._levels):
+            self._levels.append(None)
+        self._set_level(level, np.concatenate(carry))
+
+    def insert(self, points) -> np.ndarray:
+        """
+        Insert new points
+        :param points: (M, dim) array of points
+        :return: (M,) ids of the inserted points
+        """
+        ids = self._allocate(np.asarray(points, dtype=np.float64).reshape(-1, self.dim))
+        self._add_to_buffer(ids)
+        return ids
+
+    def remove(self, ids):
+        """
+        Remove points by id
+        :param ids: ids of points to remove
+        """
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        ids = ids[self._alive[ids]]
+        self._alive[ids] = False
+
+        in_buffer = self._level_of[ids] == -1
+        self._buffer = self._buffer[np.isin(self._buffer, ids[in_buffer], invert=True)]
+
+        # mask removed points out of their level, and rebuild levels that became half empty
+        for level in np.unique(self._level_of[ids[~in_buffer]]):
+            level_ids = ids[self._level_of[ids] == level]
+            lvl = self._levels[level]
+            lvl.tree._deleted[self._slot_of[level_ids]] = True
+            lvl.n_deleted += len(level_ids)
+
+            if 2 * lvl.n_deleted > len(lvl.ids):
+                self._set_level(level, lvl.alive_ids())
+
+    def update(self, ids, new_positions):
+        """
+        Move existing points to new positions, keeping their ids
+        :param ids: (M,) ids of points to move, if an id is repeated its last position is used
+        :param new_positions: (M, dim) new positions
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        new_positions = np.asarray(new_positions, dtype=np.float64).reshape(-1, self.dim)
+        if not np.all(self._alive[ids]):
+            raise ValueError('Only points in the tree can be updated, removed points must be inserted again')
+
+        _, last = np.unique(ids[::-1], return_index=True)
+        keep = len(ids) - 1 - last
+        ids, new_positions = ids[keep], new_positions[keep]
+
+        self.remove(ids)
+        self._positions[ids] = new_positions
+        self._alive[ids] = True
+        self._add_to_buffer(ids)
+
+    def query_knn(self, points, k: int, eps=0.0) -> (np.ndarray, np.ndarray):
+        """
+        Find the k nearest neighbors of many query points at once, (1 + eps)-approximately if eps > 0
+        :return: (Q, k) ids and (Q, k) euclidean distances, sorted by distance. Missing neighbors have id -1
+        """
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+        n_queries = len(queries)
+
+        indices = [np.full((n_queries, k), -1, dtype=np.int64)]
+        d2 = [np.full((n_queries, k), np.inf)]
+
+        for level in self._levels:
+            if level is None:
+                continue
+            level_idx, level_dist = level.tree.query_knn(queries, k, eps)
+            indices.append(np.where(level_idx >= 0, level.ids[level_idx], -1))
+            d2.append(level_dist ** 2)
+
+        if len(self._buffer):
+            indices.append(np.broadcast_to(self._buffer, (n_queries, len(self._buffer))))
+            d2.append(squared_distances(queries, self._positions[self._buffer]))
+
+        indices, d2 = merge_knn(indices, d2, k)
+        return indices, np.sqrt(d2)
+
+    def query_batch(self, points, eps=0.0) -> (np.ndarray, np.ndarray):
+        """
+        Find the nearest neighbor of many query points at once, (1 + eps)-approximately if eps > 0
+        :return: (Q,) ids and (Q,) euclidean distances
+        """
+        indices, distances = self.query_knn(points, k=1, eps=eps)
+        return indices[:, 0], distances[:, 0]
+
+    def query_radius(self, points, r: float) -> (list[np.ndarray], list[np.ndarray]):
+        """
+        Find all points within distance r of many query points at once
+        :return: for each query, an array of ids and an array of euclidean distances, sorted by distance
+        """
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+        n_queries = len(queries)
+
+        indices = [[] for _ in range(n_queries)]
+        distances = [[] for _ in range(n_queries)]
+
+        for level in self._levels:
+            if level is None:
+                continue
+            level_idx, level_dist = level.tree.query_radius(queries, r)
+            for q in range(n_queries):
+                indices[q].append(level.ids[level_idx[q]])
+                distances[q].append(level_dist[q])
+
+        if len(self._buffer):
+            buffer_dist = np.sqrt(squared_distances(queries, self._positions[self._buffer]))
+            for q in range(n_queries):
+                inside = buffer_dist[q] <= r
+                indices[q].append(self._buffer[inside])
+                distances[q].append(buffer_dist[q, inside])
+
+        for q in range(n_queries):
+            q_idx = np.concatenate(indices[q]) if indices[q] else np.zeros(0, dtype=np.int64)
+            q_dist = np.concatenate(distances[q]) if distances[q] else np.zeros(0)
+            order = np.argsort(q_dist, kind='stable')
+            indices[q], distances[q] = q_idx[order], q_dist[order]
+
+        return indices, distances
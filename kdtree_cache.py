@@ -0,0 +1,100 @@
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+
+import numpy as np
+
+try:
+    from .kd_tree import KDTree
+except ImportError:
+    from kd_tree import KDTree
+
+class KDTreeCache:
+    """
+    Directory of saved KDTrees, keyed by a hash of the points they were built from.
+
+    Each entry is a subdirectory written with KDTree.save, so a cache hit memory-maps the tree instead of building it.
+    The cache is bounded to max_bytes: when it grows larger, least recently used entries are evicted. Usage is
+    tracked with the modification time of the entries, so the cache can be shared between processes and sessions.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        """
+        :param cache_dir: directory to store the trees in, created if it does not exist
+        :param max_bytes: maximum total size of the cache on disk
+        """
+        self.cache_dir = pathlib.Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        # outcome of the last get_or_build call, for reporting
+        self.last_hit = False
+
+    @staticmethod
+    def key(points: np.ndarray, leaf_size: int) -> str:
+        """
+        Hash of the point buffer, and of the build parameters that change the tree
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(np.array(points.shape + (leaf_size,), dtype=np.int64).tobytes())
+        h.update(points.tobytes())
+        return h.hexdigest()
+
+    def get_or_build(self, points: np.ndarray, leaf_size=128, workers=1) -> KDTree:
+        """
+        Load the tree of the given points from the cache, or build it and add it to the cache
+        """
+        entry = self.cache_dir / self.key(points, leaf_size)
+
+        if (entry / 'meta.json').exists():
+            self.last_hit = True
+            os.utime(entry)
+            return KDTree.load(entry, mmap=True)
+
+        self.last_hit = False
+        tree = KDTree(points, dim=points.shape[1], leaf_size=leaf_size, workers=workers)
+
+        # write to a temporary directory first, so that other processes never see partially written entries
+        tmp = pathlib.Path(tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-'))
+        try:
+            tree.save(tmp)
+            os.replace(tmp, entry)
+        except OSError:
+            # another process added the same entry in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict(keep=entry)
+        return tree
+
+    def entries(self) -> list[pathlib.Path]:
+        return [p for p in self.cache_dir.iterdir() if p.is_dir() and not p.name.startswith('.')]
+
+    def size(self) -> int:
+        return sum(_dir_size(entry) for entry in self.entries())
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        :param keep: an entry that is never evicted, e.g. the one that was just added
+        """
+        entries = sorted(self.entries(), key=lambda p: p.stat().st_mtime)
+        sizes = {entry: _dir_size(entry) for entry in entries}
+        total = sum(sizes.values())
+
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
+
+    def clear(self):
+        for entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+def _dir_size(path: pathlib.Path) -> int:
+    return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
@@ -0,0 +1,220 @@
+import pathlib
+
+import numpy as np
+
+try:
+    from .kd_tree import KDTree
+except ImportError:
+    from kd_tree import KDTree
+
+# neighbors used to estimate the normals of point clouds without normals or faces
+NORMAL_NEIGHBORS = 16
+
+# numpy types of the scalar property types of PLY files
+_PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+              'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+              'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+def read_points(path, estimate_missing_normals=True) -> (np.ndarray, np.ndarray):
+    """
+    Read the points and normals of a mesh or point cloud file: PLY, OBJ, XYZ (text columns x y z, optionally
+    followed by nx ny nz) or NPY ((N, 3) points or (N, 6) points and normals).
+    Normals missing from the file are computed from the faces, or estimated from the neighbors of each point.
+    :return: (N, 3) points and (N, 3) unit normals, or None if they are missing and not estimated
+    """
+    path = pathlib.Path(path)
+    readers = {'.ply': read_ply, '.obj': read_obj, '.xyz': read_xyz, '.npy': read_npy}
+    if path.suffix.lower() not in readers:
+        raise ValueError(f'Unsupported point file format: {path.suffix}')
+
+    points, normals, faces = readers[path.suffix.lower()](path)
+    if normals is None and faces is not None and len(faces):
+        normals = face_vertex_normals(points, faces)
+    elif normals is None and estimate_missing_normals:
+        normals = estimate_normals(points)
+    elif normals is not None:
+        normals = normals / np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+    return points, normals
+
+def read_ply(path) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Read an ascii or binary PLY file
+    :return: (N, 3) points, (N, 3) normals or None, and (M, 3) triangle indices or None
+    """
+    with open(path, 'rb') as fp:
+        if fp.readline().strip() != b'ply':
+            raise ValueError(f'{path} is not a PLY file')
+
+        # header: the format, and the elements with their properties, in file order
+        fmt, elements = None, []
+        for line in iter(fp.readline, b''):
+            words = line.decode('ascii').split()
+            if not words or words[0] in {'comment', 'obj_info'}:
+                continue
+            if words[0] == 'end_header':
+                break
+            if words[0] == 'format':
+                fmt = words[1]
+            elif words[0] == 'element':
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == 'property':
+                # scalar properties are (name, type), list properties (name, count type, item type)
+                elements[-1][2].append((words[-1], *words[2:-1]) if words[1] == 'list' else (words[2], words[1]))
+        body = fp.read()
+
+    if fmt == 'ascii':
+        data = _read_ply_ascii(body, elements)
+    elif fmt in {'binary_little_endian', 'binary_big_endian'}:
+        data = _read_ply_binary(body, elements, '<' if fmt == 'binary_little_endian' else '>')
+    else:
+        raise ValueError(f'Unsupported PLY format: {fmt}')
+
+    vertex = data['vertex']
+    points = np.column_stack([vertex[axis] for axis in 'xyz']).astype(np.float64)
+    normals = None
+    if all(name in vertex for name in ('nx', 'ny', 'nz')):
+        normals = np.column_stack([vertex[name] for name in ('nx', 'ny', 'nz')]).astype(np.float64)
+
+    faces = None
+    if 'face' in data:
+        lists = data['face'].get('vertex_indices', data['face'].get('vertex_index'))
+        faces = _triangulate(lists) if lists is not None else None
+    return points, normals, faces
+
+def _read_ply_ascii(body: bytes, elements: list) -> dict:
+    lines = body.decode('ascii').splitlines()
+    data, start = {}, 0
+    for name, count, properties in elements:
+        rows = [line.split() for line in lines[start:start + count]]
+        start += count
+
+        if all(len(prop) == 2 for prop in properties):
+            values = np.array(rows, dtype=np.float64).reshape(count, len(properties))
+            data[name] = {prop[0]: values[:, i] for i, prop in enumerate(properties)}
+        elif len(properties) == 1:
+            # a single list property, like the vertex indices of faces
+            data[name] = {properties[0][0]: [np.array(row[1:1 + int(row[0])], dtype=np.int64) for row in rows]}
+        else:
+            raise ValueError(f'Unsupported PLY element: {name}')
+    return data
+
+def _read_ply_binary(body: bytes, elements: list, byte_order: str) -> dict:
+    data, offset = {}, 0
+    for name, count, properties in elements:
+        if all(len(prop) == 2 for prop in properties):
+            dtype = np.dtype([(prop[0], byte_order + _PLY_TYPES[prop[1]]) for prop in properties])
+            values = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+            offset += count * dtype.itemsize
+            data[name] = {prop[0]: values[prop[0]] for prop in properties}
+        elif len(properties) == 1:
+            list_name, count_type, item_type = properties[0]
+            count_type = np.dtype(byte_order + _PLY_TYPES[count_type])
+            item_type = np.dtype(byte_order + _PLY_TYPES[item_type])
+
+            # read all lists at once if they have the same length as the first one, e.g. triangle meshes
+            n = int(np.frombuffer(body, dtype=count_type, count=1, offset=offset)[0]) if count else 0
+            dtype = np.dtype([('n', count_type), ('items', item_type, (n,))])
+            if count and offset + count * dtype.itemsize <= len(body):
+                values = np.frombuffer(body, dtype=dtype, count=count, offset=offset)
+                if np.all(values['n'] == n):
+                    offset += count * dtype.itemsize
+                    data[name] = {list_name: values['items'].astype(np.int64)}
+                    continue
+
+            lists = []
+            for _ in range(count):
+                n = int(np.frombuffer(body, dtype=count_type, count=1, offset=offset)[0])
+                offset += count_type.itemsize
+                lists.append(np.frombuffer(body, dtype=item_type, count=n, offset=offset).astype(np.int64))
+                offset += n * item_type.itemsize
+            data[name] = {list_name: lists}
+        else:
+            raise ValueError(f'Unsupported PLY element: {name}')
+    return data
+
+def read_obj(path) -> (np.ndarray, np.ndarray, np.ndarray):
+    """
+    Read the vertices, vertex normals and faces of a Wavefront OBJ file. Normals of meshes are computed from the
+    faces, the vn lines of point clouds are used if there is one per vertex
+    :return: (N, 3) points, (N, 3) normals or None, and (M, 3) triangle indices or None
+    """
+    vertices, normals, faces = [], [], []
+    with open(path, 'r') as fp:
+        for line in fp:
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == 'v':
+                vertices.append(words[1:4])
+            elif words[0] == 'vn':
+                normals.append(words[1:4])
+            elif words[0] == 'f':
+                # v, v/vt, v//vn or v/vt/vn, 1-based or negative relative to the end
+                indices = np.array([int(word.split('/')[0]) for word in words[1:]], dtype=np.int64)
+                faces.append(np.where(indices < 0, len(vertices) + indices, indices - 1))
+
+    points = np.array(vertices, dtype=np.float64).reshape(-1, 3)
+    normals = np.array(normals, dtype=np.float64).reshape(-1, 3) if len(normals) == len(points) and not faces else None
+    return points, normals, _triangulate(faces) if faces else None
+
+def read_xyz(path) -> (np.ndarray, np.ndarray, None):
+    """
+    Read a text point cloud with x y z, or x y z nx ny nz, per line
+    """
+    values = np.loadtxt(path, ndmin=2)
+    return values[:, :3], values[:, 3:6] if values.shape[1] >= 6 else None, None
+
+def read_npy(path) -> (np.ndarray, np.ndarray, None):
+    """
+    Read an (N, 3) array of points, or an (N, 6) array of points and normals
+    """
+    values = np.load(path).astype(np.float64)
+    if values.ndim != 2 or values.shape[1] not in {3, 6}:
+        raise ValueError(f'Expected an (N, 3) or (N, 6) array in {path}, got {values.shape}')
+    return values[:, :3], values[:, 3:] if values.shape[1] == 6 else None, None
+
+def _triangulate(faces) -> np.ndarray:
+    """
+    Split polygons, given as a list of index arrays or an array of equally sized ones, into triangle fans
+    :return: (M, 3) triangle indices
+    """
+    if isinstance(faces, np.ndarray):
+        # polygons of the same size, split all at once
+        return np.concatenate([faces[:, [0, i, i + 1]] for i in range(1, faces.shape[1] - 1)])
+
+    triangles = [np.column_stack((np.full(len(face) - 2, face[0]), face[1:-1], face[2:])) for face in faces
+                 if len(face) >= 3]
+    return np.concatenate(triangles) if triangles else np.zeros((0, 3), dtype=np.int64)
+
+def face_vertex_normals(points: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """
+    Vertex normals as the area weighted average of the normals of the adjacent triangles
+    :return: (N, 3) unit normals, zero for vertices without faces
+    """
+    a, b, c = points[faces[:, 0]], points[faces[:, 1]], points[faces[:, 2]]
+    face_normals = np.cross(b - a, c - a)
+
+    normals = np.zeros_like(points)
+    for corner in range(3):
+        np.add.at(normals, faces[:, corner], face_normals)
+    return normals / np.maximum(np.linalg.norm(normals, axis=1), 1e-12)[:, None]
+
+def estimate_normals(points: np.ndarray, k=NORMAL_NEIGHBORS, center: np.ndarray = None) -> np.ndarray:
+    """
+    Estimate the normals of a point cloud as the direction of least variance of each point's k nearest neighbors.
+    Normals are oriented away from the centroid of the points, which is right for closed, roughly convex scans
+    :param center: point the normals are oriented away from, the centroid of the points if None
+    :return: (N, 3) unit normals
+    """
+    k = min(k, len(points))
+    neighbors, _ = KDTree(points).query_knn(points, k)
+    offsets = points[neighbors] - points[neighbors].mean(axis=1)[:, None, :]
+
+    # eigenvectors of all (3, 3) covariance matrices at once, in ascending order of eigenvalues
+    _, eigenvectors = np.linalg.eigh(np.einsum('nki,nkj->nij', offsets, offsets))
+    normals = eigenvectors[:, :, 0]
+
+    center = points.mean(axis=0) if center is None else center
+    inward = np.einsum('ij,ij->i', normals, points - center) < 0
+    normals[inward] *= -1
+    return normals
@@ -302,24 +302,15 @@ def to_vxvyvz(mesh: BMesh, dims: list[int]) -> list[np.ndarray]:
     :param dims: the set of dimensions to convert, e.g [0, 1, 2] for full representation
     """
 
-    vs = [[] for _ in dims]
-
-    for v in mesh.verts:
-        for d_i, _ in enumerate(dims):
-            vs[d_i].append(v.co[d_i])
-
-    for i, _ in enumerate(vs):
-        vs[i] = np.array(vs[i])
-
-    return vs
+    positions = bmesh_positions(mesh)
+    return [np.ascontiguousarray(positions[:, dim]) for dim in dims]
 
 def set_vs(bm: BMesh, vs: list[np.ndarray], dims: list[int]) -> BMesh:
     """
     Set the mesh to the provided vx, vy, vz
     """
 
-    for v_i, v in enumerate(bm.verts):
-
-        # set each dimension of v
-        for d_i, dim in enumerate(dims):
-            v.co[dim] = vs[d_i][v_i]
+    positions = bmesh_positions(bm)
+    for d_i, dim in enumerate(dims):
+        positions[:, dim] = np.ravel(vs[d_i])
+    set_bmesh_positions(bm, positions)
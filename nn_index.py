@@ -0,0 +1,331 @@
+import json
+import math
+import os
+import pathlib
+import platform
+import time
+
+import numpy as np
+
+try:
+    from .kd_tree import KDTree, brute_force_knn, squared_distances
+    from .voxel_grid import VoxelGridIndex
+except ImportError:
+    from kd_tree import KDTree, brute_force_knn, squared_distances
+    from voxel_grid import VoxelGridIndex
+
+# memory brute force queries may use at once. Each (query, point) pair holds two 8 byte values: its distance, which
+# is computed in place, and an index when selecting the nearest points
+BRUTE_FORCE_MAX_BYTES = 64 << 20
+BRUTE_FORCE_BYTES_PER_PAIR = 16
+
+BACKENDS = ['BRUTE_FORCE', 'KD_TREE', 'VOXEL_GRID']
+
+# point and query counts the backends are timed with when calibrating
+CALIBRATION_POINTS = [1000, 4000, 16000, 64000]
+CALIBRATION_QUERIES = [100, 1000]
+
+# brute force is only timed on problems with at most this many (query, point) pairs, to keep calibration short
+CALIBRATION_MAX_PAIRS = 16_000_000
+
+# bump to invalidate cached calibrations when the cost model changes
+CALIBRATION_VERSION = 1
+
+DEFAULT_CALIBRATION_PATH = (pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache'))
+                            / 'geometric-data-processing' / 'nn_calibration.json')
+
+class BruteForceIndex:
+    """
+    Exhaustive search over an (N, dim) point buffer, with the same query interface as KDTree.
+
+    Distances are computed with matrix products, in chunks of queries whose distance matrices fit into max_bytes.
+    There is no build cost, which makes this the fastest index for few points or few queries.
+    """
+
+    def __init__(self, points, dim=3, max_bytes=BRUTE_FORCE_MAX_BYTES):
+        """
+        :param points: (N, dim) array of points
+        :param dim: dimensionality of the points
+        :param max_bytes: upper bound on the memory used by the distance matrix chunks of a query
+        """
+        self.dim = dim
+        self.max_bytes = max_bytes
+        self._points = np.asarray(points, dtype=np.float64).reshape(-1, dim)
+        self._points_sq = np.sum(self._points ** 2, axis=1)
+
+    # flat arrays that make up the index
+    _ARRAYS = ['_points', '_points_sq']
+
+    @classmethod
+    def _from_arrays(cls, arrays: dict[str, np.ndarray], dim: int, max_bytes: int) -> 'BruteForceIndex':
+        """
+        Wrap the arrays of an already built index, e.g. views of shared memory, into an index
+        """
+        index = cls.__new__(cls)
+        index.dim = dim
+        index.max_bytes = max_bytes
+        for name in cls._ARRAYS:
+            setattr(index, name, arrays[name])
+        return index
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def _max_pairs(self) -> int:
+        return max(1, self.max_bytes // BRUTE_FORCE_BYTES_PER_PAIR)
+
+    def query_knn(self, points, k: int, eps=0.0) -> (np.ndarray, np.ndarray):
+        """
+        Find the k nearest neighbors of many query points at once
+        :param points: (Q, dim) array of query points
+        :param k: number of neighbors per query
+        :param eps: ignored, brute force search is always exact
+        :return: (Q, k) indices into the point buffer and (Q, k) euclidean distances, sorted by distance.
+        If there are fewer than k points, missing neighbors have index -1 and distance inf
+        """
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+        indices, d2 = brute_force_knn(queries, self._points, k, self._max_pairs, self._points_sq)
+        return indices, np.sqrt(d2)
+
+    def query_batch(self, points, eps=0.0) -> (np.ndarray, np.ndarray):
+        """
+        Find the nearest neighbor of many query points at once
+        :return: (Q,) indices of the nearest points in the point buffer, and (Q,) euclidean distances to them
+        """
+        indices, distances = self.query_knn(points, k=1, eps=eps)
+        return indices[:, 0], distances[:, 0]
+
+    def query_radius(self, points, r: float) -> (list[np.ndarray], list[np.ndarray]):
+        """
+        Find all points within distance r of many query points at once
+        :return: for each query, an array of indices into the point buffer and an array of euclidean
+        distances, sorted by distance
+        """
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+
+        indices, distances = [], []
+        chunk = max(1, self._max_pairs // max(len(self._points), 1))
+        for lo in range(0, len(queries), chunk):
+            d2 = squared_distances(queries[lo:lo + chunk], self._points, self._points_sq)
+            for row in d2:
+                inside = np.flatnonzero(row <= r * r)
+                order = np.argsort(row[inside], kind='stable')
+                indices.append(inside[order])
+                distances.append(np.sqrt(row[inside[order]]))
+        return indices, distances
+
+    def get_nearest_neighbor(self, point) -> (np.ndarray, float):
+        indices, distances = self.query_batch(point)
+        if indices[0] < 0:
+            return None, np.inf
+        return self._points[indices[0]], distances[0]
+
+def _features(backend: str, n_points: int, n_queries: int) -> (list[float], list[float]):
+    """
+    Terms of the cost model of a backend, whose build and query times are linear combinations of them
+    :return: build terms and query terms
+    """
+    log_n = math.log2(max(n_points, 2))
+    if backend == 'BRUTE_FORCE':
+        return [1.0, n_points], [1.0, n_queries, n_points * n_queries]
+    elif backend == 'KD_TREE':
+        return [1.0, n_points * log_n], [1.0, n_queries * log_n]
+    elif backend == 'VOXEL_GRID':
+        return [1.0, n_points], [1.0, n_queries]
+    else:
+        raise ValueError(f'Unknown nearest neighbor backend {backend}')
+
+def _fit(features: list[list[float]], times: list[float]) -> list[float]:
+    """
+    Fit non-negative coefficients of a linear cost model, minimizing relative errors. Terms that get negative
+    coefficients are dropped and the rest is fitted again.
+    """
+    a = np.array(features) / np.array(times)[:, None]
+    b = np.ones(len(times))
+
+    active = np.ones(a.shape[1], dtype=bool)
+    coefficients = np.zeros(a.shape[1])
+    while np.any(active):
+        solution = np.linalg.lstsq(a[:, active], b, rcond=None)[0]
+        if np.all(solution >= 0):
+            coefficients[active] = solution
+            break
+        active[np.flatnonzero(active)[solution < 0]] = False
+    return coefficients.tolist()
+
+def _build(backend: str, points: np.ndarray):
+    if backend == 'BRUTE_FORCE':
+        return BruteForceIndex(points)
+    elif backend == 'KD_TREE':
+        return KDTree(points)
+    return VoxelGridIndex(points)
+
+def _query(backend: str, index, queries: np.ndarray):
+    if backend == 'KD_TREE':
+        return index.query_batch(queries, morton=True)
+    return index.query_batch(queries)
+
+def _best_time(fun, repeats: int) -> (float, object):
+    """
+    :return: shortest time of repeated calls of fun, and the result of the last call
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+def calibrate(repeats=2, seed=0) -> dict:
+    """
+    Time building and querying every backend on sphere samples of several sizes, and fit their cost models
+    :return: per backend, coefficients of the build and query cost models
+    """
+    rng = np.random.default_rng(seed)
+    samples = {backend: ([], [], [], []) for backend in BACKENDS}
+
+    for n_points in CALIBRATION_POINTS:
+        points = rng.normal(size=(n_points, 3))
+        points /= np.linalg.norm(points, axis=1)[:, None]
+
+        for backend in BACKENDS:
+            build_features, query_features, build_times, query_times = samples[backend]
+
+            # the index is built once per point count, and queried with each query count
+            build_time, index = _best_time(lambda: _build(backend, points), repeats)
+            build_features.append(_features(backend, n_points, 0)[0])
+            build_times.append(build_time)
+
+            for n_queries in CALIBRATION_QUERIES:
+                if backend == 'BRUTE_FORCE' and n_points * n_queries > CALIBRATION_MAX_PAIRS:
+                    continue
+
+                # queries at distances from the surface spanning both roughly and closely aligned objects
+                offsets = rng.normal(size=(n_queries, 3)) * 10 ** rng.uniform(-3, -1, (n_queries, 1))
+                queries = points[rng.integers(n_points, size=n_queries)] + offsets
+
+                query_features.append(_features(backend, n_points, n_queries)[1])
+                query_times.append(_best_time(lambda: _query(backend, index, queries), repeats)[0])
+
+    return {backend: {'build': _fit(build_features, build_times), 'query': _fit(query_features, query_times)}
+            for backend, (build_features, query_features, build_times, query_times) in samples.items()}
+
+def _machine_key() -> dict:
+    return {'version': CALIBRATION_VERSION, 'node': platform.node(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count(), 'numpy': np.__version__}
+
+# calibrations loaded in this process, by path
+_calibrations = {}
+
+def load_calibration(path=None) -> dict:
+    """
+    Load the calibration of this machine from a json file, or calibrate and save it there if the file is missing
+    or was written on another machine
+    :param path: calibration file, DEFAULT_CALIBRATION_PATH if None
+    """
+    path = pathlib.Path(path) if path is not None else DEFAULT_CALIBRATION_PATH
+    if path in _calibrations:
+        return _calibrations[path]
+
+    key = _machine_key()
+    try:
+        with open(path, 'r') as fp:
+            saved = json.load(fp)
+        if saved['key'] == key:
+            _calibrations[path] = saved['coefficients']
+            return saved['coefficients']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    coefficients = calibrate()
+    _calibrations[path] = coefficients
+
+    # write through a temporary file, so that concurrent processes never read a partial calibration
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump({'key': key, 'coefficients': coefficients}, fp, indent=2)
+        os.replace(tmp, path)
+    except OSError:
+        # the calibration is still used in this process
+        pass
+
+    return coefficients
+
+def estimate_cost(calibration: dict, backend: str, n_points: int, n_queries: int, n_batches=1) -> float:
+    """
+    Estimated seconds to build a backend and answer n_batches batches of n_queries queries with it
+    """
+    build, query = _features(backend, n_points, n_queries)
+    coefficients = calibration[backend]
+    return (float(np.dot(coefficients['build'], build))
+            + n_batches * float(np.dot(coefficients['query'], query)))
+
+def select_backend(n_points: int, n_queries: int, n_batches=1, dim=3, calibration=None) -> str:
+    """
+    Choose the fastest backend for a problem size
+    :param n_points: number of indexed points
+    :param n_queries: number of queries per batch
+    :param n_batches: number of query batches answered with the same index
+    :param dim: dimensionality of the points. Voxel grids are only considered in 3 dimensions
+    :param calibration: cost model coefficients, as returned by calibrate. If None, the cached calibration of this
+    machine is used
+    """
+    if calibration is None:
+        calibration = load_calibration()
+
+    candidates = BACKENDS if dim == 3 else ['BRUTE_FORCE', 'KD_TREE']
+    return min(candidates, key=lambda backend: estimate_cost(calibration, backend, n_points, n_queries, n_batches))
+
+class AdaptiveIndex:
+    """
+    Nearest neighbor index that picks brute force, a KDTree or a voxel grid depending on the problem size, based on
+    a calibration of this machine. Has the same query interface as KDTree.
+    """
+
+    def __init__(self, points, n_queries: int, n_batches=1, dim=3, workers=1, calibration=None, build_kd_tree=None):
+        """
+        :param points: (N, dim) array of points
+        :param n_queries: expected number of queries per batch
+        :param n_batches: expected number of query batches
+        :param dim: dimensionality of the points
+        :param workers: number of threads and processes used to build and query a KDTree
+        :param calibration: cost model coefficients, see select_backend
+        :param build_kd_tree: optional function (points) -> KDTree, e.g. to reuse trees from a KDTreeCache
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, dim)
+        self.dim = dim
+        self.backend = select_backend(len(points), n_queries, n_batches, dim, calibration)
+
+        self._query_kwargs = {}
+        if self.backend == 'BRUTE_FORCE':
+            self.index = BruteForceIndex(points, dim=dim)
+        elif self.backend == 'KD_TREE':
+            self.index = build_kd_tree(points) if build_kd_tree else KDTree(points, dim=dim, workers=workers)
+            self._query_kwargs = {'workers': workers, 'morton': True}
+        else:
+            self.index = VoxelGridIndex(points, dim=dim)
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        """
+        Stop the worker processes of parallel KDTree queries, if any were started
+        """
+        if isinstance(self.index, KDTree):
+            self.index.close()
+
+    def query_knn(self, points, k: int, eps=0.0) -> (np.ndarray, np.ndarray):
+        return self.index.query_knn(points, k, eps=eps, **self._query_kwargs)
+
+    def query_batch(self, points, eps=0.0) -> (np.ndarray, np.ndarray):
+        return self.index.query_batch(points, eps=eps, **self._query_kwargs)
+
+    def query_radius(self, points, r: float) -> (list[np.ndarray], list[np.ndarray]):
+        return self.index.query_radius(points, r)
+
+    def get_nearest_neighbor(self, point):
+        return self.index.get_nearest_neighbor(point)
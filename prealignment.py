@@ -0,0 +1,204 @@
+import numpy as np
+
+try:
+    from .kd_tree import KDTree
+    from .voxel_grid import VoxelGridIndex, voxel_downsample
+except ImportError:
+    from kd_tree import KDTree
+    from voxel_grid import VoxelGridIndex, voxel_downsample
+
+# about this many points of each object are used to find the initial alignment
+PREALIGN_POINTS = 1024
+
+# neighbors of the scales at which local shape is described, for feature matching
+FEATURE_SCALES = (8, 16, 32)
+
+# random three point correspondences tried by feature matching
+FEATURE_HYPOTHESES = 256
+
+# moving points that hypotheses are scored on
+SCORE_POINTS = 256
+
+# best hypotheses that are refined by a few iterations of point to point ICP on the downsampled points, before the
+# best of them is chosen
+REFINED_HYPOTHESES = 8
+REFINE_ITERATIONS = 10
+
+# distances are truncated at this many voxels when scoring, so that parts without overlap weigh the same in all
+# hypotheses
+SCORE_TRUNCATION = 3
+
+# sign flips of the principal axes that keep a frame right-handed: none, and half turns around each axis
+_AXIS_FLIPS = np.array([[1, 1, 1], [1, -1, -1], [-1, 1, -1], [-1, -1, 1]], dtype=np.float64)
+
+def prealign(p_points: np.ndarray, q_points: np.ndarray, features=False, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Find a coarse rigid transformation of the moving points onto the fixed points, to start iterative closest point
+    from. Candidates are the current pose, the alignments of the principal axes of both objects, and optionally
+    transformations estimated from correspondences of local shape features. Each candidate is scored by the
+    truncated distances of the moving points to their nearest fixed points, and the best one is returned.
+    Both objects are downsampled to about PREALIGN_POINTS points first, so this takes milliseconds
+    :param p_points: (N, 3) world space points of the moving object
+    :param q_points: (M, 3) world space points of the fixed object
+    :param features: also try transformations from feature correspondences, which unlike principal axes are not
+    misled by partial overlap, at the cost of some more time
+    :return: 4x4 matrix of the transformation, to be composed before the moving object's world matrix
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+
+    # downsample both objects with the same voxels, so that their neighborhoods have the same scale
+    q_sample = np.asarray(q_points[::max(1, len(q_points) // (16 * PREALIGN_POINTS))], dtype=np.float64)
+    p_sample = np.asarray(p_points[::max(1, len(p_points) // (16 * PREALIGN_POINTS))], dtype=np.float64)
+    cell_size = VoxelGridIndex(q_sample, points_per_cell=max(len(q_sample) / PREALIGN_POINTS, 1)).cell_size
+    q_sample = q_sample[voxel_downsample(q_sample, 1, cell_size)]
+    p_sample = p_sample[voxel_downsample(p_sample, 1, cell_size)]
+    q_tree = KDTree(q_sample)
+
+    candidates = [np.eye(4)[None], pca_hypotheses(p_sample, q_sample)]
+    if features:
+        candidates.append(feature_hypotheses(p_sample, q_sample, q_tree, cell_size, rng))
+    candidates = np.concatenate(candidates)
+
+    score_points = p_sample[rng.choice(len(p_sample), min(SCORE_POINTS, len(p_sample)), replace=False)]
+    truncation = SCORE_TRUNCATION * cell_size
+    scores = score_hypotheses(candidates, score_points, q_tree, truncation)
+
+    # hypotheses close to the right one may still score worse than a wrong one, before they are refined
+    best = candidates[np.argsort(scores)[:REFINED_HYPOTHESES]]
+    best = refine_hypotheses(best, score_points, q_sample, q_tree, truncation)
+    return best[np.argmin(score_hypotheses(best, score_points, q_tree, truncation))]
+
+def principal_frame(points: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Centroid and principal axes of points. The sign of each axis is chosen so that the third moment of the points
+    along it is positive, i.e. the axis points to the side the points are skewed towards, which makes the frame
+    independent of the orientation of the points. The frame is kept right-handed by flipping the axis whose skewness
+    is least pronounced, and so least reliable
+    :return: (3,) centroid and (3, 3) axes as columns, in descending order of variance
+    """
+    centroid = points.mean(axis=0)
+    centered = points - centroid
+    eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered / len(points))
+    axes = eigenvectors[:, ::-1]
+
+    # skewness along each axis, the third moment normalized by the variance
+    skewness = np.mean((centered @ axes) ** 3, axis=0) / np.maximum(eigenvalues[::-1], 1e-24) ** 1.5
+    axes = axes * np.where(skewness < 0, -1.0, 1.0)
+    if np.linalg.det(axes) < 0:
+        axes[:, np.argmin(np.abs(skewness))] *= -1
+    return centroid, axes
+
+def pca_hypotheses(p_points: np.ndarray, q_points: np.ndarray) -> np.ndarray:
+    """
+    Transformations that map the principal frame of the moving points onto that of the fixed points: the one of the
+    disambiguated frames first, then the ones with the other right-handed sign choices of the axes, in case the
+    skewness of symmetric objects picked the wrong signs
+    :return: (4, 4, 4) matrices
+    """
+    p_centroid, p_axes = principal_frame(p_points)
+    q_centroid, q_axes = principal_frame(q_points)
+
+    rotations = np.einsum('ij,hj,kj->hik', q_axes, _AXIS_FLIPS, p_axes)
+    return _matrices(rotations, q_centroid - rotations @ p_centroid)
+
+def local_features(points: np.ndarray, tree: KDTree) -> np.ndarray:
+    """
+    Rotation invariant description of the shape around each point: the fractions of the variance of its neighbors
+    along the second and third principal axes, at each of FEATURE_SCALES
+    :return: (N, 2 * len(FEATURE_SCALES)) features
+    """
+    k_max = min(max(FEATURE_SCALES), len(points))
+    neighbors, _ = tree.query_knn(points, k_max)
+
+    features = []
+    for k in FEATURE_SCALES:
+        local = points[neighbors[:, :min(k, k_max)]]
+        offsets = local - local.mean(axis=1)[:, None, :]
+        eigenvalues = np.linalg.eigvalsh(np.einsum('nki,nkj->nij', offsets, offsets))
+        fractions = eigenvalues / np.maximum(eigenvalues.sum(axis=1), 1e-24)[:, None]
+        features.append(fractions[:, :2])
+    return np.hstack(features)
+
+def feature_hypotheses(p_points: np.ndarray, q_points: np.ndarray, q_tree: KDTree, cell_size: float,
+                       rng: np.random.Generator, n_hypotheses=FEATURE_HYPOTHESES) -> np.ndarray:
+    """
+    Transformations estimated from random triples of feature correspondences: pairs of moving and fixed points that
+    are each other's nearest neighbors in feature space. Triples whose triangles differ in shape can't be related by
+    a rigid transformation, and are dropped
+    :return: (H, 4, 4) matrices, at most n_hypotheses
+    """
+    p_features = local_features(p_points, KDTree(p_points))
+    q_features = local_features(q_points, q_tree)
+    dim = p_features.shape[1]
+
+    forward, _ = KDTree(q_features, dim=dim).query_batch(p_features)
+    backward, _ = KDTree(p_features, dim=dim).query_batch(q_features)
+    mutual = np.flatnonzero(backward[forward] == np.arange(len(p_points)))
+    if len(mutual) < 3:
+        return np.zeros((0, 4, 4))
+
+    picks = mutual[rng.integers(len(mutual), size=(n_hypotheses, 3))]
+    ps, qs = p_points[picks], q_points[forward[picks]]
+
+    # side lengths of the triangles, which a rigid transformation preserves
+    p_sides = np.linalg.norm(ps - np.roll(ps, 1, axis=1), axis=2)
+    q_sides = np.linalg.norm(qs - np.roll(qs, 1, axis=1), axis=2)
+    valid = np.all((p_sides > 2 * cell_size) & (np.abs(p_sides - q_sides) <= np.maximum(0.1 * p_sides, cell_size)),
+                   axis=1)
+    if not np.any(valid):
+        return np.zeros((0, 4, 4))
+
+    return _matrices(*kabsch(ps[valid], qs[valid]))
+
+def kabsch(ps: np.ndarray, qs: np.ndarray, weights: np.ndarray = None) -> (np.ndarray, np.ndarray):
+    """
+    Least squares rigid transformations of many point sets at once
+    :param ps: (H, K, 3) moving points of each set
+    :param qs: (H, K, 3) corresponding fixed points
+    :param weights: (H, K, 1) weights of the pairs, equal if None
+    :return: (H, 3, 3) rotations and (H, 3) translations
+    """
+    weights = np.ones(ps.shape[:2] + (1,)) if weights is None else weights
+    weights = weights / weights.sum(axis=1)[:, None]
+    p_mean, q_mean = np.sum(weights * ps, axis=1), np.sum(weights * qs, axis=1)
+    covariances = np.einsum('hki,hkj->hij', weights * (ps - p_mean[:, None, :]), qs - q_mean[:, None, :])
+    u, _, vt = np.linalg.svd(covariances)
+
+    # avoid reflections
+    d = np.sign(np.linalg.det(np.einsum('hji,hkj->hik', vt, u)))
+    d[d == 0] = 1
+    rotations = np.einsum('hji,hj,hkj->hik', vt, np.column_stack((np.ones_like(d), np.ones_like(d), d)), u)
+    return rotations, q_mean - np.einsum('hij,hj->hi', rotations, p_mean)
+
+def score_hypotheses(matrices: np.ndarray, p_points: np.ndarray, q_tree: KDTree, truncation: float) -> np.ndarray:
+    """
+    Mean distance of the transformed moving points to their nearest fixed points, each truncated at truncation
+    :return: (H,) scores, lower is better
+    """
+    moved = np.einsum('hij,nj->hni', matrices[:, :3, :3], p_points) + matrices[:, None, :3, 3]
+    _, distances = q_tree.query_batch(moved.reshape(-1, 3))
+    return np.minimum(distances, truncation).reshape(len(matrices), -1).mean(axis=1)
+
+def refine_hypotheses(matrices: np.ndarray, p_points: np.ndarray, q_points: np.ndarray, q_tree: KDTree,
+                      truncation: float, iterations=REFINE_ITERATIONS) -> np.ndarray:
+    """
+    Refine many transformations at once by iterations of point to point ICP, with the pairs of each that are farther
+    apart than truncation given no weight
+    :return: (H, 4, 4) refined matrices
+    """
+    for _ in range(iterations):
+        moved = np.einsum('hij,nj->hni', matrices[:, :3, :3], p_points) + matrices[:, None, :3, 3]
+        indices, distances = q_tree.query_batch(moved.reshape(-1, 3))
+        weights = (distances <= truncation).reshape(len(matrices), -1, 1).astype(np.float64)
+        if not np.all(weights.sum(axis=1) >= 3):
+            break
+
+        rotations, translations = kabsch(moved, q_points[indices].reshape(moved.shape), weights)
+        matrices = np.einsum('hij,hjk->hik', _matrices(rotations, translations), matrices)
+    return matrices
+
+def _matrices(rotations: np.ndarray, translations: np.ndarray) -> np.ndarray:
+    matrices = np.tile(np.eye(4), (len(rotations), 1, 1))
+    matrices[:, :3, :3] = rotations
+    matrices[:, :3, 3] = translations
+    return matrices
@@ -2,6 +2,7 @@ import numpy as np
 import scipy.sparse as sp
 from bmesh.types import BMesh
 
+from .bpyutil import set_bmesh_positions
 from .meshutil import mesh_laplacian, to_vxvyvz
 
 def iterative_laplace_smoothing(bm: BMesh, n_iters: int, step_size: float, laplacian=None) -> (
@@ -40,9 +41,6 @@ def implicit_laplace_smoothing(bm: BMesh, n_iters: int, step_size: float):
         vz = lhs_factorized.solve(vz)
 
         # set vertex coordinates
-        for v_i, v in enumerate(bm.verts):
-            v.co.x = vx[v_i]
-            v.co.y = vy[v_i]
-            v.co.z = vz[v_i]
+        set_bmesh_positions(bm, np.column_stack((vx, vy, vz)))
 
     return vx, vy, vz
@@ -1,61 +1,214 @@
-import numpy as np
-from matplotlib import pyplot as plt
+"""
+Headless KDTree benchmark suite.
 
-from timer import Timer
+Sweeps point counts, query counts, point distributions and leaf sizes, and reports build time, query throughput and
+peak memory of kd_tree.KDTree, next to a chunked brute force search that is also used to check the tree's results.
 
-plt.switch_backend('TkAgg')
+usage:
+python test/benchmark_kdtree.py --output results.json
+python test/benchmark_kdtree.py --output new.json --compare results.json
+"""
 
-from kd_tree import KDTree
+import argparse
+import json
+import pathlib
+import platform
+import sys
+import tracemalloc
 
-def rand_point(dim=3):
-    return np.random.uniform(0, 1, dim)
+import numpy as np
 
-def distance(p1, p2):
-    return np.linalg.norm(p1 - p2)
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
 
-def get_nearest_brute(points, p):
-    nearest = min(points, key=lambda p: distance(p, points))
-    return nearest
+from kd_tree import KDTree, brute_force_knn
+from timer import Timer
 
-def benchmark_kdtree():
+# brute force is only run on as many queries as fit in this many (query, point) pairs, its throughput is
+# measured on those
+MAX_BRUTE_FORCE_PAIRS = 2 * 10 ** 8
+
+# metrics, and whether a larger value is better
+METRICS = {
+    'build_s': False,
+    'build_peak_mb': False,
+    'query_per_s': True,
+    'morton_query_per_s': True,
+    'query_peak_mb': False,
+}
+
+def uniform_points(rng: np.random.Generator, n: int) -> np.ndarray:
+    return rng.uniform(-1, 1, (n, 3))
+
+def surface_points(rng: np.random.Generator, n: int) -> np.ndarray:
+    # samples of a torus, like the vertices of a scanned surface
+    u, v = rng.uniform(0, 2 * np.pi, (2, n))
+    r_major, r_minor = 1.0, 0.3
+    return np.stack(((r_major + r_minor * np.cos(v)) * np.cos(u),
+                     (r_major + r_minor * np.cos(v)) * np.sin(u),
+                     r_minor * np.sin(v)), axis=1)
+
+def clustered_points(rng: np.random.Generator, n: int) -> np.ndarray:
+    centers = rng.uniform(-1, 1, (20, 3))
+    return centers[rng.integers(len(centers), size=n)] + rng.normal(scale=0.02, size=(n, 3))
+
+DISTRIBUTIONS = {
+    'uniform': uniform_points,
+    'surface': surface_points,
+    'clustered': clustered_points,
+}
+
+def make_queries(rng: np.random.Generator, points: np.ndarray, n: int) -> np.ndarray:
+    # queries near the points, like the samples of a roughly aligned moving object in ICP
+    scale = 0.01 * np.linalg.norm(np.ptp(points, axis=0))
+    return points[rng.integers(len(points), size=n)] + rng.normal(scale=scale, size=(n, 3))
+
+def peak_memory_mb(fun) -> (object, float):
+    """
+    Run fun, and return its result and the peak memory allocated while it ran
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = fun()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak / 2 ** 20
+
+def best_time(fun, repeats: int) -> float:
     t = Timer()
-    t.logging_enabled = True
-
-    # generate random points
-    dim = 3
-    points = [rand_point(dim) for x in range(1000)]
-
-    t.start()
-    kd_tree = KDTree(points,
-                     dist_fun=distance,
-                     index_fun=lambda p, ax: p[ax])
-
-    t.stop('tree construction')
-
-    n_query_points = [1, 5, 10, 20, 50, 100, 200, 400, 800, 1000]
-
-    times_naive = []
-    times_kdtree = []
-    for num_query in n_query_points:
-        query_points = [rand_point(dim) for x in range(num_query)]
-
-        t.start()
-        for q in query_points:
-            get_nearest_brute(points, q)
-        times_naive.append(t.stop(f'naive q={num_query}'))
+    t.logging_enabled = False
 
+    times = []
+    for _ in range(repeats):
         t.start()
-        for q in query_points:
-            kd_tree.get_nearest_neighbor(q)
-        times_kdtree.append(t.stop(f'kdtree q={num_query}'))
-
-    plt.plot(n_query_points, times_naive, marker='.', label='brute force')
-    plt.plot(n_query_points, times_kdtree, marker='.', label='KDtree')
-    plt.legend()
-    plt.xlabel('num query points')
-    plt.ylabel('time (seconds)')
-    plt.yscale('log')
-    plt.show()
+        fun()
+        times.append(t.stop())
+    return min(times)
+
+def run_case(points: np.ndarray, queries: np.ndarray, leaf_size: int, repeats: int) -> dict:
+    build_s = best_time(lambda: KDTree(points, leaf_size=leaf_size), repeats)
+    tree, build_peak_mb = peak_memory_mb(lambda: KDTree(points, leaf_size=leaf_size))
+
+    query_s = best_time(lambda: tree.query_batch(queries), repeats)
+    (_, distances), query_peak_mb = peak_memory_mb(lambda: tree.query_batch(queries))
+    morton_query_s = best_time(lambda: tree.query_batch(queries, morton=True), repeats)
+
+    # brute force on a subset of the queries, to check results and compare throughput
+    n_brute = max(1, min(len(queries), MAX_BRUTE_FORCE_PAIRS // len(points)))
+    brute_s = best_time(lambda: brute_force_knn(queries[:n_brute], points, 1), 1)
+    _, brute_d2 = brute_force_knn(queries[:n_brute], points, 1)
+    correct = bool(np.allclose(distances[:n_brute], np.sqrt(brute_d2[:, 0]), atol=1e-7))
+
+    return {
+        'build_s': build_s,
+        'build_peak_mb': build_peak_mb,
+        'query_per_s': len(queries) / query_s,
+        'query_peak_mb': query_peak_mb,
+        'morton_query_per_s': len(queries) / morton_query_s,
+        'brute_force_query_per_s': n_brute / brute_s,
+        'correct': correct,
+    }
+
+def case_key(case: dict) -> str:
+    return f'{case["distribution"]}/n={case["n_points"]}/q={case["n_queries"]}/leaf={case["leaf_size"]}'
+
+def run_benchmarks(args) -> list[dict]:
+    results = []
+    for distribution in args.distributions:
+        for n_points in args.points:
+            # same seed for each configuration, so that runs are reproducible and comparable
+            rng = np.random.default_rng(args.seed)
+            points = DISTRIBUTIONS[distribution](rng, n_points)
+
+            for n_queries in args.queries:
+                queries = make_queries(rng, points, n_queries)
+
+                for leaf_size in args.leaf_sizes:
+                    case = {'distribution': distribution, 'n_points': n_points, 'n_queries': n_queries,
+                            'leaf_size': leaf_size}
+                    case.update(run_case(points, queries, leaf_size, args.repeats))
+                    results.append(case)
+
+                    print(f'{case_key(case):45s} build {case["build_s"]:8.4f}s '
+                          f'{case["build_peak_mb"]:8.1f}MB | query {case["query_per_s"]:10.0f}/s '
+                          f'{case["query_peak_mb"]:8.1f}MB | morton {case["morton_query_per_s"]:10.0f}/s '
+                          f'| brute force {case["brute_force_query_per_s"]:10.0f}/s'
+                          f'{"" if case["correct"] else " | WRONG RESULTS"}')
+    return results
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    :return: descriptions of all metrics that regressed by more than tolerance with respect to the baseline
+    """
+    baseline = {case_key(case): case for case in baseline}
+
+    regressions = []
+    for case in results:
+        key = case_key(case)
+        if not case['correct']:
+            regressions.append(f'{key}: wrong results')
+        if key not in baseline:
+            continue
+
+        for metric, higher_is_better in METRICS.items():
+            if metric not in baseline[key]:
+                continue
+            old, new = baseline[key][metric], case[metric]
+
+            # a zero baseline, e.g. a peak below the resolution of the measurement, leaves nothing to compare to, while
+            # a rate that dropped to zero is the largest regression
+            if old == 0:
+                continue
+            ratio = old / max(new, 1e-12) if higher_is_better else new / old
+            if ratio > 1 + tolerance:
+                regressions.append(f'{key}: {metric} {old:.4g} -> {new:.4g}')
+    return regressions
+
+def parse_list(s: str, type_=int) -> list:
+    return [type_(float(x)) if type_ is int else type_(x) for x in s.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=parse_list, default=[1000, 10000, 100000, 1000000],
+                        help='comma separated point counts, e.g. 1e3,1e6')
+    parser.add_argument('--queries', type=parse_list, default=[1000, 10000], help='comma separated query counts')
+    parser.add_argument('--distributions', type=lambda s: parse_list(s, str), default=list(DISTRIBUTIONS),
+                        help=f'comma separated distributions, out of {",".join(DISTRIBUTIONS)}')
+    parser.add_argument('--leaf-sizes', type=parse_list, default=[16, 64, 128, 256],
+                        help='comma separated leaf sizes')
+    parser.add_argument('--repeats', type=int, default=3, help='timings are the best of this many runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=pathlib.Path, help='write results to this json file')
+    parser.add_argument('--compare', type=pathlib.Path, help='baseline json file to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown or memory growth that counts as a regression')
+    args = parser.parse_args()
+
+    unknown = set(args.distributions) - set(DISTRIBUTIONS)
+    if unknown:
+        parser.error(f'unknown distributions: {", ".join(unknown)}')
+
+    results = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump({
+                'machine': {'platform': platform.platform(), 'processor': platform.processor(),
+                            'python': platform.python_version(), 'numpy': np.__version__},
+                'results': results,
+            }, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)['results']
+
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'no regressions against {args.compare}')
 
 if __name__ == '__main__':
-    benchmark_kdtree()
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark KDTree leaf sizes on the meshes used by the ICP evaluation.
+
+Run inside blender with the evaluation file, to use the fixed and moving objects of its experiment collections:
+blender path/to/evaluation.blend --background --python test/benchmark_leaf_size.py
+
+Or outside blender, on (N, 3) point arrays saved with np.save:
+python test/benchmark_leaf_size.py fixed.npy moving.npy
+"""
+
+import pathlib
+import sys
+
+import numpy as np
+
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+
+from kd_tree import KDTree
+from timer import Timer
+
+LEAF_SIZES = [1, 4, 8, 16, 32, 64, 128, 256, 512]
+N_QUERIES = [1000, 10000]
+N_REPEATS = 3
+
+def world_vertices(obj) -> np.ndarray:
+    verts = np.array([v.co for v in obj.data.vertices])
+    m = np.array(obj.matrix_world)
+    return verts @ m[:3, :3].T + m[:3, 3]
+
+def blender_datasets() -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    import bpy
+
+    datasets = {}
+    for coll in bpy.data.collections['Evaluation'].children:
+        fixed = [o for o in coll.all_objects if 'fixed' in o.name]
+        moving = [o for o in coll.all_objects if 'moving' in o.name]
+        if fixed and moving:
+            datasets[coll.name] = (world_vertices(fixed[0]), world_vertices(moving[0]))
+    return datasets
+
+def file_datasets(fixed_path: str, moving_path: str) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    return {pathlib.Path(fixed_path).stem: (np.load(fixed_path), np.load(moving_path))}
+
+def benchmark_leaf_sizes(fixed: np.ndarray, moving: np.ndarray) -> dict[int, dict]:
+    t = Timer()
+    t.logging_enabled = False
+    rng = np.random.default_rng(0)
+
+    results = {}
+    for leaf_size in LEAF_SIZES:
+        t.start()
+        tree = KDTree(fixed, leaf_size=leaf_size)
+        build_time = t.stop()
+
+        query_times = {}
+        for n_queries in N_QUERIES:
+            # queries are sampled from the moving object, like the ICP matching step
+            queries = moving[rng.choice(len(moving), n_queries)]
+            times = []
+            for _ in range(N_REPEATS):
+                t.start()
+                tree.query_batch(queries)
+                times.append(t.stop())
+            query_times[n_queries] = min(times)
+
+        results[leaf_size] = {'build': build_time, 'query': query_times}
+    return results
+
+def main():
+    args = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else sys.argv[1:]
+    if 'bpy' in sys.modules or not args:
+        datasets = blender_datasets()
+    else:
+        datasets = file_datasets(args[0], args[1])
+
+    for name, (fixed, moving) in datasets.items():
+        print(f'{name}: {len(fixed)} fixed points, {len(moving)} moving points')
+        print('leaf size | build (s) | ' + ' | '.join(f'{q} queries (s)' for q in N_QUERIES))
+
+        results = benchmark_leaf_sizes(fixed, moving)
+        for leaf_size, res in results.items():
+            row = ' | '.join(f'{res["query"][q]:.4f}' for q in N_QUERIES)
+            print(f'{leaf_size:9d} | {res["build"]:.4f} | {row}')
+
+        best = min(results, key=lambda ls: results[ls]['query'][N_QUERIES[0]])
+        print(f'best leaf size for {N_QUERIES[0]} queries: {best}\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from geometry_cache import GeometryCache, nbytes
+from kd_tree import KDTree
+
+class Closeable:
+    def __init__(self, size: int):
+        self.data = np.zeros(size, dtype=np.uint8)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class TestGeometryCache(unittest.TestCase):
+
+    def test_nbytes(self):
+        points = np.zeros((1000, 3))
+        tree = KDTree(points)
+        self.assertGreaterEqual(nbytes(tree), 2 * points.nbytes)
+        # shared arrays are counted once
+        self.assertEqual(nbytes((points, points, {'a': points})), points.nbytes)
+
+    def test_nbytes_mmap(self):
+        points = np.random.uniform(-1, 1, (1000, 3))
+        with tempfile.TemporaryDirectory() as directory:
+            KDTree(points).save(directory)
+            tree = KDTree.load(directory, mmap=True)
+
+            # memory-mapped arrays and views of them are not held in memory
+            self.assertEqual(nbytes(tree), 0)
+            self.assertEqual(nbytes(np.asarray(tree._idx)[::2]), 0)
+            self.assertEqual(nbytes(KDTree.load(directory, mmap=False)), nbytes(KDTree(points)))
+            del tree
+
+    def test_hits_and_misses(self):
+        cache = GeometryCache(max_bytes=1 << 20)
+        builds = []
+
+        def build():
+            builds.append(1)
+            return np.zeros(10)
+
+        first = cache.get_or_build('a', build)
+        second = cache.get_or_build('a', build)
+        self.assertIs(first, second)
+        self.assertTrue(cache.last_hit)
+        self.assertEqual((cache.hits, cache.misses, len(builds)), (1, 1, 1))
+
+        cache.get_or_build('b', build)
+        self.assertFalse(cache.last_hit)
+        self.assertEqual((cache.hits, cache.misses, len(builds)), (1, 2, 2))
+
+    def test_eviction(self):
+        cache = GeometryCache(max_bytes=250)
+        values = {key: Closeable(100) for key in 'abc'}
+
+        cache.get_or_build('a', lambda: values['a'])
+        cache.get_or_build('b', lambda: values['b'])
+        # touch a, so that b is the least recently used
+        cache.get_or_build('a', lambda: values['a'])
+        cache.get_or_build('c', lambda: values['c'])
+
+        self.assertEqual(set(cache._entries), {'a', 'c'})
+        self.assertTrue(values['b'].closed)
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+        # values larger than the whole budget are not cached
+        big = cache.get_or_build('d', lambda: Closeable(1000))
+        self.assertNotIn('d', cache)
+        self.assertFalse(big.closed)
+
+        # shrinking the budget evicts
+        cache.max_bytes = 100
+        cache.evict()
+        self.assertEqual(len(cache), 1)
+
+if __name__ == '__main__':
+    unittest.main()
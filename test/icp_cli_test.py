@@ -0,0 +1,59 @@
+import json
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+import icp_cli
+from shapes import ellipsoid, rotation
+
+class TestICPCLI(unittest.TestCase):
+
+    def test_register_files(self):
+        points, normals = ellipsoid(5000, 0)
+
+        # moving copy, rotated by 0.1 radians around z and translated
+        turn = rotation(0.1)
+        moved = points @ turn.T + [0.03, 0.0, 0.01]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            np.save(tmp / 'fixed.npy', np.hstack((points, normals)))
+            np.savetxt(tmp / 'moving.xyz', np.hstack((moved, normals @ turn.T)))
+
+            # fixed points in memory, and paged in from tiles built on the first run
+            for options in ([], ['--tiles', str(tmp / 'tiles'), '--tile-points', '500'],
+                            ['--tiles', str(tmp / 'tiles'), '--memory-budget', '0.1']):
+                status = icp_cli.main([str(tmp / 'moving.xyz'), str(tmp / 'fixed.npy'), '--point-to-plane',
+                                       '--output', str(tmp / 'result.json'), *options])
+                with open(tmp / 'result.json', 'r') as fp:
+                    output = json.load(fp)
+
+                self.assertEqual(status, 0)
+                self.assertEqual(output['fixed_points'], len(points))
+                result = output['results'][0]
+                self.assertTrue(result['converged'])
+                self.assertEqual(len(result['stats']), result['iterations'])
+
+                # the transform undoes the motion
+                matrix = np.array(result['matrix'])
+                self.assertTrue(np.allclose(moved @ matrix[:3, :3].T + matrix[:3, 3], points, atol=1e-3))
+
+    def test_close_levels_on_error(self):
+        points, normals = ellipsoid(1000, 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = pathlib.Path(tmp)
+            np.save(tmp / 'fixed.npy', np.hstack((points, normals)))
+
+            # the fixed levels are closed even if registration fails
+            with mock.patch('icp_cli.register_batch', side_effect=RuntimeError), \
+                    mock.patch('icp_cli.close_levels') as close_levels:
+                with self.assertRaises(RuntimeError):
+                    icp_cli.main([str(tmp / 'fixed.npy'), str(tmp / 'fixed.npy')])
+            close_levels.assert_called_once()
+
+if __name__ == '__main__':
+    unittest.main()
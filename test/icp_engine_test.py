@@ -0,0 +1,55 @@
+import unittest
+
+import numpy as np
+
+from icp_engine import ICPEngine, register_batch, transform_matrix
+from kd_tree import KDTree
+from shapes import ellipsoid, rotation
+from voxel_grid import VoxelGridIndex
+
+class TestICPEngine(unittest.TestCase):
+
+    def test_register(self):
+        q_points, q_normals = ellipsoid(5000, 0)
+        p_points, p_normals = ellipsoid(5000, 1)
+        start = transform_matrix(rotation(0.2), [0.05, 0.02, 0.0])
+
+        for options in (dict(point_to_plane=True), dict(point_to_plane=True, pyramid_levels=2),
+                        dict(point_to_plane=True, sampling_strategy='STRATIFIED_NORMAL')):
+            engine = ICPEngine(max_points=500, seed=0, **options)
+            fixed_levels = engine.prepare_fixed(q_points, q_normals, 500)
+            converged, iterations, matrix = engine.register(p_points, p_normals, fixed_levels, start)
+
+            self.assertTrue(converged)
+            self.assertTrue(np.allclose(matrix, np.eye(4), atol=0.01))
+
+    def test_register_batch(self):
+        q_points, q_normals = ellipsoid(5000, 0)
+        moving = [(*ellipsoid(2000, i + 1), transform_matrix(rotation(0.1 * i), [0.01 * i, 0.0, 0.0]))
+                  for i in range(3)]
+
+        engine = ICPEngine(max_points=300, seed=0, point_to_plane=True, matching_index='KD_TREE')
+        fixed_levels = engine.prepare_fixed(q_points, q_normals, 300)
+
+        # results don't depend on the number of processes, and the engine's generator is left as it was
+        rng = engine.rng
+        serial = register_batch(engine, moving, fixed_levels, processes=1)
+        self.assertIs(engine.rng, rng)
+        parallel = register_batch(engine, moving, fixed_levels, processes=2)
+        for a, b in zip(serial, parallel):
+            self.assertTrue(a.converged)
+            self.assertEqual(a.iterations, b.iterations)
+            self.assertTrue(np.allclose(a.matrix, b.matrix))
+            self.assertTrue(np.allclose(a.matrix, np.eye(4), atol=0.01))
+
+    def test_matching_index(self):
+        q_points, q_normals = ellipsoid(2000, 0)
+
+        # voxel grids index positions only, normal weighted matching falls back to a kd-tree
+        for distance_strategy, index_class in (('EUCLIDEAN', VoxelGridIndex), ('NORMAL_WEIGHTED', KDTree)):
+            engine = ICPEngine(matching_index='VOXEL_GRID', distance_strategy=distance_strategy, verbose=False)
+            fixed_levels = engine.prepare_fixed(q_points, q_normals, 300)
+            self.assertIsInstance(fixed_levels[0][3], index_class)
+
+if __name__ == '__main__':
+    unittest.main()
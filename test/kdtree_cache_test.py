@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from kd_tree import KDTree
+from kdtree_cache import KDTreeCache
+
+class TestKdTreeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_save_load(self):
+        points = np.random.uniform(-1, 1, (5000, 3))
+        query_points = np.random.uniform(-1, 1, (200, 3))
+
+        kd_tree = KDTree(points, leaf_size=32)
+        kd_tree.save(self.tmp.name)
+        loaded = KDTree.load(self.tmp.name, mmap=True)
+
+        self.assertIsInstance(loaded._points, np.memmap)
+        self.assertIsInstance(loaded._leaf_points, np.memmap)
+        self.assertEqual(loaded.leaf_size, 32)
+        for expected, actual in zip(kd_tree.query_knn(query_points, 3), loaded.query_knn(query_points, 3)):
+            self.assertTrue(np.array_equal(expected, actual))
+
+    def test_hit_and_miss(self):
+        cache = KDTreeCache(self.tmp.name)
+        points = np.random.uniform(-1, 1, (1000, 3))
+
+        cache.get_or_build(points)
+        self.assertFalse(cache.last_hit)
+        cache.get_or_build(points.copy())
+        self.assertTrue(cache.last_hit)
+        cache.get_or_build(points + 1)
+        self.assertFalse(cache.last_hit)
+        self.assertEqual(len(cache.entries()), 2)
+
+    def test_eviction(self):
+        cache = KDTreeCache(self.tmp.name)
+        clouds = [np.random.uniform(-1, 1, (1000, 3)) for _ in range(3)]
+        cache.get_or_build(clouds[0])
+        entry_size = cache.size()
+
+        # room for two entries, the least recently used one is evicted
+        cache.max_bytes = 2 * entry_size
+        cache.get_or_build(clouds[1])
+        cache.get_or_build(clouds[0])
+        cache.get_or_build(clouds[2])
+
+        self.assertEqual(len(cache.entries()), 2)
+        cache.get_or_build(clouds[0])
+        self.assertTrue(cache.last_hit)
+        cache.get_or_build(clouds[1])
+        self.assertFalse(cache.last_hit)
@@ -1,7 +1,10 @@
+import pickle
 import random
 import unittest
+from unittest import mock
 
-from kd_tree import KDTree
+import kd_tree as kd_tree_module
+from kd_tree import DynamicKDTree, KDTree, _WorkerFunction
 
 import numpy as np
 
@@ -32,4 +35,181 @@ class TestKdTtree(unittest.TestCase):
 
             self.assertTrue(np.allclose(closest_kd, closest_naive))
 
+    def test_query_batch(self):
+        points = np.random.uniform(-1, 1, (5000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (500, 3))
 
+        kd_tree = KDTree(points)
+        indices, distances = kd_tree.query_batch(query_points)
+
+        naive_distances = np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+        self.assertTrue(np.array_equal(indices, naive_distances.argmin(axis=1)))
+        self.assertTrue(np.allclose(distances, naive_distances.min(axis=1)))
+
+    def test_query_knn(self):
+        points = np.random.uniform(-1, 1, (3000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (200, 3))
+        k = 8
+
+        indices, distances = KDTree(points).query_knn(query_points, k)
+
+        naive_distances = np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+        self.assertTrue(np.array_equal(indices, np.argsort(naive_distances, axis=1)[:, :k]))
+        self.assertTrue(np.allclose(distances, np.sort(naive_distances, axis=1)[:, :k]))
+
+    def test_query_knn_more_than_points(self):
+        points = np.random.uniform(-1, 1, (3, 3))
+        indices, distances = KDTree(points).query_knn(np.zeros((1, 3)), 5)
+
+        self.assertTrue(np.array_equal(np.sort(indices[0, :3]), [0, 1, 2]))
+        self.assertTrue(np.all(indices[0, 3:] == -1))
+        self.assertTrue(np.all(np.isinf(distances[0, 3:])))
+
+    def test_query_radius(self):
+        points = np.random.uniform(-1, 1, (3000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (200, 3))
+        r = 0.2
+
+        indices, distances = KDTree(points).query_radius(query_points, r)
+
+        naive_distances = np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+        for q in range(len(query_points)):
+            naive_indices = np.flatnonzero(naive_distances[q] <= r)
+            self.assertEqual(set(indices[q]), set(naive_indices))
+            self.assertTrue(np.all(np.diff(distances[q]) >= 0))
+            self.assertTrue(np.allclose(distances[q], naive_distances[q, indices[q]]))
+
+    def test_leaf_sizes(self):
+        points = np.random.uniform(-1, 1, (2000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (200, 3))
+
+        naive_distances = np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+        for leaf_size in [1, 7, 64, 5000]:
+            indices, distances = KDTree(points, leaf_size=leaf_size).query_batch(query_points)
+            self.assertTrue(np.array_equal(indices, naive_distances.argmin(axis=1)))
+            self.assertTrue(np.allclose(distances, naive_distances.min(axis=1)))
+
+    def test_parallel_build(self):
+        points = np.random.uniform(-1, 1, (20000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (200, 3))
+
+        with mock.patch('kd_tree.PARALLEL_BUILD_MIN_POINTS', 1000):
+            kd_tree = KDTree(points, leaf_size=16, workers=4)
+
+        indices, distances = kd_tree.query_batch(query_points)
+        naive_distances = np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+        self.assertTrue(np.array_equal(indices, naive_distances.argmin(axis=1)))
+        self.assertTrue(np.array_equal(np.sort(kd_tree._idx), np.arange(len(points))))
+
+    def test_approximate_query(self):
+        points = np.random.uniform(-1, 1, (5000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (500, 3))
+        eps = 0.5
+
+        _, distances = KDTree(points).query_batch(query_points, eps=eps)
+
+        naive_distances = np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2).min(axis=1)
+        self.assertTrue(np.all(distances >= naive_distances - 1e-12))
+        self.assertTrue(np.all(distances <= (1 + eps) * naive_distances + 1e-12))
+
+    def test_parallel_query(self):
+        points = np.random.uniform(-1, 1, (5000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (1000, 3))
+
+        kd_tree = KDTree(points)
+        with mock.patch('kd_tree.PARALLEL_QUERY_MIN_POINTS', 100):
+            indices, distances = kd_tree.query_knn(query_points, 2, workers=2)
+        kd_tree.close()
+
+        expected_indices, expected_distances = kd_tree.query_knn(query_points, 2)
+        self.assertTrue(np.array_equal(indices, expected_indices))
+        self.assertTrue(np.array_equal(distances, expected_distances))
+
+    def test_worker_function(self):
+        # workers receive the function of the module imported by its top-level name
+        function = pickle.loads(pickle.dumps(_WorkerFunction('kd_tree', 'morton_order')))
+        self.assertIs(function, kd_tree_module.morton_order)
+
+        points = np.random.uniform(-1, 1, (100, 3))
+        self.assertTrue(np.array_equal(_WorkerFunction('kd_tree', 'morton_order')(points),
+                                       kd_tree_module.morton_order(points)))
+
+    def test_morton_query(self):
+        points = np.random.uniform(-1, 1, (5000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (2000, 3))
+        kd_tree = KDTree(points, leaf_size=16)
+
+        for k in (1, 3):
+            _, expected_distances = kd_tree.query_knn(query_points, k)
+            _, distances = kd_tree.query_knn(query_points, k, morton=True)
+            self.assertTrue(np.allclose(distances, expected_distances))
+
+        # approximate search may prune seeded bounds, but must still find a neighbor for every query
+        eps = 0.5
+        indices, distances = kd_tree.query_batch(query_points, eps=eps, morton=True)
+        self.assertTrue(np.all(indices >= 0))
+        self.assertTrue(np.all(distances <= (1 + eps) * expected_distances[:, 0] + 1e-12))
+
+    def test_position_normal_points(self):
+        # (position, scaled normal) points, as used by normal weighted matching
+        positions = np.random.uniform(-1, 1, (3000, 3))
+        normals = np.random.normal(size=(3000, 3))
+        normals /= np.linalg.norm(normals, axis=1)[:, None]
+        points = np.hstack((positions, 0.1 * normals))
+        query_points = points[:300] + np.random.normal(scale=0.05, size=(300, 6))
+
+        indices, _ = KDTree(points, dim=6, leaf_size=16).query_batch(query_points)
+
+        naive_distances = np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+        self.assertTrue(np.array_equal(indices, naive_distances.argmin(axis=1)))
+
+class TestDynamicKdTree(unittest.TestCase):
+
+    def assert_matches_naive(self, kd_tree: DynamicKDTree, points: dict):
+        ids = np.array(list(points.keys()))
+        positions = np.array([points[i] for i in ids])
+        query_points = np.random.uniform(-1.2, 1.2, (100, 3))
+
+        indices, _ = kd_tree.query_knn(query_points, 4)
+        naive_distances = np.linalg.norm(query_points[:, None, :] - positions[None, :, :], axis=2)
+        self.assertTrue(np.array_equal(indices, ids[np.argsort(naive_distances, axis=1)[:, :4]]))
+        self.assertEqual(len(kd_tree), len(points))
+
+    def test_insert_remove_update(self):
+        kd_tree = DynamicKDTree(np.random.uniform(-1, 1, (2000, 3)), leaf_size=16, buffer_size=32)
+        points = dict(enumerate(kd_tree.points.copy()))
+
+        for _ in range(50):
+            new_points = np.random.uniform(-1, 1, (random.randint(1, 40), 3))
+            points.update(zip(kd_tree.insert(new_points), new_points))
+
+            removed = random.sample(list(points.keys()), random.randint(1, 40))
+            kd_tree.remove(removed)
+            for i in removed:
+                del points[i]
+
+            moved = random.sample(list(points.keys()), random.randint(1, 40))
+            new_positions = np.random.uniform(-1, 1, (len(moved), 3))
+            kd_tree.update(moved, new_positions)
+            points.update(zip(moved, new_positions))
+
+            self.assert_matches_naive(kd_tree, points)
+
+    def test_update_removed(self):
+        kd_tree = DynamicKDTree(np.random.uniform(-1, 1, (100, 3)), leaf_size=16, buffer_size=32)
+        kd_tree.remove([3])
+
+        with self.assertRaises(ValueError):
+            kd_tree.update([3], [[0, 0, 0]])
+        self.assertEqual(len(kd_tree), 99)
+
+    def test_update_repeated_ids(self):
+        kd_tree = DynamicKDTree(np.random.uniform(-1, 1, (100, 3)), leaf_size=16, buffer_size=32)
+        kd_tree.update([7, 7], [[5, 5, 5], [2, 2, 2]])
+
+        # the point is moved once, to its last position
+        indices, distances = kd_tree.query_knn([[2, 2, 2]], 2)
+        self.assertEqual(indices[0, 0], 7)
+        self.assertNotEqual(indices[0, 1], 7)
+        self.assertAlmostEqual(distances[0, 0], 0.0)
+        self.assertEqual(len(kd_tree), 100)
@@ -0,0 +1,83 @@
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+from mesh_io import estimate_normals, read_points
+
+# unit cube, as 6 quads whose vertex order makes the normals point outwards
+CUBE_POINTS = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float64)
+CUBE_QUADS = np.array([[0, 1, 3, 2], [4, 6, 7, 5], [0, 4, 5, 1], [2, 3, 7, 6], [0, 2, 6, 4], [1, 5, 7, 3]])
+
+def ply_header(fmt: str, n_vertices: int, n_faces: int) -> str:
+    return (f'ply\nformat {fmt} 1.0\ncomment test\nelement vertex {n_vertices}\nproperty float x\nproperty float y\n'
+            f'property float z\nelement face {n_faces}\nproperty list uchar int vertex_indices\nend_header\n')
+
+class TestMeshIO(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = pathlib.Path(self._tmp.name)
+
+        # vertex normals of the cube point away from its center, up to the weighting of the triangulated quads
+        self.cube_normals = CUBE_POINTS - 0.5
+        self.cube_normals /= np.linalg.norm(self.cube_normals, axis=1)[:, None]
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_ply(self):
+        ascii_path = self.tmp / 'cube_ascii.ply'
+        with open(ascii_path, 'w') as fp:
+            fp.write(ply_header('ascii', 8, 6))
+            fp.writelines(' '.join(map(str, point)) + '\n' for point in CUBE_POINTS)
+            fp.writelines('4 ' + ' '.join(map(str, quad)) + '\n' for quad in CUBE_QUADS)
+
+        binary_path = self.tmp / 'cube_binary.ply'
+        faces = np.zeros(6, dtype=[('n', 'u1'), ('items', '>i4', (4,))])
+        faces['n'], faces['items'] = 4, CUBE_QUADS
+        with open(binary_path, 'wb') as fp:
+            fp.write(ply_header('binary_big_endian', 8, 6).encode('ascii'))
+            fp.write(CUBE_POINTS.astype('>f4').tobytes())
+            fp.write(faces.tobytes())
+
+        for path in (ascii_path, binary_path):
+            points, normals = read_points(path)
+            self.assertTrue(np.allclose(points, CUBE_POINTS))
+            self.assertGreater(np.einsum('ij,ij->i', normals, self.cube_normals).min(), 0.9)
+
+    def test_obj(self):
+        path = self.tmp / 'cube.obj'
+        with open(path, 'w') as fp:
+            fp.writelines(f'v {x} {y} {z}\n' for x, y, z in CUBE_POINTS)
+            # 1-based, negative and v/vt/vn indices
+            fp.writelines(f'f {a + 1}/1/1 {b + 1}//1 {c - 8} {d + 1}\n' for a, b, c, d in CUBE_QUADS)
+
+        points, normals = read_points(path)
+        self.assertTrue(np.allclose(points, CUBE_POINTS))
+        self.assertGreater(np.einsum('ij,ij->i', normals, self.cube_normals).min(), 0.9)
+
+    def test_xyz_and_npy(self):
+        points = np.random.normal(size=(500, 3))
+        normals = points / np.linalg.norm(points, axis=1)[:, None]
+
+        np.savetxt(self.tmp / 'points.xyz', np.hstack((points, 2 * normals)))
+        np.save(self.tmp / 'points.npy', np.hstack((points, normals)))
+        for name in ('points.xyz', 'points.npy'):
+            read, read_normals = read_points(self.tmp / name)
+            self.assertTrue(np.allclose(read, points))
+            self.assertTrue(np.allclose(read_normals, normals))
+
+        with self.assertRaises(ValueError):
+            read_points(self.tmp / 'points.stl')
+
+    def test_estimate_normals(self):
+        points = np.random.normal(size=(2000, 3))
+        points /= np.linalg.norm(points, axis=1)[:, None]
+
+        normals = estimate_normals(points)
+        self.assertGreater(np.einsum('ij,ij->i', normals, points).min(), 0.95)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import json
+import pathlib
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+import nn_index
+from kd_tree import KDTree
+from nn_index import AdaptiveIndex, BruteForceIndex, load_calibration, select_backend
+
+import numpy as np
+
+# synthetic calibration: brute force is free to build but scales with points times queries, voxel grids are cheap to
+# query but expensive to build
+CALIBRATION = {
+    'BRUTE_FORCE': {'build': [0.0, 0.0], 'query': [0.0, 0.0, 1e-8]},
+    'KD_TREE': {'build': [0.0, 1e-7], 'query': [1e-4, 1e-6]},
+    'VOXEL_GRID': {'build': [0.0, 1e-5], 'query': [1e-4, 1e-6]},
+}
+
+class TestBruteForceIndex(unittest.TestCase):
+
+    def test_query_knn(self):
+        points = np.random.uniform(-1, 1, (2000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (300, 3))
+
+        _, expected_distances = KDTree(points).query_knn(query_points, 4)
+        # a tiny memory budget forces one query per chunk
+        _, distances = BruteForceIndex(points, max_bytes=1).query_knn(query_points, 4)
+        self.assertTrue(np.allclose(distances, expected_distances))
+
+    def test_query_radius(self):
+        points = np.random.uniform(-1, 1, (2000, 3))
+        query_points = np.random.uniform(-1, 1, (50, 3))
+
+        expected_indices, _ = KDTree(points).query_radius(query_points, 0.2)
+        indices, distances = BruteForceIndex(points, max_bytes=10_000).query_radius(query_points, 0.2)
+        for i in range(len(query_points)):
+            self.assertEqual(set(indices[i]), set(expected_indices[i]))
+            self.assertTrue(np.all(np.diff(distances[i]) >= 0))
+
+    def test_memory_budget(self):
+        points = np.random.uniform(-1, 1, (10000, 3))
+        query_points = np.random.uniform(-1, 1, (2000, 3))
+        index = BruteForceIndex(points, max_bytes=4 << 20)
+
+        # the distance chunks stay within the budget, besides the (Q, k) results
+        tracemalloc.start()
+        index.query_knn(query_points, 4)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.assertLessEqual(peak, index.max_bytes + 3 * len(query_points) * 4 * 8)
+
+class TestAdaptiveIndex(unittest.TestCase):
+
+    def test_select_backend(self):
+        self.assertEqual(select_backend(100, 100, calibration=CALIBRATION), 'BRUTE_FORCE')
+        self.assertEqual(select_backend(100_000, 1000, calibration=CALIBRATION), 'KD_TREE')
+        self.assertEqual(select_backend(100_000, 1000, n_batches=10_000, calibration=CALIBRATION), 'VOXEL_GRID')
+        # voxel grids are only used for 3d points
+        self.assertEqual(select_backend(100_000, 1000, n_batches=10_000, dim=6, calibration=CALIBRATION), 'KD_TREE')
+
+    def test_queries(self):
+        points = np.random.uniform(-1, 1, (3000, 3))
+        query_points = np.random.uniform(-1, 1, (200, 3))
+        expected_indices, _ = KDTree(points).query_batch(query_points)
+
+        for n_batches, backend in ((1, 'KD_TREE'), (1000, 'VOXEL_GRID')):
+            index = AdaptiveIndex(points, n_queries=1000, n_batches=n_batches, calibration=CALIBRATION)
+            self.assertEqual(index.backend, backend)
+            indices, _ = index.query_batch(query_points)
+            self.assertTrue(np.array_equal(indices, expected_indices))
+            index.close()
+
+    def test_calibration_cache(self):
+        with tempfile.TemporaryDirectory() as tmp, mock.patch('nn_index.calibrate', return_value=CALIBRATION) as calib:
+            path = pathlib.Path(tmp) / 'calibration.json'
+
+            self.assertEqual(load_calibration(path), CALIBRATION)
+            self.assertEqual(calib.call_count, 1)
+
+            # read back from disk in a fresh process
+            nn_index._calibrations.clear()
+            self.assertEqual(load_calibration(path), CALIBRATION)
+            self.assertEqual(calib.call_count, 1)
+
+            # calibrations of other machines are redone
+            with open(path, 'r') as fp:
+                saved = json.load(fp)
+            saved['key']['node'] = 'other machine'
+            with open(path, 'w') as fp:
+                json.dump(saved, fp)
+            nn_index._calibrations.clear()
+            load_calibration(path)
+            self.assertEqual(calib.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
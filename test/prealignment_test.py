@@ -0,0 +1,74 @@
+import unittest
+
+import numpy as np
+
+from icp_engine import ICPEngine, transform_matrix
+from shapes import ellipsoid
+from prealignment import kabsch, prealign, principal_frame
+
+def cut_ellipsoid(n, seed):
+    # caps cut off along two axes, so that the shape has no rotational symmetry
+    points, normals = ellipsoid(n, seed)
+    keep = (points[:, 0] > -0.6) & (points[:, 1] > -0.5)
+    return points[keep], normals[keep]
+
+def random_rotation(rng):
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q *= np.sign(np.diag(r))
+    return q * np.sign(np.linalg.det(q))
+
+class TestPrealignment(unittest.TestCase):
+
+    def test_principal_frame(self):
+        points, _ = cut_ellipsoid(5000, 0)
+        rotation = random_rotation(np.random.default_rng(0))
+
+        # the frame turns with the points, signs included
+        centroid, axes = principal_frame(points)
+        moved_centroid, moved_axes = principal_frame(points @ rotation.T + [1, 2, 3])
+        self.assertTrue(np.allclose(moved_centroid, rotation @ centroid + [1, 2, 3]))
+        self.assertTrue(np.allclose(moved_axes, rotation @ axes))
+        self.assertAlmostEqual(np.linalg.det(axes), 1.0)
+
+    def test_kabsch(self):
+        rng = np.random.default_rng(0)
+        rotations = np.array([random_rotation(rng) for _ in range(5)])
+        translations = rng.normal(size=(5, 3))
+        ps = rng.normal(size=(5, 10, 3))
+        qs = np.einsum('hij,hkj->hki', rotations, ps) + translations[:, None, :]
+
+        r, t = kabsch(ps, qs)
+        self.assertTrue(np.allclose(r, rotations))
+        self.assertTrue(np.allclose(t, translations))
+
+    def test_prealign(self):
+        q_points, _ = cut_ellipsoid(20000, 0)
+        p_points, _ = cut_ellipsoid(10000, 1)
+        rng = np.random.default_rng(0)
+
+        for features in (False, True):
+            start = transform_matrix(random_rotation(rng), rng.normal(scale=0.5, size=3))
+            matrix = prealign(p_points @ start[:3, :3].T + start[:3, 3], q_points, features, rng) @ start
+
+            # coarse, up to the spacing of the downsampled points
+            self.assertTrue(np.allclose(matrix, np.eye(4), atol=0.1))
+
+    def test_register(self):
+        q_points, q_normals = cut_ellipsoid(20000, 0)
+        p_points, p_normals = cut_ellipsoid(10000, 1)
+        rng = np.random.default_rng(1)
+        start = transform_matrix(random_rotation(rng), [0.3, -0.2, 0.1])
+
+        # starting far away, pre-alignment finds the right pose, in fewer iterations
+        iterations = {}
+        for alignment in ('NONE', 'PCA'):
+            engine = ICPEngine(max_points=500, seed=0, point_to_plane=True, initial_alignment=alignment,
+                               verbose=False)
+            converged, iterations[alignment], matrix = engine.register(
+                p_points, p_normals, engine.prepare_fixed(q_points, q_normals, 500), start)
+            self.assertTrue(converged)
+        self.assertTrue(np.allclose(matrix, np.eye(4), atol=0.01))
+        self.assertLess(iterations['PCA'], iterations['NONE'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,18 @@
+import numpy as np
+
+def ellipsoid(n, seed, axes=(1.0, 0.7, 0.4)):
+    """
+    Points sampled on the surface of an ellipsoid, with their normals
+    :return: (n, 3) points and (n, 3) unit normals
+    """
+    points = np.random.default_rng(seed).normal(size=(n, 3))
+    points *= np.array(axes) / np.linalg.norm(points, axis=1)[:, None]
+    normals = points / np.array(axes) ** 2
+    return points, normals / np.linalg.norm(normals, axis=1)[:, None]
+
+def rotation(angle):
+    """
+    3x3 rotation by angle radians around the z axis
+    """
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
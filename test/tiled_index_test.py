@@ -0,0 +1,84 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from icp_engine import ICPEngine, close_levels, transform_matrix
+from shapes import ellipsoid, rotation
+from tiled_index import TiledIndex, build_tiles
+
+def naive_distances(query_points, points):
+    return np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+
+class TestTiledIndex(unittest.TestCase):
+
+    def test_build_tiles(self):
+        points, normals = ellipsoid(5000, 0)
+        with tempfile.TemporaryDirectory() as directory:
+            build_tiles(points, normals, directory, tile_points=200, chunk_points=1000)
+            index = TiledIndex(directory)
+
+            # every point is stored once, next to its normal, inside the bounding box of its tile
+            stored = np.asarray(index.points, dtype=np.float64)
+            order, stored_order = np.lexsort(points.T), np.lexsort(stored.T)
+            self.assertTrue(np.allclose(stored[stored_order], points[order], atol=1e-6))
+            self.assertTrue(np.allclose(index.normals[stored_order], normals[order], atol=1e-6))
+            self.assertGreater(index.n_tiles, 4)
+
+            tiles = np.repeat(np.arange(index.n_tiles), index._tile_count)
+            self.assertTrue(np.all(stored >= index._tile_lo[tiles]) and np.all(stored <= index._tile_hi[tiles]))
+            index.close()
+
+    def test_query_batch(self):
+        points, _ = ellipsoid(5000, 0)
+        with tempfile.TemporaryDirectory() as directory:
+            build_tiles(points, None, directory, tile_points=200)
+
+            # a budget of a few tiles, queries far from the surface visit many tiles
+            index = TiledIndex(directory, memory_budget=50_000)
+            query_points = np.vstack((points[:300] + np.random.normal(scale=0.02, size=(300, 3)),
+                                      np.random.uniform(-2, 2, (50, 3))))
+            indices, distances = index.query_batch(query_points)
+
+            naive = naive_distances(query_points, np.asarray(index.points, dtype=np.float64))
+            self.assertTrue(np.allclose(distances, naive.min(axis=1), atol=1e-9))
+            self.assertTrue(np.allclose(naive[np.arange(len(query_points)), indices], naive.min(axis=1)))
+            self.assertLessEqual(index._trees.size, 50_000)
+
+            # queries on a small patch of the surface only page in the tiles around it
+            index.close()
+            loads = index.tile_loads
+            index.query_batch(points[np.linalg.norm(points - points[0], axis=1) < 0.1])
+            self.assertLess(index.tile_loads - loads, index.n_tiles // 2)
+            index.close()
+
+    def test_register(self):
+        q_points, q_normals = ellipsoid(20000, 0)
+        p_points, p_normals = ellipsoid(5000, 1)
+        start = transform_matrix(rotation(0.2), [0.05, 0.02, 0.0])
+
+        with tempfile.TemporaryDirectory() as directory:
+            build_tiles(q_points, q_normals, directory, tile_points=1000)
+            engine = ICPEngine(max_points=500, seed=0, point_to_plane=True, pyramid_levels=2, verbose=False)
+            fixed_levels = engine.prepare_fixed_tiled(directory, 500, memory_budget=1 << 20)
+            converged, _, matrix = engine.register(p_points, p_normals, fixed_levels, start)
+            close_levels(fixed_levels)
+
+        self.assertTrue(converged)
+        self.assertTrue(np.allclose(matrix, np.eye(4), atol=0.01))
+
+    def test_coarse_levels(self):
+        points, normals = ellipsoid(20000, 0)
+        with tempfile.TemporaryDirectory() as directory:
+            build_tiles(points, normals, directory, tile_points=1000)
+
+            # the coarse levels are held in memory besides the budget, so their size is capped
+            engine = ICPEngine(pyramid_levels=3, pyramid_ratio=2, verbose=False)
+            with mock.patch('icp_engine.TILED_COARSE_POINTS', 1000):
+                fixed_levels = engine.prepare_fixed_tiled(directory, 500)
+            self.assertEqual([len(level[0]) for level in fixed_levels], [500, 1000, 20000])
+            close_levels(fixed_levels)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+
+import numpy as np
+
+from voxel_grid import VoxelGridIndex, voxel_downsample
+
+def naive_distances(query_points, points):
+    return np.linalg.norm(query_points[:, None, :] - points[None, :, :], axis=2)
+
+def sphere_points(n):
+    points = np.random.normal(size=(n, 3))
+    return points / np.linalg.norm(points, axis=1)[:, None]
+
+class TestVoxelGrid(unittest.TestCase):
+
+    def test_query_batch(self):
+        points = sphere_points(5000)
+        query_points = points[:500] + np.random.normal(scale=0.02, size=(500, 3))
+
+        indices, distances = VoxelGridIndex(points).query_batch(query_points)
+
+        naive = naive_distances(query_points, points)
+        self.assertTrue(np.array_equal(indices, naive.argmin(axis=1)))
+        self.assertTrue(np.allclose(distances, naive.min(axis=1)))
+
+    def test_far_queries(self):
+        points = sphere_points(2000)
+        query_points = np.random.uniform(-10, 10, (200, 3))
+
+        indices, _ = VoxelGridIndex(points).query_batch(query_points)
+        self.assertTrue(np.array_equal(indices, naive_distances(query_points, points).argmin(axis=1)))
+
+    def test_query_knn(self):
+        points = np.random.uniform(-1, 1, (3000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (200, 3))
+
+        indices, distances = VoxelGridIndex(points).query_knn(query_points, 6)
+
+        naive = naive_distances(query_points, points)
+        self.assertTrue(np.array_equal(indices, np.argsort(naive, axis=1)[:, :6]))
+        self.assertTrue(np.allclose(distances, np.sort(naive, axis=1)[:, :6]))
+
+    def test_query_radius(self):
+        points = np.random.uniform(-1, 1, (3000, 3))
+        query_points = np.random.uniform(-1.2, 1.2, (200, 3))
+
+        indices, distances = VoxelGridIndex(points, cell_size=0.07).query_radius(query_points, 0.2)
+
+        naive = naive_distances(query_points, points)
+        for q in range(len(query_points)):
+            self.assertEqual(set(indices[q]), set(np.flatnonzero(naive[q] <= 0.2)))
+            self.assertTrue(np.allclose(distances[q], naive[q, indices[q]]))
+
+    def test_voxel_downsample(self):
+        points = sphere_points(20000)
+
+        subset = voxel_downsample(points, 16)
+        self.assertTrue(500 < len(subset) < 2500)
+        self.assertTrue(np.all(np.diff(subset) > 0))
+
+        # every point has a representative nearby
+        distances = naive_distances(points[:500], points[subset]).min(axis=1)
+        self.assertLess(distances.max(), 0.2)
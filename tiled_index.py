@@ -0,0 +1,213 @@
+import json
+import pathlib
+
+import numpy as np
+
+try:
+    from .geometry_cache import GeometryCache
+    from .kd_tree import KDTree
+    from .mesh_io import estimate_normals, read_points
+    from .voxel_grid import VoxelGridIndex
+except ImportError:
+    from geometry_cache import GeometryCache
+    from kd_tree import KDTree
+    from mesh_io import estimate_normals, read_points
+    from voxel_grid import VoxelGridIndex
+
+# average number of points per tile aimed for
+TILE_POINTS = 1 << 20
+
+# points read from the source at once while building tiles
+CHUNK_POINTS = 1 << 22
+
+# the tile grid is sized on a strided sample of at most this many points
+SIZING_SAMPLE_POINTS = 1 << 20
+
+# upper bound on the number of (query, tile) lower bounds computed at once
+MAX_BOUNDS_PER_CHUNK = 1 << 22
+
+def build_tiles(points, normals, directory, tile_points=TILE_POINTS, chunk_points=CHUNK_POINTS) -> pathlib.Path:
+    """
+    Partition points into the tiles of a uniform grid, and write them to a directory sorted by tile, so that each
+    tile is a contiguous range of a memory-mapped array. Points are read and written in chunks, so points and
+    normals can be memory-mapped arrays larger than memory.
+    :param points: (N, 3) points
+    :param normals: (N, 3) normals, or None to estimate them from the points of each tile
+    :param tile_points: average number of points per occupied tile aimed for
+    :return: the directory
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    n = len(points)
+    chunks = [(lo, min(lo + chunk_points, n)) for lo in range(0, n, chunk_points)]
+
+    # grid origin, and a cell size whose occupied cells hold about tile_points points, chosen on a strided sample
+    origin = np.min([np.min(points[lo:hi], axis=0) for lo, hi in chunks], axis=0)
+    sample = np.asarray(points[::max(1, n // SIZING_SAMPLE_POINTS)], dtype=np.float64)
+    tile_size = VoxelGridIndex(sample, points_per_cell=max(tile_points * len(sample) / n, 1)).cell_size
+
+    def tile_keys(lo: int, hi: int) -> np.ndarray:
+        cells = np.floor((np.asarray(points[lo:hi], dtype=np.float64) - origin) / tile_size).astype(np.int64)
+        # cells are non-negative and far fewer than 2^21 per axis, so they pack into one key
+        return (cells[:, 0] << 42) | (cells[:, 1] << 21) | cells[:, 2]
+
+    # first pass: the occupied tiles and their sizes
+    keys = np.unique(np.concatenate([np.unique(tile_keys(lo, hi)) for lo, hi in chunks]))
+    counts = np.zeros(len(keys), dtype=np.int64)
+    for lo, hi in chunks:
+        counts += np.bincount(np.searchsorted(keys, tile_keys(lo, hi)), minlength=len(keys))
+    starts = np.cumsum(counts) - counts
+
+    # second pass: scatter each chunk to the next free rows of its tiles
+    out_points = np.lib.format.open_memmap(directory / 'points.npy', mode='w+', dtype=np.float32, shape=(n, 3))
+    out_normals = np.lib.format.open_memmap(directory / 'normals.npy', mode='w+', dtype=np.float32, shape=(n, 3))
+    cursor = starts.copy()
+    for lo, hi in chunks:
+        tiles = np.searchsorted(keys, tile_keys(lo, hi))
+        order = np.argsort(tiles, kind='stable')
+        chunk_counts = np.bincount(tiles, minlength=len(keys))
+        ranks = np.arange(hi - lo) - np.repeat(np.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        rows = cursor[tiles[order]] + ranks
+
+        out_points[rows] = np.asarray(points[lo:hi])[order]
+        if normals is not None:
+            out_normals[rows] = np.asarray(normals[lo:hi])[order]
+        cursor += chunk_counts
+
+    # bounding boxes of the tiles, and the normals of tiles that have none
+    center = np.sum([np.sum(points[lo:hi], axis=0, dtype=np.float64) for lo, hi in chunks], axis=0) / max(n, 1)
+    bounds_lo = np.empty((len(keys), 3))
+    bounds_hi = np.empty((len(keys), 3))
+    for tile, (start, count) in enumerate(zip(starts, counts)):
+        values = np.asarray(out_points[start:start + count], dtype=np.float64)
+        bounds_lo[tile], bounds_hi[tile] = values.min(axis=0), values.max(axis=0)
+        if normals is None:
+            out_normals[start:start + count] = estimate_normals(values, center=center)
+
+    out_points.flush()
+    out_normals.flush()
+    for name, array in (('tile_start', starts), ('tile_count', counts), ('tile_lo', bounds_lo),
+                        ('tile_hi', bounds_hi)):
+        np.save(directory / f'{name}.npy', array)
+    with open(directory / 'meta.json', 'w') as fp:
+        json.dump({'points': n, 'tiles': len(keys), 'tile_size': tile_size}, fp)
+
+    return directory
+
+def build_tiles_from_file(path, directory, tile_points=TILE_POINTS) -> pathlib.Path:
+    """
+    Build tiles from a point file. NPY files are memory-mapped, other formats are read into memory
+    """
+    path = pathlib.Path(path)
+    if path.suffix.lower() == '.npy':
+        values = np.load(path, mmap_mode='r')
+        if values.ndim != 2 or values.shape[1] not in {3, 6}:
+            raise ValueError(f'Expected an (N, 3) or (N, 6) array in {path}, got {values.shape}')
+        points, normals = values[:, :3], values[:, 3:] if values.shape[1] == 6 else None
+    else:
+        points, normals = read_points(path, estimate_missing_normals=False)
+    return build_tiles(points, normals, directory, tile_points)
+
+def is_tiled(directory) -> bool:
+    return (pathlib.Path(directory) / 'meta.json').exists()
+
+class TiledIndex:
+    """
+    Nearest neighbor index over points that are stored on disk in tiles, built by build_tiles, with the query
+    interface of KDTree.
+
+    The points and normals stay memory-mapped. Each query first searches the tile whose bounding box is closest to
+    it, which for the samples of an ICP iteration touches only the tiles near the moving object, and then every
+    other tile whose bounding box is closer than the best distance found so far. Tiles are searched with KDTrees,
+    built on first use and kept in a least recently used cache bounded by memory_budget bytes.
+    """
+
+    def __init__(self, directory, memory_budget=1 << 30):
+        """
+        :param directory: directory written by build_tiles
+        :param memory_budget: maximum total size of the kd-trees of the tiles kept in memory, in bytes. The
+        memory-mapped points and normals are paged by the operating system and not counted
+        """
+        directory = pathlib.Path(directory)
+        self.dim = 3
+        self.points = np.load(directory / 'points.npy', mmap_mode='r')
+        self.normals = np.load(directory / 'normals.npy', mmap_mode='r')
+        self._tile_start = np.load(directory / 'tile_start.npy')
+        self._tile_count = np.load(directory / 'tile_count.npy')
+        self._tile_lo = np.load(directory / 'tile_lo.npy')
+        self._tile_hi = np.load(directory / 'tile_hi.npy')
+        self._trees = GeometryCache(max_bytes=memory_budget)
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def n_tiles(self) -> int:
+        return len(self._tile_start)
+
+    @property
+    def tile_loads(self) -> int:
+        """
+        Number of times a tile was read from disk and its kd-tree built
+        """
+        return self._trees.misses
+
+    def _tree(self, tile: int) -> KDTree:
+        start, count = self._tile_start[tile], self._tile_count[tile]
+        return self._trees.get_or_build(
+            tile, lambda: KDTree(np.asarray(self.points[start:start + count], dtype=np.float64), workers=1))
+
+    def _lower_bounds(self, queries: np.ndarray) -> np.ndarray:
+        """
+        (Q, T) distances from the queries to the bounding boxes of the tiles
+        """
+        below = np.maximum(self._tile_lo[None, :, :] - queries[:, None, :], 0)
+        above = np.maximum(queries[:, None, :] - self._tile_hi[None, :, :], 0)
+        return np.linalg.norm(below + above, axis=2)
+
+    def _search_tile(self, tile: int, rows: np.ndarray, queries: np.ndarray, eps: float, best_idx: np.ndarray,
+                     best_dist: np.ndarray):
+        idx, dist = self._tree(tile).query_batch(queries[rows], eps=eps)
+        closer = dist < best_dist[rows]
+        best_idx[rows[closer]] = self._tile_start[tile] + idx[closer]
+        best_dist[rows[closer]] = dist[closer]
+
+    def query_batch(self, points, eps=0.0) -> (np.ndarray, np.ndarray):
+        """
+        Find the nearest neighbor of many query points at once
+        :param points: (Q, 3) array of query points
+        :param eps: approximation factor, neighbors may be up to (1 + eps) times farther than the nearest ones
+        :return: (Q,) indices into the tiled points and (Q,) euclidean distances
+        """
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+        best_idx = np.full(len(queries), -1, dtype=np.int64)
+        best_dist = np.full(len(queries), np.inf)
+
+        chunk = max(1, MAX_BOUNDS_PER_CHUNK // max(self.n_tiles, 1))
+        for lo in range(0, len(queries), chunk):
+            rows = np.arange(lo, min(lo + chunk, len(queries)))
+            bounds = self._lower_bounds(queries[rows])
+
+            # the tile closest to each query first
+            home = np.argmin(bounds, axis=1)
+            for tile in np.unique(home):
+                self._search_tile(tile, rows[home == tile], queries, eps, best_idx, best_dist)
+
+            # then the other tiles that may hold closer points, closest first so that the bounds prune most
+            bounds[np.arange(len(rows)), home] = np.inf
+            for tile in np.argsort(bounds.min(axis=0)):
+                active = bounds[:, tile] * (1 + eps) < best_dist[rows]
+                if np.any(active):
+                    self._search_tile(tile, rows[active], queries, eps, best_idx, best_dist)
+
+        return best_idx, best_dist
+
+    def get_nearest_neighbor(self, point) -> (np.ndarray, float):
+        indices, distances = self.query_batch(point)
+        return np.asarray(self.points[indices[0]], dtype=np.float64), distances[0]
+
+    def close(self):
+        """
+        Drop the kd-trees of all tiles
+        """
+        self._trees.clear()
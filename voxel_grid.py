@@ -0,0 +1,302 @@
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    from .kd_tree import brute_force_knn, merge_knn
+except ImportError:
+    from kd_tree import brute_force_knn, merge_knn
+
+# queries that are still unresolved after searching this many rings of cells are answered by brute force
+MAX_RING = 6
+
+# upper bound on the number of (query, point) pairs gathered at once
+MAX_PAIRS_PER_CHUNK = 1 << 22
+
+@lru_cache(maxsize=None)
+def _ring_offsets(r: int, dim: int) -> np.ndarray:
+    """
+    Integer offsets of all cells at Chebyshev distance exactly r from a cell
+    """
+    cube = np.indices((2 * r + 1,) * dim).reshape(dim, -1).T - r
+    return cube[np.abs(cube).max(axis=1) == r]
+
+@lru_cache(maxsize=None)
+def _cube_offsets(r: int, dim: int) -> np.ndarray:
+    """
+    Integer offsets of all cells at Chebyshev distance at most r from a cell
+    """
+    return np.indices((2 * r + 1,) * dim).reshape(dim, -1).T - r
+
+def _expand_ranges(owners: np.ndarray, starts: np.ndarray, counts: np.ndarray) -> (np.ndarray, np.ndarray):
+    """
+    Expand ranges [start, start + count) into one entry per element, tagged with the owner of its range
+    """
+    total = counts.sum()
+    element_owners = np.repeat(owners, counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return element_owners, np.repeat(starts, counts) + offsets
+
+class VoxelGridIndex:
+    """
+    Uniform grid over an (N, dim) point buffer, with the same query interface as KDTree.
+
+    Points are hashed to the linear index of their cell and sorted by it, so that each occupied cell is a contiguous
+    range of `_sorted_points`. Only occupied cells are stored, as sorted `_cell_keys` with `_cell_start` and
+    `_cell_count`. Nearest neighbor queries search rings of cells of growing Chebyshev radius around the query's
+    cell, until no unvisited cell can hold a closer point. This is fastest when queries lie close to the points,
+    e.g. when matching two roughly aligned objects.
+    """
+
+    def __init__(self, points, cell_size=None, points_per_cell=4, dim=3):
+        """
+        :param points: (N, dim) array of points
+        :param cell_size: edge length of the cells. If None, it is chosen from the sampling density of the points
+        :param points_per_cell: average number of points per occupied cell aimed for, if cell_size is None
+        :param dim: dimensionality of the points
+        """
+        self.dim = dim
+        self._points = np.asarray(points, dtype=np.float64).reshape(-1, dim)
+
+        n = len(self._points)
+        self._origin = self._points.min(axis=0) if n else np.zeros(dim)
+
+        if cell_size is None:
+            cell_size = self._estimate_cell_size(points_per_cell)
+        self.cell_size = float(cell_size)
+
+        # grid dimensions, and strides to turn integer cell coordinates into linear keys
+        cells = self._cell_coords(self._points)
+        self._dims = cells.max(axis=0) + 1 if n else np.ones(dim, dtype=np.int64)
+        self._strides = np.concatenate((np.cumprod(self._dims[::-1])[::-1][1:], [1]))
+
+        keys = cells @ self._strides
+        self._order = np.argsort(keys, kind='stable')
+        self._sorted_points = self._points[self._order]
+        self._cell_keys, self._cell_start, self._cell_count = np.unique(keys[self._order], return_index=True,
+                                                                        return_counts=True)
+
+    # flat arrays that make up a built grid
+    _ARRAYS = ['_points', '_origin', '_dims', '_strides', '_order', '_sorted_points', '_cell_keys', '_cell_start',
+               '_cell_count']
+
+    @classmethod
+    def _from_arrays(cls, arrays: dict[str, np.ndarray], dim: int, cell_size: float) -> 'VoxelGridIndex':
+        """
+        Wrap the arrays of an already built grid, e.g. views of shared memory, into a grid
+        """
+        grid = cls.__new__(cls)
+        grid.dim = dim
+        grid.cell_size = cell_size
+        for name in cls._ARRAYS:
+            setattr(grid, name, arrays[name])
+        return grid
+
+    def __len__(self):
+        return len(self._points)
+
+    def _cell_coords(self, points: np.ndarray) -> np.ndarray:
+        return np.floor((points - self._origin) / self.cell_size).astype(np.int64)
+
+    def _estimate_cell_size(self, points_per_cell: float) -> float:
+        n = len(self._points)
+        if n == 0:
+            return 1.0
+
+        extent = np.ptp(self._points, axis=0)
+        scale = max(extent.max(), 1e-12)
+
+        # start from the cell size that would fill the bounding box uniformly, then correct it for the actual
+        # occupancy, assuming the points sample a surface so that occupancy scales with the cell area
+        volume = np.prod(np.maximum(extent, 1e-3 * scale))
+        cell_size = (volume * points_per_cell / n) ** (1 / self.dim)
+        for _ in range(2):
+            cells = np.floor((self._points - self._origin) / cell_size).astype(np.int64)
+            dims = cells.max(axis=0) + 1
+            n_occupied = len(np.unique(np.ravel_multi_index(cells.T, dims)))
+            cell_size *= np.sqrt(points_per_cell * n_occupied / n)
+
+        return cell_size
+
+    def _lookup(self, cells: np.ndarray) -> (np.ndarray, np.ndarray):
+        """
+        :param cells: (M, dim) integer cell coordinates
+        :return: start and count of the points of each cell in _sorted_points, count is 0 for empty cells
+        """
+        inside = np.all((cells >= 0) & (cells < self._dims), axis=1)
+        keys = cells[inside] @ self._strides
+
+        pos = np.searchsorted(self._cell_keys, keys)
+        pos = np.minimum(pos, len(self._cell_keys) - 1)
+        found = self._cell_keys[pos] == keys
+
+        starts = np.zeros(len(cells), dtype=np.int64)
+        counts = np.zeros(len(cells), dtype=np.int64)
+        starts[np.flatnonzero(inside)[found]] = self._cell_start[pos[found]]
+        counts[np.flatnonzero(inside)[found]] = self._cell_count[pos[found]]
+        return starts, counts
+
+    def _candidates(self, qids: np.ndarray, qcells: np.ndarray, offsets: np.ndarray, queries: np.ndarray):
+        """
+        All (query, point) pairs between the queries qids and the points in cells qcells + offsets, in chunks
+        :return: generator of (query ids, point slots in _sorted_points, squared distances)
+        """
+        chunk = max(1, MAX_PAIRS_PER_CHUNK // (len(offsets) * 8))
+        for lo in range(0, len(qids), chunk):
+            chunk_qids = qids[lo:lo + chunk]
+            cells = (qcells[chunk_qids][:, None, :] + offsets[None, :, :]).reshape(-1, self.dim)
+            starts, counts = self._lookup(cells)
+
+            owners, slots = _expand_ranges(np.repeat(chunk_qids, len(offsets)), starts, counts)
+            d2 = np.sum((queries[owners] - self._sorted_points[slots]) ** 2, axis=1)
+            yield owners, slots, d2
+
+    def _push(self, best_idx: np.ndarray, best_d2: np.ndarray, owners: np.ndarray, slots: np.ndarray,
+              d2: np.ndarray):
+        """
+        Merge candidate (query, point) pairs into the (Q, k) nearest neighbor arrays
+        """
+        if len(owners) == 0:
+            return
+        k = best_d2.shape[1]
+
+        if k == 1:
+            # candidates are grouped by query, so the closest one of each group can be found with a segmented min
+            group_start = np.flatnonzero(np.concatenate(([True], owners[1:] != owners[:-1])))
+            group_min = np.minimum.reduceat(d2, group_start)
+            sizes = np.diff(np.append(group_start, len(owners)))
+
+            # first candidate of each group reaching the minimum
+            at_min = np.flatnonzero(d2 == np.repeat(group_min, sizes))
+            first = at_min[np.concatenate(([True], owners[at_min[1:]] != owners[at_min[:-1]]))]
+
+            closer = group_min < best_d2[owners[first], 0]
+            rows = owners[first[closer]]
+            best_d2[rows, 0] = group_min[closer]
+            best_idx[rows, 0] = self._order[slots[first[closer]]]
+            return
+
+        # keep the k closest candidates of each query
+        order = np.lexsort((d2, owners))
+        owners, slots, d2 = owners[order], slots[order], d2[order]
+        rank = np.arange(len(owners)) - np.searchsorted(owners, owners)
+        keep = rank < k
+
+        rows = np.unique(owners)
+        row = np.searchsorted(rows, owners[keep])
+        cand_idx = np.full((len(rows), k), -1, dtype=np.int64)
+        cand_d2 = np.full((len(rows), k), np.inf)
+        cand_idx[row, rank[keep]] = self._order[slots[keep]]
+        cand_d2[row, rank[keep]] = d2[keep]
+
+        best_idx[rows], best_d2[rows] = merge_knn([best_idx[rows], cand_idx], [best_d2[rows], cand_d2], k)
+
+    def query_knn(self, points, k: int, eps=0.0) -> (np.ndarray, np.ndarray):
+        """
+        Find the k nearest neighbors of many query points at once
+        :param points: (Q, dim) array of query points
+        :param k: number of neighbors per query
+        :param eps: if > 0, search approximately: the i-th neighbor returned is at most (1 + eps) times farther
+        than the true i-th nearest neighbor
+        :return: (Q, k) indices into the point buffer and (Q, k) euclidean distances, sorted by distance.
+        If there are fewer than k points, missing neighbors have index -1 and distance inf
+        """
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+        n_queries = len(queries)
+
+        best_idx = np.full((n_queries, k), -1, dtype=np.int64)
+        best_d2 = np.full((n_queries, k), np.inf)
+        if len(self._points) == 0 or n_queries == 0:
+            return best_idx, np.sqrt(best_d2)
+
+        rel = (queries - self._origin) / self.cell_size
+        qcells = np.floor(rel).astype(np.int64)
+
+        # distance from each query to the boundary of its own cell, which bounds the distance to the next ring
+        frac = rel - qcells
+        margin = np.minimum(frac, 1 - frac).min(axis=1) * self.cell_size
+
+        # first ring that intersects the grid, and ring after which the whole grid has been searched
+        r_start = np.maximum(np.maximum(-qcells, qcells - (self._dims - 1)).max(axis=1), 0)
+        r_end = np.maximum(qcells, self._dims - 1 - qcells).max(axis=1)
+
+        active = np.ones(n_queries, dtype=bool)
+        r = r_start.min()
+        while r <= MAX_RING and np.any(active):
+            ring_qids = np.flatnonzero(active & (r_start <= r))
+            for owners, slots, d2 in self._candidates(ring_qids, qcells, _ring_offsets(r, self.dim), queries):
+                self._push(best_idx, best_d2, owners, slots, d2)
+
+            # unvisited cells are at least r cells plus the margin away
+            bound = (1 + eps) * (r * self.cell_size + margin)
+            active &= (best_d2[:, -1] > bound ** 2) & (r < r_end)
+            r += 1
+
+        # resolve queries far from the points, or in very sparse regions, by brute force
+        remaining = np.flatnonzero(active)
+        if len(remaining):
+            idx, d2 = brute_force_knn(queries[remaining], self._points, k)
+            best_idx[remaining], best_d2[remaining] = idx, d2
+
+        return best_idx, np.sqrt(best_d2)
+
+    def query_batch(self, points, eps=0.0) -> (np.ndarray, np.ndarray):
+        """
+        Find the nearest neighbor of many query points at once
+        :param points: (Q, dim) array of query points
+        :param eps: if > 0, return (1 + eps)-approximate nearest neighbors
+        :return: (Q,) indices of the nearest points in the point buffer, and (Q,) euclidean distances to them
+        """
+        indices, distances = self.query_knn(points, k=1, eps=eps)
+        return indices[:, 0], distances[:, 0]
+
+    def query_radius(self, points, r: float) -> (list[np.ndarray], list[np.ndarray]):
+        """
+        Find all points within distance r of many query points at once
+        :param points: (Q, dim) array of query points
+        :param r: search radius
+        :return: for each query, an array of indices into the point buffer and an array of euclidean
+        distances, sorted by distance
+        """
+        queries = np.asarray(points, dtype=np.float64).reshape(-1, self.dim)
+        n_queries = len(queries)
+
+        qids, indices, d2 = [], [], []
+        if len(self._points):
+            qcells = self._cell_coords(queries)
+            offsets = _cube_offsets(int(np.ceil(r / self.cell_size)), self.dim)
+            for owners, slots, pair_d2 in self._candidates(np.arange(n_queries), qcells, offsets, queries):
+                inside = pair_d2 <= r * r
+                qids.append(owners[inside])
+                indices.append(self._order[slots[inside]])
+                d2.append(pair_d2[inside])
+
+        qids = np.concatenate(qids) if qids else np.zeros(0, dtype=np.int64)
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        d2 = np.concatenate(d2) if d2 else np.zeros(0)
+
+        # group matches per query, sorted by distance
+        order = np.lexsort((d2, qids))
+        splits = np.cumsum(np.bincount(qids, minlength=n_queries))[:-1]
+        return np.split(indices[order], splits), np.split(np.sqrt(d2[order]), splits)
+
+    def get_nearest_neighbor(self, point) -> (np.ndarray, float):
+        indices, distances = self.query_batch(point)
+        if indices[0] < 0:
+            return None, np.inf
+        return self._points[indices[0]], distances[0]
+
+def voxel_downsample(points, points_per_cell: float, cell_size: float = None) -> np.ndarray:
+    """
+    Downsample points to one point per occupied cell of a voxel grid, whose cells hold points_per_cell points on
+    average. The subset covers the points uniformly, unlike a random subset of dense and sparse regions
+    :param points: (N, dim) array of points
+    :param cell_size: edge length of the cells, e.g. to downsample several objects alike. Overrides points_per_cell
+    :return: sorted indices of about N / points_per_cell points
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if (cell_size is None and points_per_cell <= 1) or len(points) == 0:
+        return np.arange(len(points))
+
+    grid = VoxelGridIndex(points, cell_size=cell_size, points_per_cell=points_per_cell, dim=points.shape[1])
+    return np.sort(grid._order[grid._cell_start])